@@ -416,10 +416,20 @@ class AttachmentAPI(API):
         result = db.allDocs(wanted_ids, include_docs=True)
         # turn the result into a dict so we can detect missing ones etc.
         by_key = {}
+        accounts = None
         for row, si in zip(result['rows'], wanted_details):
             if 'doc' in row:
+                doc = row['doc']
+                # Attachments left on the server are fetched the first time
+                # someone asks for them, so the 'url' works.
+                if doc and 'remote' in doc:
+                    if accounts is None:
+                        accounts = get_api_config(req).accounts
+                    db.doc_model.ensure_remote_attachment(doc['remote'],
+                                                          accounts)
+                    del doc['remote']
                 schemas = by_key.setdefault(hashable_key(si['rd_key']), {})
-                schemas[si['rd_schema_id']] = self._filter_user_fields(row['doc'])
+                schemas[si['rd_schema_id']] = self._filter_user_fields(doc)
 
         # now back to the 'result' object.
         result = []
@@ -10,6 +10,7 @@ except ImportError:
     import ExifTags
 
 from cStringIO import StringIO
+import tempfile
 
 ct_images = set("""image/jpg image/jpeg image/png image/ppm image/gif
                 """.split())
@@ -17,18 +18,28 @@ ct_images = set("""image/jpg image/jpeg image/png image/ppm image/gif
 # these shouldn't be hard-coded!
 SIZE_THUMBNAIL = 100
 SIZE_PREVIEW = 1024
+# images larger than this are spooled to disk rather than held in memory.
+MAX_SPOOL_MEMORY = 1024*1024
 
 def handler(doc):
     if doc.get('content_type') not in ct_images:
         return
+    # Don't go and fetch images which were left on the server just to make
+    # a thumbnail.
+    if 'remote' in doc:
+        return
     # in theory PIL can handle it...
     logger.info("creating thumbnail and preview for %(_id)r", doc)
 
     # This is pretty hacky - we assume the URL is in "{doc_id}/attach"
     # format in this DB.
     docid, attach_id = doc['url'].split("/", 1)
-    attach_data = open_attachment(docid, attach_id)
-    infile = StringIO(attach_data)
+    # PIL wants to seek around the image, so we spool the streamed
+    # attachment into a temp file rather than reading it all into memory.
+    reader = open_attachment(docid, attach_id, stream=True)
+    infile = tempfile.SpooledTemporaryFile(MAX_SPOOL_MEMORY)
+    for data in reader:
+        infile.write(data)
     # Make the thumbnail and preview.
     for (name, size) in [
         ('thumbnail', SIZE_THUMBNAIL),
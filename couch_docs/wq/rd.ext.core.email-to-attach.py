@@ -1,7 +1,12 @@
 # Take email schemas and create schemas for the non-text attachments.
 def handler(doc):
     num = 0
-    for name, attach in doc['_attachments'].iteritems():
+    attachments = [(name, attach, "/%s/%s" % (doc['_id'], name))
+                   for name, attach in doc.get('_attachments', {}).iteritems()]
+    # large attachments may be stored in a shared 'blob' doc.
+    for name, ref in doc.get('rd_blobs', {}).iteritems():
+        attachments.append((name, ref, "/%s/blob" % (ref['blob_id'],)))
+    for name, attach, url in attachments:
         # skip text attachments.
         if attach['content_type'].lower().startswith("text/"):
             continue
@@ -11,8 +16,11 @@ def handler(doc):
                  'visible': True,
                  'content_type': attach['content_type'],
                  'length': attach['length'],
-                 'url': "/%s/%s" % (doc['_id'], name),
+                 'url': url,
                  }
+        # attachments left on the server are fetched when first opened.
+        if 'remote' in attach:
+            items['remote'] = attach
         attach_rdkey = ['attach', [doc['rd_key'], 'file', fname]]
         emit_schema('rd.attach.file', items, attach_rdkey)
         num += 1
@@ -27,15 +27,26 @@
 from raindrop.proto.imap import get_rdkey_for_email
 
 def handler(doc):
-    # This is dealing with the 'imap folder state cache doc' - it stores
-    # all meta-data about all items in a folder; so one document holds the
-    # state for many messages.  We first need to determine which are
-    # different...
+    # This is dealing with a segment of the 'imap folder state cache' - it
+    # stores all meta-data about the items in a range of UIDs in a folder; so
+    # one document holds the state for many messages.  We first need to
+    # determine which are different...
+    if not doc['infos']:
+        return
     rdkeys = []
     imap_flags = []
     folder_name = doc['rd_key'][1][1]
+    # Messages with the same ID as one in an earlier segment of the folder
+    # are noted by the IMAP protocol; skip them to avoid conflicts.
+    duplicate_uids = set(doc.get('duplicate_uids', []))
+    nduplicates = 0
 
     for item in doc['infos']:
+        if item['UID'] in duplicate_uids:
+            logger.debug('skipping duplicate message in folder %r: %r',
+                         folder_name, item['ENVELOPE'][-1])
+            nduplicates += 1
+            continue
         msg_id = item['ENVELOPE'][-1]
         rdkey = get_rdkey_for_email(msg_id)
         rdkeys.append(rdkey)
@@ -58,13 +69,13 @@ def handler(doc):
     # find what is different...
     nnew = 0
     nupdated = 0
-    # Note it is fairly common to see multiples with the same msg ID in, eg
-    # a 'drafts' folder, so skip duplicates to avoid conflicts.
+    # and skip duplicates within this segment.
     seen_keys = set()
     for rdkey, flags in imap_flags:
         if rdkey in seen_keys:
-            logger.info('skipping duplicate message in folder %r: %r',
-                        folder_name, rdkey)
+            logger.debug('skipping duplicate message in folder %r: %r',
+                         folder_name, rdkey)
+            nduplicates += 1
             continue
         if rdkey not in existing_rdkeys:
             # this means we haven't actually sucked the message into raindrop
@@ -100,5 +111,6 @@ def handler(doc):
                          }
                 emit_schema('rd.msg.seen', items, rdkey)
                 nupdated += 1
-    logger.info("folder %r needs %d new and %d updated 'seen' records",
-                folder_name, nnew, nupdated)
+    logger.info("folder %r needs %d new and %d updated 'seen' records "
+                "(%d duplicate messages skipped)",
+                folder_name, nnew, nupdated, nduplicates)
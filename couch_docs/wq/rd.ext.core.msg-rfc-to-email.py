@@ -114,7 +114,10 @@ def sanitize_attach_name(name):
     # and nuke spaces...
     return base.replace(" ", "")
 
-def attach_from_msg(attach_id, msg):
+# The header the IMAP protocol puts on parts it left on the server.
+REMOTE_PART_HEADER = "X-Raindrop-Remote-Part"
+
+def attach_from_msg(attach_id, msg, remote=None):
     ct = msg.get_content_type()
     cs = msg.get_content_charset()
     if cs:
@@ -127,6 +130,16 @@ def attach_from_msg(attach_id, msg):
                         attach_id, cs)
         else:
             ct += "; charset=" + cs
+    part_info = msg.get(REMOTE_PART_HEADER)
+    if remote is not None and part_info:
+        # The data was left on the server; tell the model where to find it
+        # when someone asks.
+        part_id, size = [p.strip() for p in part_info.split(";", 1)]
+        encoding = (msg.get('content-transfer-encoding') or '').lower()
+        return {'content_type': ct,
+                'length': int(size.split("=", 1)[1]),
+                'remote': dict(remote, part=part_id, encoding=encoding),
+                }
     return {'content_type': ct,
             'data': msg.get_payload(decode=True),
             }
@@ -134,7 +147,8 @@ def attach_from_msg(attach_id, msg):
 # Given a raw rfc822 message stream, return a list of useful schema instances
 # describing that message.
 # Returns a list of (schema_id, schema_fields) tuples.
-def doc_from_bytes(docid, rdkey, b):
+# 'remote' is set when some of the message's parts were left on the server.
+def doc_from_bytes(docid, rdkey, b, remote=None):
     msg = message_from_string(b)
     doc = {}
     mp = doc['multipart'] = msg.is_multipart()
@@ -189,10 +203,13 @@ def doc_from_bytes(docid, rdkey, b):
                 if not name:
                     name = "subpart-%d" % i
                     i += 1
-                attachments[name] = attach_from_msg((docid, name), attach)
+                attachments[name] = attach_from_msg((docid, name), attach,
+                                                    remote)
                 # Put together info about the attachment.
                 ah = {}
                 for hn, hv in attach.items():
+                    if hn.lower() == REMOTE_PART_HEADER.lower():
+                        continue
                     ah[hn.lower()] = _safe_convert_header(hv)
                 # content-type is redundant, but may be helpful...
                 ct = attachments[name]['content_type']
@@ -206,7 +223,8 @@ def doc_from_bytes(docid, rdkey, b):
 def handler(doc):
     # I need the binary attachment.
     content = open_schema_attachment(doc, "rfc822")
-    items, attachments = doc_from_bytes(doc['_id'], doc['rd_key'], content)
+    items, attachments = doc_from_bytes(doc['_id'], doc['rd_key'], content,
+                                        doc.get('remote'))
  
     # Get the timestamp for the message.   
     if 'headers' in items and 'date' in items['headers']:
@@ -0,0 +1,33 @@
+/* ***** BEGIN LICENSE BLOCK *****
+ * Version: MPL 1.1
+ *
+ * The contents of this file are subject to the Mozilla Public License Version
+ * 1.1 (the "License"); you may not use this file except in compliance with
+ * the License. You may obtain a copy of the License at
+ * http://www.mozilla.org/MPL/
+ *
+ * Software distributed under the License is distributed on an "AS IS" basis,
+ * WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+ * for the specific language governing rights and limitations under the
+ * License.
+ *
+ * The Original Code is Raindrop.
+ *
+ * The Initial Developer of the Original Code is
+ * Mozilla Messaging, Inc..
+ * Portions created by the Initial Developer are Copyright (C) 2009
+ * the Initial Developer. All Rights Reserved.
+ *
+ * Contributor(s):
+ * */
+
+// The blob documents referenced by each document, keyed by the blob ID.
+// Blobs are shared by every document with the same content, so this is
+// used to find which blobs are no longer referenced and can be deleted.
+function(doc) {
+  if (doc.rd_blobs) {
+    for (var name in doc.rd_blobs) {
+      emit(doc.rd_blobs[name].blob_id, null);
+    }
+  }
+}
@@ -0,0 +1,40 @@
+/* ***** BEGIN LICENSE BLOCK *****
+ * Version: MPL 1.1
+ *
+ * The contents of this file are subject to the Mozilla Public License Version
+ * 1.1 (the "License"); you may not use this file except in compliance with
+ * the License. You may obtain a copy of the License at
+ * http://www.mozilla.org/MPL/
+ *
+ * Software distributed under the License is distributed on an "AS IS" basis,
+ * WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+ * for the specific language governing rights and limitations under the
+ * License.
+ *
+ * The Original Code is Raindrop.
+ *
+ * The Initial Developer of the Original Code is
+ * Mozilla Messaging, Inc..
+ * Portions created by the Initial Developer are Copyright (C) 2009
+ * the Initial Developer. All Rights Reserved.
+ *
+ * Contributor(s):
+ * */
+
+// A _changes filter used by the raindrop work-queues so they only see
+// changes to documents holding the schemas they care about.  The schema IDs
+// are passed as a comma-separated 'schemas' query param.  Deletions are
+// always passed, as the tombstones have no schema and the queues' caches
+// must hear about them.
+function(doc, req) {
+  if (doc._deleted)
+    return true;
+  if (!doc.rd_schema_id || !req.query.schemas)
+    return false;
+  var schemas = req.query.schemas.split(",");
+  for (var i=0; i<schemas.length; i++) {
+    if (schemas[i] == doc.rd_schema_id)
+      return true;
+  }
+  return false;
+}
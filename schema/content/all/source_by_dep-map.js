@@ -0,0 +1,40 @@
+/* ***** BEGIN LICENSE BLOCK *****
+ * Version: MPL 1.1
+ *
+ * The contents of this file are subject to the Mozilla Public License Version
+ * 1.1 (the "License"); you may not use this file except in compliance with
+ * the License. You may obtain a copy of the License at
+ * http://www.mozilla.org/MPL/
+ *
+ * Software distributed under the License is distributed on an "AS IS" basis,
+ * WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+ * for the specific language governing rights and limitations under the
+ * License.
+ *
+ * The Original Code is Raindrop.
+ *
+ * The Initial Developer of the Original Code is
+ * Mozilla Messaging, Inc..
+ * Portions created by the Initial Developer are Copyright (C) 2009
+ * the Initial Developer. All Rights Reserved.
+ *
+ * Contributor(s):
+ * */
+
+// The documents schema items depend on, keyed by the [rd_key, schema_id]
+// of the dependency (exactly as in the megaview 'dep' rows), with the ID of
+// the item's source as the value.  Used by the work-queues to re-run
+// extensions when something they depend on changes; much smaller than the
+// 'dep' rows in the megaview.
+function(doc) {
+  if (doc.rd_schema_items) {
+    for (var rd_ext_id in doc.rd_schema_items) {
+      var schema_item = doc.rd_schema_items[rd_ext_id];
+      if (schema_item.rd_deps && schema_item.rd_source) {
+        for (var i=0; i<schema_item.rd_deps.length; i++) {
+          emit(schema_item.rd_deps[i], schema_item.rd_source[0]);
+        }
+      }
+    }
+  }
+}
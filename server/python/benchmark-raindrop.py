@@ -33,7 +33,7 @@ import optparse
 
 from raindrop import json
 from raindrop.config import get_config
-from raindrop.proto.imap import MAX_MESSAGES_PER_FETCH
+from raindrop.proto.imap import MESSAGES_PER_FETCH
 
 from raindrop.tests import TestCaseWithCorpus, FakeOptions
 from raindrop.config import get_config
@@ -93,7 +93,7 @@ def gen_batched_corpus_items(testcase, opts):
         this = []
         while sub_batch:
             this.append(sub_batch.pop(0))
-            if len(this) > MAX_MESSAGES_PER_FETCH:
+            if len(this) > MESSAGES_PER_FETCH:
                 yield this
                 this = []
         if this:
@@ -191,6 +191,62 @@ def run_timings_sync(opts):
     tc.tearDown()
 
 
+class ReplaySocket(object):
+    """Looks enough like a socket to replay a recorded response body."""
+    def __init__(self, data, max_read=16384):
+        self.data = memoryview(data)
+        self.offset = 0
+        self.max_read = max_read
+
+    def recv_into(self, buf):
+        nbytes = min(len(buf), self.max_read, len(self.data)-self.offset)
+        buf[:nbytes] = self.data[self.offset:self.offset+nbytes]
+        self.offset += nbytes
+        return nbytes
+
+
+def make_changes_stream(num_changes=50000):
+    # Build a chunked _changes response body like couch sends it.
+    chunks = []
+    for seq in xrange(1, num_changes+1):
+        line = json.dumps({'seq': seq,
+                           'id': 'rc!msg.%s!rd.msg.email' % ('x' * 40,),
+                           'changes': [{'rev': '1-%032x' % seq}],
+                           }) + "\n"
+        chunks.append("%x\r\n%s\r\n" % (len(line), line))
+        if seq % 100 == 0:
+            chunks.append("1\r\n\n\r\n") # a heartbeat.
+    return "".join(chunks)
+
+
+def parse_changes_stream(data):
+    from raindrop.changesiter import ChunkedLineParser
+    parser = ChunkedLineParser()
+    sock = ReplaySocket(data)
+    num = 0
+    while True:
+        chunk = parser.next_chunk()
+        if chunk is None:
+            if not parser.read_from(sock):
+                break
+            continue
+        if chunk.strip():
+            json.loads(chunk)
+            num += 1
+    return num
+
+
+def run_changes_parser_timings(opts):
+    if opts.changes_file:
+        # a recording of the body of a _changes?feed=continuous response.
+        data = open(opts.changes_file, "rb").read()
+    else:
+        data = make_changes_stream()
+    num, avg = timeit(parse_changes_stream, data)
+    print "Parsed %d changes from a %s stream in %.3f" % \
+          (num, format_num_bytes(len(data)), avg)
+
+
 def run_api_timings(opts):
     import httplib
     from urllib import urlencode    
@@ -244,8 +300,18 @@ the size on disk of the DB and views will be reported.""")
                       help="don't benchmark async processing")
     parser.add_option("", "--skip-api", action="store_true",
                       help="don't benchmark api processing")
+    parser.add_option("", "--skip-changes-parser", action="store_true",
+                      help="don't benchmark parsing of the _changes feed")
+    parser.add_option("", "--changes-file",
+                      help=
+"""A file holding a recorded (chunked) _changes feed response body to replay
+when benchmarking the _changes parser.  If not specified, a synthetic stream
+is used.""")
     opts, args = parser.parse_args()
 
+    if not opts.skip_changes_parser:
+        run_changes_parser_timings(opts)
+
     if not opts.skip_async:
         run_timings_async(opts)
     if not opts.skip_sync:
@@ -33,8 +33,9 @@
 import sys
 
 # Get the python version checks out of the way asap...
-if not hasattr(sys, "version_info") or sys.version_info < (2,5):
-    print >> sys.stderr, "raindrop requires Python 2.5 or later"
+# 2.7 is needed for (at least) memoryview and collections.OrderedDict.
+if not hasattr(sys, "version_info") or sys.version_info < (2,7):
+    print >> sys.stderr, "raindrop requires Python 2.7 or later"
     sys.exit(1)
 
 if sys.version_info > (3,):
@@ -78,7 +79,7 @@ deps = [
     ('feedparser', '>=4.1', False),
     ('Skype4Py', '', False),
     ('twitter', '>=1.3.1', False),
-    ('imapclient', '>=0.6', False),
+    ('imapclient', '>=0.9', False), # fetch modifiers and IDLE
     ('PIL', '', False),
 ]
 
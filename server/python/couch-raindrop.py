@@ -73,7 +73,7 @@ from twisted.python.failure import Failure
 from zope.interface import implements
 from twisted.internet import interfaces
 
-from raindrop import model, opts, config, proto
+from raindrop import model, opts, config, proto, profiler
 from raindrop.pipeline import Pipeline
 import raindrop.sync
 
@@ -187,7 +187,8 @@ def status(req):
         running[key] = time.time() - started
     ret = {"code": 200, "json": {"running": running,
                                  "finished": finished_tasks,
-                                 "conductor": conductor.get_status_ob()}}
+                                 "conductor": conductor.get_status_ob(),
+                                 "extensions": pipeline.get_stats()}}
     return ret
 
 
@@ -329,6 +330,8 @@ def main():
         parser.error("this program accepts no args")
 
     opts.setup_logging(options)
+    if options.profile:
+        profiler.start_profiling()
     config.init_config()
     proto.init_protocols()
 
@@ -366,6 +369,8 @@ def main():
     
     reactor.callWhenRunning(d.callback, None)
     reactor.run()
+    if options.profile:
+        profiler.stop_profiling(options.profile)
 
 if __name__ == "__main__":
     main()
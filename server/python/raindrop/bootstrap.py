@@ -597,13 +597,15 @@ def install_views(options, include_tests=False):
 
 
 def _build_views_doc_from_directory(ddir):
-    # all we look for is the views.  And the lists.  And the shows :)
+    # all we look for is the views.  And the lists.  And the shows.  And the
+    # filters :)
     ret = {}
     fprinter = Fingerprinter()
     ret_views = ret['views'] = {}
     mtail = "-map"
     rtail = "-reduce"
     ltail = "-list"
+    ftail = "-filter"
     stail = "-show"
     rwtail = "-rewrites"
     optstail = "-options"
@@ -659,6 +661,19 @@ def _build_views_doc_from_directory(ddir):
                 logger.warning("can't open list file %r - skipping this list", fqf)
                 continue
 
+        tail = ftail + ".js"
+        if fn.endswith(tail):
+            filter_name = fn[:-len(tail)]
+            info = ret.setdefault('filters', {})
+            try:
+                with open(fqf) as f:
+                    data = f.read()
+                    info[filter_name] = data
+                    fprinter.get_finger(filter_name+tail).update(data)
+            except (OSError, IOError):
+                logger.warning("can't open filter file %r - skipping this filter", fqf)
+                continue
+
         tail = rwtail + ".js"
         if fn.endswith(tail):
             rewrite_name = fn[:-len(tail)]
@@ -21,17 +21,83 @@
 # Contributor(s):
 #
 
+from __future__ import with_statement
+
 import httplib
 import socket
 import errno
 import select
-from cStringIO import StringIO
+import bisect
+import threading
+from urllib import urlencode
 from raindrop import json
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+# The design-doc filter (see schema/content/all/schema-filter.js) used to
+# only fetch the changes to documents holding specific schemas.
+SCHEMA_FILTER = "raindrop!content!all/schema"
+
+def get_filter_args(schemas):
+    """Returns the _changes args to filter by the given schema IDs"""
+    return {'filter': SCHEMA_FILTER, 'schemas': ",".join(schemas)}
+
+
+class ChunkedLineParser(object):
+    """An incremental parser for the body of a chunked _changes response.
+
+    Data is read directly from a socket into a reusable buffer and appended
+    to a bytearray; complete chunks are returned by reading forward from an
+    offset, so no data is copied more than once no matter how many chunks
+    are buffered.  Consumed data is discarded in bulk once it makes up
+    most of the buffer.
+    """
+    READ_SIZE = 65536
+    COMPACT_SIZE = 65536
+
+    def __init__(self):
+        self._read_buf = bytearray(self.READ_SIZE)
+        self._read_view = memoryview(self._read_buf)
+        self.reset()
+
+    def reset(self):
+        self._buf = bytearray()
+        self._pos = 0
+
+    def read_from(self, sock):
+        """Perform a single read from the socket into our buffer.
+
+        Returns the number of bytes read (zero means the connection was
+        closed).  Any socket errors (eg, EWOULDBLOCK) are propagated.
+        """
+        nbytes = sock.recv_into(self._read_buf)
+        self._buf += self._read_view[:nbytes]
+        return nbytes
+
+    def next_chunk(self):
+        """Returns the next complete chunk, or None if we don't yet have
+        one buffered."""
+        # Each chunk looks like: num_bytes\r\njson_str\r\n
+        buf = self._buf
+        pos = self._pos
+        eol = buf.find("\r\n", pos)
+        if eol == -1:
+            return None
+        # ignore any chunk extensions.
+        nbytes = int(str(buf[pos:eol]).split(";", 1)[0], 16)
+        start = eol + 2
+        end = start + nbytes
+        if len(buf) < end + 2: # the crlf chunk tail.
+            return None
+        chunk = str(buf[start:end])
+        self._pos = end + 2
+        if self._pos >= self.COMPACT_SIZE and self._pos * 2 >= len(buf):
+            del buf[:self._pos]
+            self._pos = 0
+        return chunk
+
 
 class ChangesIterFactory(object):
     """Creates multiple iterators based on a single _changes feed.
@@ -49,6 +115,8 @@ class ChangesIterFactory(object):
         self.is_waiting = False
         self.connection = None
         self.include_deps = False
+        # if not None, only changes to these schemas are fetched.
+        self.filter_schemas = None
 
     def stop(self):
         self.stopping = True
@@ -61,14 +129,16 @@ class ChangesIterFactory(object):
             pass
         logger.debug('closed %r', self.connection.sock)
 
-    def initialize(self, doc_model, start_seq, include_deps=False):
+    def initialize(self, doc_model, start_seq, include_deps=False,
+                   filter_schemas=None):
         self.include_deps = include_deps
+        self.filter_schemas = filter_schemas
         self.doc_model = doc_model
         self.current_seq = start_seq or 0
+        self._parser = ChunkedLineParser()
         # it isn't *necessary* to establish the connection yet, but we do
         # so fatal errors connecting to _changes are reported early.
         self._make_connection()
-        self._chunk_buf = StringIO()
 
         # now create another socket so we can shutdown when asked.
         self.control_socket = socket.socket()
@@ -91,11 +161,25 @@ class ChangesIterFactory(object):
         # blank lines we can ignore on every heartbeat period.
         path = "/%s/_changes?feed=continuous&heartbeat=60000&since=%d" % \
                 (db.dbName, self.current_seq)
+        if self.filter_schemas is not None:
+            path += "&" + urlencode(get_filter_args(self.filter_schemas))
         c.request("GET", path)
         self.connection = c
+        # anything buffered from an old connection is useless.
+        self._parser.reset()
         self.response = c.getresponse()
         # ensure all headers are fetched.
         self.response.begin()
+        if self.response.status != 200 and self.filter_schemas is not None:
+            # probably an old couch or the filter isn't installed - the
+            # extensions all filter what they are given anyway, so just
+            # take everything.
+            logger.warn("_changes feed failed to apply the schema filter "
+                        "(%s %s) - falling back to an unfiltered feed",
+                        self.response.status, self.response.reason)
+            c.close()
+            self.filter_schemas = None
+            return self._make_connection()
         # now we are ready for our funcky non-blocking read process.
         c.sock.setblocking(False)
 
@@ -103,30 +187,17 @@ class ChangesIterFactory(object):
         # this is complicated due to chunking and non-blocking sockets.
         # We can't use readline etc as it doesn't correctly buffer prior
         # input when a read throws the EWOULDBLOCK error.  So we need to
-        # manage this manually.
-        # Each chunk looks like: num_bytes\r\njson_str\r\n
-        # We take pains to always read what is available in the buffer and
-        # avoid iterating over the stream char by char...
+        # manage this manually via our parser.
         sock = self.connection.sock
+        parser = self._parser
         while True:
-            # Do we have enough in our buffer for an entire chunk?
-            cur = self._chunk_buf.getvalue()
-            bits = cur.split("\r\n", 1)
-            if len(bits)==2:
-                # we do have the chunk size - do we have the chunk itself,
-                # including the tail?
-                nbytes = int(bits[0], 16)
-                rest_nbytes = nbytes + 2 # the crlf chunk tail.
-                data = bits[1]
-                if len(data) >= rest_nbytes:
-                    # yay - we have a complete chunk...
-                    this_chunk = data[:nbytes]
-                    self._chunk_buf.seek(0)
-                    self._chunk_buf.truncate()
-                    self._chunk_buf.write(data[rest_nbytes:])
-                    return this_chunk
+            chunk = parser.next_chunk()
+            if chunk is not None:
+                return chunk
             # So we don't have enough buffered - perform a read then try again.
-            self._chunk_buf.write(sock.recv(4096))
+            if not parser.read_from(sock):
+                # connection closed - an empty line causes a reconnect.
+                return ''
 
     def _get_next_change(self, blocking):
         while True:
@@ -199,27 +270,346 @@ class ChangesIterFactory(object):
 
         # no more _changes waiting or batch size hit.  Do deps.
         if self.include_deps:
-            # find any documents which declare they depend on the documents
-            # in the list, then lookup the "source" of that doc
-            # (ie, the one that "normally" triggers that doc to re-run)
-            # and return that source.
-            all_ids = set()
-            keys = []
-            for elt in these_elts:
-                src_id = elt[0]
-                all_ids.add(src_id)
-                try:
-                    _, rd_key, schema_id = self.doc_model.split_doc_id(src_id)
-                except ValueError:
-                    # not a raindrop document - ignore it.
-                    continue
-                keys.append(["dep", [rd_key, schema_id]])
-            if keys:
-                results = self.doc_model.open_view(keys=keys, reduce=False)
-                rows = results['rows']
-                # Find all unique IDs.
-                result_seq = set()
-                for row in rows:
-                    src_id = row['value']['rd_source'][0]
-                    if src_id not in all_ids:
-                        yield src_id, None, None, self.current_seq
+            for elt in gen_dependencies(self.doc_model, these_elts,
+                                        self.current_seq):
+                yield elt
+
+
+def gen_dependencies(doc_model, elts, current_seq):
+    """Generate elements for the documents which depend on the given elts.
+    """
+    # find any documents which declare they depend on the documents
+    # in the list, then lookup the "source" of that doc
+    # (ie, the one that "normally" triggers that doc to re-run)
+    # and return that source.
+    all_ids = set(elt[0] for elt in elts)
+    if not all_ids:
+        return
+    seen = set()
+    for sources in doc_model.get_dependent_sources(all_ids).itervalues():
+        for src_id in sources:
+            if src_id not in all_ids and src_id not in seen:
+                seen.add(src_id)
+                yield src_id, None, None, current_seq
+
+
+class SharedChangesReader(object):
+    """Reads a single _changes feed and fans it out to many cursors.
+
+    A single thread reads and decodes the continuous _changes feed into a
+    buffer, and each work-queue reads from the buffer via its own
+    ChangesCursor.  The buffer is trimmed as the slowest cursor advances,
+    but never grows beyond MAX_BUFFERED changes - a cursor which falls
+    too far behind is detached and catches up using its own (non-continuous)
+    _changes requests, re-attaching once it reaches the buffer again.
+
+    A cursor may also be given a limit function, which returns the highest
+    sequence it may read (or None for no limit) - this lets a work-queue
+    wait until the queues upstream of it have processed a change before it
+    sees it.  When a document changes more than once in the buffer, cursors
+    skip all but the last change, as that change is the only one the
+    work-queue could still process.
+    """
+    MAX_BUFFERED = 20000 # pulled from a hat!
+    MAX_READ_AHEAD = 500 # changes read before waking the cursors.
+
+    def __init__(self):
+        self.stopping = False
+        self.failure = None
+        self.feed = None
+        self.cursors = []
+        self._cond = threading.Condition()
+        self._thread = None
+        # The buffer - parallel lists of sequence numbers and elements (the
+        # element is None for changes cursors ignore, such as deletions).
+        self._seqs = []
+        self._elts = []
+        # the absolute index of the first item in the buffer.
+        self._base_index = 0
+        # the sequence number of the change immediately before the first
+        # item in the buffer.
+        self._base_seq = 0
+        # doc ID -> absolute index of its most recent change in the buffer.
+        self._last_index = {}
+        self.num_superseded = 0
+        # If set, called (with our lock held) whenever a cursor blocks
+        # waiting for new changes.
+        self.on_wait = None
+
+    def initialize(self, doc_model, start_seq, filter_schemas=None):
+        # filter_schemas must include the schemas wanted by every cursor.
+        self.doc_model = doc_model
+        self._base_seq = start_seq or 0
+        self.feed = ChangesIterFactory()
+        self.feed.initialize(doc_model, self._base_seq,
+                             filter_schemas=filter_schemas)
+        self._thread = threading.Thread(target=self._reader_thread)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def make_cursor(self, start_seq, include_deps=False, filter_schemas=None,
+                    limit_func=None):
+        cursor = ChangesCursor(self, start_seq, include_deps, filter_schemas,
+                               limit_func)
+        with self._cond:
+            self.cursors.append(cursor)
+            self._attach(cursor)
+        return cursor
+
+    def get_last_seq(self):
+        # The sequence of the last change the reader has seen.
+        with self._cond:
+            if self._seqs:
+                return self._seqs[-1]
+            return self._base_seq
+
+    def notify_progress(self):
+        # Called when a cursor's limit may have changed.
+        with self._cond:
+            self._cond.notifyAll()
+
+    def stop(self):
+        with self._cond:
+            self.stopping = True
+            self._cond.notifyAll()
+        self.feed.stop()
+        self._thread.join(10)
+        if self._thread.isAlive():
+            logger.warn("failed to wait for the _changes reader to complete")
+
+    def _reader_thread(self):
+        feed = self.feed
+        try:
+            while not self.stopping:
+                change = feed._get_next_change(True)
+                if change is None:
+                    break # stopping.
+                # the feed reconnects from current_seq if it needs to.
+                feed.current_seq = change['seq']
+                changes = [change]
+                # and grab what else is already waiting, so cursors are
+                # woken once per burst rather than once per change.
+                while len(changes) < self.MAX_READ_AHEAD:
+                    change = feed._get_next_change(False)
+                    if change is None:
+                        break
+                    feed.current_seq = change['seq']
+                    changes.append(change)
+                # The doc model's cache must forget about these before any
+                # cursor gets to see them.
+                cache = self.doc_model.doc_cache
+                if cache is not None:
+                    for change in changes:
+                        if 'id' in change:
+                            cache.invalidate(change['id'],
+                                None if 'deleted' in change else
+                                change['changes'][-1]['rev'])
+                with self._cond:
+                    for change in changes:
+                        elt = feed._change_to_elt(change)
+                        if elt is not None:
+                            self._last_index[elt[0]] = self._base_index + \
+                                                       len(self._seqs)
+                        self._seqs.append(change['seq'])
+                        self._elts.append(elt)
+                    self._trim()
+                    self._cond.notifyAll()
+        except Exception, exc:
+            logger.exception("the _changes reader failed")
+            self.failure = exc
+        with self._cond:
+            self._cond.notifyAll()
+
+    # All the functions below must be called with self._cond held.
+    def _attach(self, cursor):
+        # Attach a detached cursor to the buffer if the buffer holds all
+        # changes since the cursor's position.
+        if cursor.current_seq < self._base_seq:
+            return False
+        pos = bisect.bisect_right(self._seqs, cursor.current_seq)
+        cursor.next_index = self._base_index + pos
+        logger.debug("changes cursor attached to shared feed at sequence %s",
+                     cursor.current_seq)
+        return True
+
+    def _trim(self):
+        # discard everything all attached cursors have seen.
+        end_index = self._base_index + len(self._seqs)
+        attached = [c.next_index for c in self.cursors
+                    if c.next_index is not None and not c.stopping]
+        new_base = min(attached or [end_index])
+        # But if the slowest is too far behind, detach it.
+        if end_index - new_base > self.MAX_BUFFERED:
+            new_base = end_index - self.MAX_BUFFERED
+            for c in self.cursors:
+                if c.next_index is not None and c.next_index < new_base:
+                    logger.info("changes cursor at sequence %s has fallen "
+                                "behind the shared feed", c.current_seq)
+                    c.next_index = None
+        num = new_base - self._base_index
+        if num > 0:
+            last_index = self._last_index
+            for index, elt in enumerate(self._elts[:num]):
+                if elt is not None and \
+                   last_index.get(elt[0]) == self._base_index + index:
+                    del last_index[elt[0]]
+            self._base_seq = self._seqs[num-1]
+            del self._seqs[:num]
+            del self._elts[:num]
+            self._base_index = new_base
+
+    def _read(self, cursor, batch_size):
+        # Returns up to batch_size (seq, elt) tuples for an attached cursor,
+        # blocking if none are available.  Returns an empty list if the
+        # cursor becomes detached or we are stopping.
+        while True:
+            if self.failure is not None:
+                raise RuntimeError("the _changes reader failed: %s" %
+                                   (self.failure,))
+            if cursor.stopping or self.stopping or cursor.next_index is None:
+                return []
+            start = cursor.next_index - self._base_index
+            limit = cursor.get_limit()
+            if limit is None:
+                avail = len(self._seqs)
+            else:
+                avail = bisect.bisect_right(self._seqs, limit)
+            if start < avail:
+                break
+            # If we are only waiting for an upstream queue we aren't idle.
+            cursor.is_waiting = start >= len(self._seqs)
+            if cursor.is_waiting and self.on_wait is not None:
+                self.on_wait()
+            self._cond.wait()
+        cursor.is_waiting = False
+        end = min(start + batch_size, avail)
+        ret = []
+        for index in range(start, end):
+            elt = self._elts[index]
+            if elt is not None and \
+               self._last_index.get(elt[0]) != self._base_index + index:
+                # there is a later change to this doc in the buffer.
+                self.num_superseded += 1
+                elt = None
+            ret.append((self._seqs[index], elt))
+        cursor.next_index += len(ret)
+        self._trim()
+        return ret
+
+
+class ChangesCursor(object):
+    """A single work-queue's position in a SharedChangesReader.
+
+    Provides the same interface to the work-queues as a ChangesIterFactory
+    does.
+    """
+    CATCHUP_BATCH_SIZE = 2000
+
+    def __init__(self, reader, start_seq, include_deps, filter_schemas=None,
+                 limit_func=None):
+        self.reader = reader
+        self.doc_model = reader.doc_model
+        self.current_seq = start_seq or 0
+        self.include_deps = include_deps
+        # used only when catching up - the shared feed is filtered by the
+        # reader.
+        self.filter_schemas = filter_schemas
+        self.limit_func = limit_func
+        self.stopping = False
+        self.is_waiting = False
+        # the absolute index into the reader's buffer of the next change we
+        # should see, or None if we are detached and catching up.
+        self.next_index = None
+        # While catching up, the limit which stopped us reading further.
+        self._blocked_limit = None
+
+    def stop(self):
+        reader = self.reader
+        with reader._cond:
+            self.stopping = True
+            reader._cond.notifyAll()
+
+    def get_limit(self):
+        # The highest sequence we may read, or None.
+        if self.limit_func is None:
+            return None
+        return self.limit_func()
+
+    def _read_catchup(self, batch_size):
+        # Read directly from a non-continuous _changes feed.
+        db = self.doc_model.db
+        args = {'since': self.current_seq, 'limit': batch_size}
+        if self.filter_schemas is not None:
+            args.update(get_filter_args(self.filter_schemas))
+        # Note where the reader was before we make the request.
+        with self.reader._cond:
+            reader_seq = self.reader._base_seq
+        try:
+            result = db.listChanges(**args)
+        except db.Error, exc:
+            if self.filter_schemas is None:
+                raise
+            logger.warn("_changes request failed to apply the schema "
+                        "filter (%s) - falling back to an unfiltered feed",
+                        exc)
+            self.filter_schemas = None
+            return self._read_catchup(batch_size)
+        rows = result['results']
+        limit = self.get_limit()
+        self._blocked_limit = None
+        if limit is not None:
+            rows = [row for row in rows if row['seq'] <= limit]
+            if not rows and result['results']:
+                # waiting for the queues upstream of us.
+                self._blocked_limit = limit
+                return []
+        if not rows:
+            # We are at the end of the feed - and given the feed may be
+            # filtered, we know there is nothing for us before where the
+            # reader was when we started.
+            last_seq = max(result.get('last_seq'), reader_seq)
+            if last_seq > self.current_seq:
+                self.current_seq = last_seq
+        return [(row['seq'], self.reader.feed._change_to_elt(row))
+                for row in rows]
+
+    def _read_batch(self, batch_size):
+        reader = self.reader
+        while not self.stopping and not reader.stopping:
+            with reader._cond:
+                attached = self.next_index is not None or \
+                           reader._attach(self)
+                if attached:
+                    batch = reader._read(self, batch_size)
+            if not attached:
+                batch = self._read_catchup(min(batch_size,
+                                               self.CATCHUP_BATCH_SIZE))
+                if not batch and self._blocked_limit is not None:
+                    # waiting for the queues upstream of us - the pipeline
+                    # calls notify_progress when they get further.
+                    with reader._cond:
+                        while self.get_limit() == self._blocked_limit and \
+                              not self.stopping and not reader.stopping and \
+                              reader.failure is None:
+                            reader._cond.wait()
+                # otherwise we are at the end of the feed, so will attach
+                # to the reader next time around.
+            # The reader may hand us changes we already saw while catching
+            # up.
+            batch = [b for b in batch if b[0] > self.current_seq]
+            if batch:
+                return batch
+        return []
+
+    def make_iter(self, batch_size):
+        these_elts = []
+        for seq, elt in self._read_batch(batch_size):
+            self.current_seq = seq
+            if elt is not None:
+                these_elts.append(elt)
+                yield elt
+
+        if self.include_deps:
+            for elt in gen_dependencies(self.doc_model, these_elts,
+                                        self.current_seq):
+                yield elt
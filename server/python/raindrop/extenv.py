@@ -24,6 +24,7 @@
 # The raindrop 'extension environment'.  Responsible for setting up all the
 # globals available to extensions.
 import uuid
+import threading
 import logging
 
 logger = logging.getLogger(__name__)
@@ -35,6 +36,61 @@ def reset_for_test_suite():
     _my_identities[:] = []
     _known_grouping_tags.clear()
 
+# The names of the functions from get_ext_env() installed in each
+# extension's globals.
+ENV_FUNCTION_NAMES = ('emit_schema', 'emit_related_identities',
+                      'find_and_emit_conversation', 'init_grouping_tag',
+                      'open_attachment', 'open_schema_attachment',
+                      'open_schemas', 'process_later',
+                      'get_schema_attachment_info', 'open_view',
+                      'update_documents', 'get_my_identities', 'hashable_key')
+
+# The environments of the extensions running in each thread, keyed by
+# extension ID.
+_current = threading.local()
+
+def _get_running_envs():
+    try:
+        return _current.envs
+    except AttributeError:
+        _current.envs = envs = {}
+        return envs
+
+def _make_env_proxy(ext_id, name):
+    def proxy(*args, **kw):
+        try:
+            env = _current.envs[ext_id]
+        except (AttributeError, KeyError):
+            raise RuntimeError("%s can only be called while extension %r is "
+                               "running" % (name, ext_id))
+        return env[name](*args, **kw)
+    proxy.__name__ = name
+    return proxy
+
+def install_ext_env(ext):
+    """Install the environment functions (emit_schema etc) into the globals
+    of an extension.
+
+    Rather than the globals being updated before each call, they are proxies
+    which find the environment of the invocation running in the current
+    thread (see set_ext_env), so the same extension may run in many threads
+    at once.
+    """
+    for name in ENV_FUNCTION_NAMES:
+        ext.globs[name] = _make_env_proxy(ext.id, name)
+    ext.globs['logger'] = logging.getLogger('raindrop.ext.'+ext.id)
+
+def set_ext_env(ext, new_globs):
+    """Make new_globs (as returned by get_ext_env) the environment of the
+    extension for the current thread."""
+    envs = _get_running_envs()
+    if ext.id in envs:
+        raise RuntimeError("%r is already running in this thread" % (ext.id,))
+    envs[ext.id] = new_globs
+
+def clear_ext_env(ext):
+    del _get_running_envs()[ext.id]
+
 
 class ProcessLaterException(Exception):
     def __init__(self, value):
@@ -49,6 +105,31 @@ def get_ext_env(doc_model, context, src_doc, ext):
     # NOTE: These are all called in the context of a worker thread and
     # are expected by the caller to block.
     new_items = context['new_items']
+    # If the context has an ExtensionStats, the couch calls made by the
+    # extension are counted.
+    stats = context.get('stats')
+
+    # If the context has a 'before_query' function, it is called each time
+    # the extension queries the couch - see ProcessingQueueRunner.
+    before_query = context.get('before_query')
+
+    def _note_call(name):
+        if stats is not None:
+            stats.incr(name)
+
+    def _note_query():
+        context['did_query'] = True
+        if before_query is not None:
+            before_query()
+
+    def _note_attachment(result):
+        if stats is not None:
+            stats.incr('open_attachment')
+            if isinstance(result, basestring):
+                stats.incr('attachment_bytes', len(result))
+            elif getattr(result, 'length', None):
+                stats.incr('attachment_bytes', result.length)
+        return result
 
     def _do_deps(schema_item, deps):
         if deps is InternalNoDepsSentinal:
@@ -120,28 +201,30 @@ def get_ext_env(doc_model, context, src_doc, ext):
                      ext.id, len(new_items))
 
     def open_schema_attachment(src, attachment, **kw):
-        "A function to abstract document storage requirements away..."
-        doc_id = src['_id']
-        dm = doc_model
-        found, info = dm.get_schema_attachment_info(src, attachment)
-        logger.debug("attempting to open attachment %s/%s", doc_id, found)
-        return dm.db.openDoc(dm.quote_id(doc_id), attachment=found, **kw)
+        """A function to abstract document storage requirements away...
+        Pass stream=True to get back a file-like object rather than the
+        entire attachment as a string."""
+        return _note_attachment(doc_model.open_schema_attachment(src,
+                                                attachment, **kw))
 
-    def open_attachment(doc_id, attach_id):
+    def open_attachment(doc_id, attach_id, **kw):
         "A function to abstract document storage requirements away..."
         dm = doc_model
         logger.debug("attempting to open attachment %s/%s", doc_id, attach_id)
-        return dm.db.openDoc(dm.quote_id(doc_id), attachment=attach_id)
+        return _note_attachment(dm.db.openDoc(dm.quote_id(doc_id),
+                                              attachment=attach_id, **kw))
 
     def open_view(*args, **kw):
-        context['did_query'] = True
+        _note_query()
+        _note_call('open_view')
         return doc_model.open_view(*args, **kw)
 
     def open_schemas(*args, **kw):
+        _note_call('open_schemas')
         return doc_model.open_schemas(*args, **kw)
 
     def update_documents(docs):
-        context['did_query'] = True
+        _note_query()
         assert docs, "please fix the extension to not bother calling with no docs!"
         return doc_model.update_documents(docs)
 
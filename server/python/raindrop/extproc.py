@@ -0,0 +1,164 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+
+# The raindrop 'extension process pool'.  Extensions which declare
+# "execution": "process" have their handlers run in worker processes, so
+# CPU-bound extensions (eg, parsing messages or making thumbnails) can use
+# all our cores rather than fighting over the GIL.
+# The parent fetches the source document and its attachments and ships them
+# to a worker; the worker runs the handler and sends back the schema items
+# it emitted.  Anything else the extension does (eg, open_view) is done
+# using the worker's own connection to the couch.
+import sys
+import time
+import signal
+import traceback
+import multiprocessing
+from cStringIO import StringIO
+
+import extenv
+from raindrop.model import DocumentModel
+from raindrop.wetpaisley import CouchDB
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+class RemoteExtensionError(Exception):
+    """An extension failed in a worker process; the message includes the
+    traceback from the worker."""
+
+_pool = None
+
+def start_pool(doc_model, num_processes=None):
+    """Start the worker processes.  This should be done before any other
+    threads are started, as the workers are forked from this process."""
+    global _pool
+    assert _pool is None, "already have a process pool"
+    db = doc_model.db
+    args = (db.host, db.port, db.dbName, db.username, db.password,
+            doc_model.dedupe_attachments)
+    _pool = multiprocessing.Pool(num_processes, _init_worker, args)
+    logger.info("started extension process pool")
+
+def stop_pool():
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+
+def get_pool():
+    """Returns the process pool, or None if no pool is running."""
+    return _pool
+
+
+# Everything below here runs in the worker processes.
+_doc_model = None
+_extensions = {} # ext_id -> (_rev of the extension doc, Extension)
+
+def _init_worker(host, port, db_name, username, password, dedupe_attachments):
+    global _doc_model
+    # The parent takes care of ctrl+c.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # We must not share the parent's connections to the couch.
+    db = CouchDB(host, port, db_name, username, password)
+    _doc_model = DocumentModel(db, dedupe_attachments=dedupe_attachments)
+
+def _get_extension(ext_doc):
+    # lazily compile the extension, recompiling if it changes.
+    from raindrop.pipeline import make_extension
+    ext_id = ext_doc['rd_key'][1]
+    try:
+        rev, ext = _extensions[ext_id]
+    except KeyError:
+        rev = ext = None
+    if rev != ext_doc['_rev']:
+        ext = make_extension(ext_doc)
+        if ext is None:
+            raise RuntimeError("failed to load extension %r" % (ext_id,))
+        _extensions[ext_id] = ext_doc['_rev'], ext
+    return ext
+
+def _read_attachments(new_items):
+    # file-like attachment data can't be sent back to the parent.
+    for item in new_items:
+        for info in (item.get('attachments') or {}).itervalues():
+            data = info.get('data')
+            if hasattr(data, 'read'):
+                info['data'] = data.read()
+
+def run_handler(ext_doc, src_doc, attachments):
+    """Run the handler for an extension over a single source document.
+
+    attachments is a dict of the source document's attachments, keyed by
+    their 'base name'.  Returns a tuple of (status, value, did_query, stats),
+    where status is one of 'ok' (value is the list of new schema items),
+    'later' (value is what was passed to process_later) or 'error' (value is
+    the formatted traceback), and stats is an ExtensionStats dict with the
+    couch calls and handler time of this call.
+    """
+    from raindrop.pipeline import ExtensionStats, get_thread_cpu_time
+    new_items = []
+    stats = ExtensionStats()
+    context = {'new_items': new_items, 'stats': stats}
+    start = time.time()
+    start_cpu = get_thread_cpu_time()
+    try:
+        try:
+            ext = _get_extension(ext_doc)
+            new_globs = extenv.get_ext_env(_doc_model, context, src_doc, ext)
+            # attachments we weren't sent are fetched as normal.
+            fetch_attachment = new_globs['open_schema_attachment']
+
+            def open_schema_attachment(src, attachment, **kw):
+                if src.get('_id') == src_doc['_id'] and \
+                   attachment in attachments:
+                    data = attachments[attachment]
+                    stats.incr('open_attachment')
+                    stats.incr('attachment_bytes', len(data))
+                    if kw.get('stream'):
+                        return StringIO(data)
+                    return data
+                return fetch_attachment(src, attachment, **kw)
+
+            new_globs['open_schema_attachment'] = open_schema_attachment
+            extenv.set_ext_env(ext, new_globs)
+            try:
+                result = ext.handler(src_doc)
+            finally:
+                extenv.clear_ext_env(ext)
+            if result is not None:
+                logger.warn("extension %r returned value %r which is ignored",
+                            ext.id, result)
+            _read_attachments(new_items)
+        finally:
+            stats.note_time('wall_ms', time.time() - start)
+            if start_cpu is not None:
+                stats.note_time('cpu_ms', get_thread_cpu_time() - start_cpu)
+    except extenv.ProcessLaterException, exc:
+        return 'later', exc.value, 'did_query' in context, stats.as_dict()
+    except Exception:
+        tb = ''.join(traceback.format_exception(*sys.exc_info()))
+        return 'error', tb, 'did_query' in context, stats.as_dict()
+    return 'ok', new_items, 'did_query' in context, stats.as_dict()
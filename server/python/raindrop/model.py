@@ -21,11 +21,15 @@
 # Contributor(s):
 #
 
+import sys
 import logging
 import time
+import threading
 from urllib import quote
 import base64
 import itertools
+import hashlib
+from collections import OrderedDict # python 2.7 - see check-raindrop.py
 
 from .config import get_config
 from .wetpaisley import CouchDB, CouchError
@@ -51,6 +55,382 @@ def encode_provider_id(proto_id):
     return base64.encodestring(proto_id).replace('\n', '')
 
 
+class PendingWrite(object):
+    """The schema items one caller handed to the DocumentModel to be written
+    at some point in the future.  Once written, 'errors' holds the
+    DocumentSaveError infos for the documents these items targetted."""
+    def __init__(self, items):
+        self.items = items
+        self.doc_ids = None
+        self.errors = []
+        self.exc_info = None
+        self.done = threading.Event()
+
+    def wait(self):
+        self.done.wait()
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.errors
+
+
+def _write_pending(doc_model, pendings):
+    # Write the items from all the pending writes in a single operation,
+    # then tell each of the writers how their items went.  Items from
+    # different writers which target the same document end up being applied
+    # to that document in memory and written once.
+    items = []
+    writers_by_id = {}
+    for pending in pendings:
+        ids = pending.doc_ids = set()
+        for si in pending.items:
+            did = doc_model.get_doc_id_for_schema_item(si)
+            ids.add(did)
+            writers_by_id.setdefault(did, []).append(pending)
+        items.extend(pending.items)
+    try:
+        try:
+            if items:
+                doc_model.create_schema_items(items)
+        except DocumentSaveError, exc:
+            for info in exc.infos:
+                for pending in writers_by_id.get(info.get('id'), pendings):
+                    if info not in pending.errors:
+                        pending.errors.append(info)
+        except:
+            exc_info = sys.exc_info()
+            for pending in pendings:
+                pending.exc_info = exc_info
+    finally:
+        for pending in pendings:
+            pending.done.set()
+
+
+class WriteBehindBuffer(object):
+    """Collects the schema items written by many threads (typically each of
+    the work-queues) and writes them in larger batches.  Items are written
+    once MAX_BATCH items are waiting, once the oldest has been waiting for
+    MAX_LATENCY seconds or when a writer asks for its items to be flushed.
+    """
+    MAX_LATENCY = 0.5 # seconds - pulled from a hat!
+    MAX_BATCH = 500 # items - also pulled from a hat!
+
+    def __init__(self, doc_model, max_latency=None, max_batch=None):
+        self.doc_model = doc_model
+        if max_latency is not None:
+            self.MAX_LATENCY = max_latency
+        if max_batch is not None:
+            self.MAX_BATCH = max_batch
+        self._cond = threading.Condition()
+        self._queued = [] # PendingWrite objects not yet being written.
+        self._num_queued = 0 # total items in the above.
+        self._oldest = None # time the first of the above was queued.
+        self._running = False
+        self._thread = None
+        # some simple stats.
+        self.num_writes = 0
+        self.num_items = 0
+
+    def start(self):
+        assert self._thread is None, "already started"
+        self._running = True
+        self._thread = threading.Thread(target=self._flusher_thread)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        self._cond.acquire()
+        try:
+            self._running = False
+            self._cond.notify()
+        finally:
+            self._cond.release()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        # write whatever was still waiting.
+        self._write(self._take())
+
+    def queue_items(self, items):
+        """Queue some items for writing; returns a PendingWrite which can
+        be passed to flush()"""
+        pending = PendingWrite(items)
+        self._cond.acquire()
+        try:
+            self._queued.append(pending)
+            self._num_queued += len(items)
+            if self._oldest is None:
+                self._oldest = time.time()
+                # the flusher thread needs to start the clock.
+                self._cond.notify()
+            if self._num_queued >= self.MAX_BATCH:
+                batch = self._take()
+            else:
+                batch = None
+        finally:
+            self._cond.release()
+        # We write a full batch in the thread which filled it, so multiple
+        # full batches can be written in parallel.
+        if batch:
+            self._write(batch)
+        return pending
+
+    def flush(self, pendings):
+        """A barrier - writes everything queued (by any thread) if any of
+        the specified writes are yet to start, then waits for all of them to
+        complete.  Returns a list of the DocumentSaveError infos for all
+        of the writes."""
+        batch = None
+        self._cond.acquire()
+        try:
+            for pending in pendings:
+                if not pending.done.isSet() and pending in self._queued:
+                    batch = self._take()
+                    break
+        finally:
+            self._cond.release()
+        if batch:
+            self._write(batch)
+        errors = []
+        for pending in pendings:
+            errors.extend(pending.wait())
+        return errors
+
+    def _take(self):
+        # must be called with the lock held (or once the thread has stopped)
+        ret = self._queued
+        self._queued = []
+        self._num_queued = 0
+        self._oldest = None
+        return ret
+
+    def _write(self, batch):
+        if not batch:
+            return
+        num = sum(len(p.items) for p in batch)
+        logger.debug("write-behind buffer writing %d items from %d writers",
+                     num, len(batch))
+        self.num_writes += 1
+        self.num_items += num
+        _write_pending(self.doc_model, batch)
+
+    def _flusher_thread(self):
+        # Only responsible for writing items which have been waiting too long;
+        # full batches and flushes are written by the threads which
+        # requested them.
+        while True:
+            batch = None
+            self._cond.acquire()
+            try:
+                while self._running:
+                    if self._oldest is None:
+                        self._cond.wait()
+                        continue
+                    waited = time.time() - self._oldest
+                    if waited >= self.MAX_LATENCY:
+                        batch = self._take()
+                        break
+                    self._cond.wait(self.MAX_LATENCY - waited)
+                else:
+                    return
+            finally:
+                self._cond.release()
+            try:
+                self._write(batch)
+            except Exception:
+                # errors have been passed to the writers...
+                logger.exception("write-behind buffer failed to write")
+
+
+class DocumentCache(object):
+    """A bounded LRU cache of documents, used by open_documents_by_id.
+
+    The cache can't know when documents change, so whoever owns it must call
+    invalidate() for every change - the work-queues do this from the
+    _changes feed they are reading.  If that feed is filtered, only
+    documents with the schemas it sees are cached.  Documents are held as
+    JSON strings; the size of these strings is what MAX_BYTES limits and
+    each caller gets a fresh copy of the doc.
+    """
+    MAX_BYTES = 32 * 1024 * 1024 # pulled from a hat!
+    # how many invalidated IDs we remember while documents are being fetched.
+    MAX_INVALIDATED = 10000 # also pulled from a hat!
+
+    def __init__(self, max_bytes=None, schemas=None):
+        if max_bytes is not None:
+            self.MAX_BYTES = max_bytes
+        self.schemas = schemas
+        if schemas is not None:
+            self.schemas = set(schemas)
+        self._lock = threading.Lock()
+        self._docs = OrderedDict() # doc_id -> (rev, json_string)
+        self.num_bytes = 0
+        # Every invalidation bumps the generation; a document fetched before
+        # an invalidation of its ID must not be cached - it may be stale.
+        self._gen = 0
+        self._invalidated = {} # doc_id -> generation it was invalidated.
+        self._min_gen = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+    def start_fetch(self):
+        """Returns a token to be passed to put() for docs fetched after
+        this call."""
+        return self._gen
+
+    def get(self, doc_id):
+        self._lock.acquire()
+        try:
+            try:
+                entry = self._docs.pop(doc_id)
+            except KeyError:
+                self.misses += 1
+                return None
+            # re-insert so it is the most recently used.
+            self._docs[doc_id] = entry
+            self.hits += 1
+        finally:
+            self._lock.release()
+        return json.loads(entry[1])
+
+    def put(self, doc, token):
+        if self.schemas is not None and \
+           doc.get('rd_schema_id') not in self.schemas:
+            # we won't hear about changes to this doc.
+            return
+        doc_id = doc['_id']
+        data = json.dumps(doc)
+        self._lock.acquire()
+        try:
+            if token < self._min_gen or \
+               self._invalidated.get(doc_id, -1) > token:
+                return
+            old = self._docs.pop(doc_id, None)
+            if old is not None:
+                self.num_bytes -= len(old[1])
+            self._docs[doc_id] = (doc['_rev'], data)
+            self.num_bytes += len(data)
+            while self.num_bytes > self.MAX_BYTES:
+                _, (_, old_data) = self._docs.popitem(last=False)
+                self.num_bytes -= len(old_data)
+        finally:
+            self._lock.release()
+
+    def invalidate(self, doc_id, rev=None):
+        """Note a doc has changed.  If rev is specified and is the revision
+        we hold, the doc is kept."""
+        self._lock.acquire()
+        try:
+            self._gen += 1
+            if len(self._invalidated) >= self.MAX_INVALIDATED:
+                # forget them all and refuse anything fetched before now.
+                self._invalidated.clear()
+                self._min_gen = self._gen
+            self._invalidated[doc_id] = self._gen
+            entry = self._docs.get(doc_id)
+            if entry is not None and (rev is None or entry[0] != rev):
+                del self._docs[doc_id]
+                self.num_bytes -= len(entry[1])
+        finally:
+            self._lock.release()
+
+
+class DependencyIndex(object):
+    """Memoizes lookups of the documents which declared (via rd_deps) that
+    they depend on other documents.
+
+    The lookups are done using the compact 'source_by_dep' view, keyed by
+    the [rd_key, schema_id] of the document depended upon and whose value is
+    the ID of the 'source' of the dependent item.  Each doc ID's result is
+    remembered for up to MAX_AGE seconds; as new dependencies only appear
+    when an item declaring them is written, the doc model forgets the IDs
+    named in the items it writes, so our own writes are seen immediately.
+    Writes made by other processes are seen once the result expires.
+    """
+    MAX_ENTRIES = 100000 # pulled from a hat!
+    MAX_AGE = 300 # seconds - also pulled from a hat!
+    # how many invalidated IDs we remember while lookups are in progress.
+    MAX_INVALIDATED = 10000
+
+    def __init__(self, doc_model, max_entries=None, max_age=None):
+        self.doc_model = doc_model
+        if max_entries is not None:
+            self.MAX_ENTRIES = max_entries
+        if max_age is not None:
+            self.MAX_AGE = max_age
+        self._lock = threading.Lock()
+        self._sources = OrderedDict() # doc_id -> (time, [source_id, ...])
+        # As for the DocumentCache, a lookup started before an ID was
+        # invalidated must not be remembered.
+        self._gen = 0
+        self._invalidated = {} # doc_id -> generation it was invalidated.
+        self._min_gen = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._sources)
+
+    def lookup(self, doc_ids):
+        """Returns a dict of doc_id -> list of the source IDs of the items
+        which depend on it.  All IDs we don't remember are fetched in a
+        single request."""
+        result = {}
+        missing = []
+        expired = time.time() - self.MAX_AGE
+        self._lock.acquire()
+        try:
+            for doc_id in doc_ids:
+                if doc_id in result:
+                    continue
+                entry = self._sources.pop(doc_id, None)
+                if entry is None or entry[0] < expired:
+                    result[doc_id] = None
+                    missing.append(doc_id)
+                    self.misses += 1
+                else:
+                    self._sources[doc_id] = entry
+                    result[doc_id] = entry[1]
+                    self.hits += 1
+            token = self._gen
+        finally:
+            self._lock.release()
+        if not missing:
+            return result
+        now = time.time()
+        fetched = self.doc_model._open_dependent_sources(missing)
+        self._lock.acquire()
+        try:
+            for doc_id in missing:
+                sources = result[doc_id] = fetched[doc_id]
+                if token < self._min_gen or \
+                   self._invalidated.get(doc_id, -1) > token:
+                    continue
+                self._sources[doc_id] = now, sources
+            while len(self._sources) > self.MAX_ENTRIES:
+                self._sources.popitem(last=False)
+        finally:
+            self._lock.release()
+        return result
+
+    def invalidate(self, doc_ids):
+        """Note items depending on these doc IDs have been written."""
+        self._lock.acquire()
+        try:
+            self._gen += 1
+            if len(self._invalidated) + len(doc_ids) > self.MAX_INVALIDATED:
+                # forget them all and refuse anything fetched before now.
+                self._invalidated.clear()
+                self._min_gen = self._gen
+            for doc_id in doc_ids:
+                self._invalidated[doc_id] = self._gen
+                self._sources.pop(doc_id, None)
+        finally:
+            self._lock.release()
+
+
 class _NotSpecified:
     pass
 
@@ -68,7 +448,9 @@ def get_db(couchname="local", dbname=_NotSpecified):
         pass
     logger.info("Connecting to couchdb at %s", dbinfo)
     db = CouchDB(dbinfo['host'], dbinfo['port'], dbname,
-                 dbinfo.get('username'), dbinfo.get('password'))
+                 dbinfo.get('username'), dbinfo.get('password'),
+                 pool_size=dbinfo.get('max-connections'),
+                 pool_timeout=dbinfo.get('connection-timeout'))
     DBs[key] = db
     return db
 
@@ -78,11 +460,37 @@ class DocumentModel(object):
        creating the unique ID for each document (other than the raw document),
        for fetching documents based on an ID, etc
     """
-    MAX_INLINE_ATTACH_SIZE = 100000 # pulled from a hat!
-    def __init__(self, db):
+    # Documents with more than this many bytes of attachments have them
+    # saved individually rather than inline in the _bulk_docs request.
+    MAX_INLINE_ATTACH_SIZE = 4000000 # pulled from a hat!
+    # The number of (base64 encoded) attachment bytes we are willing to send
+    # in a single _bulk_docs request; more than this and the docs are split
+    # over multiple requests.
+    MAX_BULK_ATTACH_SIZE = 8000000 # also pulled from a hat!
+    # When dedupe_attachments is set, attachments of at least this size are
+    # stored once in a 'blob' document keyed by a hash of their content.
+    # The schema document then only holds a reference in 'rd_blobs'.
+    MIN_BLOB_SIZE = 4096 # pulled from a hat!
+    BLOB_ID_PREFIX = "rb!"
+    # Extensions may emit a 'remote' attachment - a placeholder for data
+    # which was left on the server it came from (eg, a large attachment of
+    # an IMAP message.)  It is also held in 'rd_blobs', referencing a blob
+    # keyed by its location, which is created when it is first opened.
+    REMOTE_BLOB_ID_PREFIX = BLOB_ID_PREFIX + "remote-"
+    BLOB_ATTACH_NAME = "blob"
+    def __init__(self, db, dedupe_attachments=False):
         self.db = db
+        self.dedupe_attachments = dedupe_attachments
         self._important_views = None # views we update periodically
         self._extension_confidences = {}
+        self._known_blobs = set() # blob doc IDs we know exist.
+        # blob doc IDs a write of ours is about to reference -> count.  These
+        # are never deleted, even if no document yet refers to them.
+        self._blobs_in_flight = {}
+        self._blob_lock = threading.Lock()
+        self.write_buffer = None # a WriteBehindBuffer when started.
+        self.doc_cache = None # a DocumentCache when started.
+        self.dep_index = None # a DependencyIndex when started.
 
     def set_extension_confidences(self, conf):
         self._extension_confidences = conf
@@ -165,8 +573,33 @@ class DocumentModel(object):
                      docId, viewId, args, kwargs)
         return self.db.openView(docId, viewId, *args, **kwargs)
 
+    def iter_view(self, docId='raindrop!content!all', viewId='megaview',
+                  **kwargs):
+        """Like open_view, but returns an iterator over the rows - the
+        rows are fetched in pages as the iterator is consumed."""
+        logger.debug("attempting to iterate view %s/%s - %r",
+                     docId, viewId, kwargs)
+        return self.db.iterView(docId, viewId, **kwargs)
+
     def open_documents_by_id(self, doc_ids, **kw):
         """Open documents by the already constructed docid"""
+        cache = self.doc_cache
+        # only plain old documents are cached.
+        if cache is None or kw:
+            return self._open_documents_by_id(doc_ids, **kw)
+        ret = [cache.get(did) for did in doc_ids]
+        missing = [did for did, doc in zip(doc_ids, ret) if doc is None]
+        if missing:
+            token = cache.start_fetch()
+            fetched = dict(zip(missing, self._open_documents_by_id(missing)))
+            for i, doc in enumerate(ret):
+                if doc is None:
+                    doc = ret[i] = fetched[doc_ids[i]]
+                    if doc is not None:
+                        cache.put(doc, token)
+        return ret
+
+    def _open_documents_by_id(self, doc_ids, **kw):
         logger.debug("attempting to open documents %r", doc_ids)
         kwuse = kw.copy()
         if 'include_docs' not in kwuse:
@@ -220,6 +653,13 @@ class DocumentModel(object):
         bits = ['rc', key_part, sch_id]
         return "!".join(bits)
 
+    @classmethod
+    def get_doc_id_for_dep(cls, dep):
+        """Returns the doc ID for an item in a schema's 'rd_deps'"""
+        rd_key, schema_id = dep
+        return cls._calc_doc_id_for_schema_item({'rd_key': rd_key,
+                                                 'rd_schema_id': schema_id})
+
     @classmethod
     def split_doc_id(cls, doc_id, decode_key=True):
         if not doc_id.startswith('rc!'):
@@ -237,13 +677,23 @@ class DocumentModel(object):
     def delete_documents(self, docs):
         for doc in docs:
             doc['_deleted'] = True
-        results = self.db.updateDocuments(docs)
+        self._invalidate_cached(docs)
+        try:
+            results = self.db.updateDocuments(docs)
+        finally:
+            # a reader may have cached the old revision while we wrote.
+            self._invalidate_cached(docs)
         # XXX - this error handling is also duplicated below.
         errors = []
+        old_blobs = set()
         for doc, dinfo in zip(docs, results):
             if 'error' in dinfo:
                 # presumably an unexpected error :(
                 errors.append(dinfo)
+            else:
+                old_blobs.update(self._get_blob_ids(doc))
+        if old_blobs:
+            self._delete_unreferenced_blobs(old_blobs)
         if errors:
             raise DocumentSaveError(errors)
         return results
@@ -252,32 +702,83 @@ class DocumentModel(object):
         assert docs, "don't call me when you have no docs!"
         logger.debug("attempting to update %d documents", len(docs))
 
-        attachments = self._prepare_attachments(docs)
-        results = self.db.updateDocuments(docs)
-        errors = []
-        update_items = []
-        real_ret = []
-        for doc, dattach, dinfo in zip(docs, attachments, results):
-            if 'error' in dinfo:
-                # presumably an unexpected error :(
-                errors.append(dinfo)
-            else:
-                # attachments...
-                while dattach:
-                    name, info = dattach.popitem()
-                    docid = dinfo['id']
-                    revision = dinfo['rev']
-                    logger.debug('saving attachment %r to doc %r', name, docid)
-                    dinfo = self.db.saveAttachment(self.quote_id(docid),
-                             self.quote_id(name), info['data'],
-                             content_type=info['content_type'],
-                             revision=revision)
-
-                real_ret.append(dinfo)
+        attachments, blob_ids = self._prepare_attachments(docs)
+        self._invalidate_cached(docs)
+        try:
+            results = []
+            for chunk in self._gen_bulk_chunks(docs):
+                results.extend(self.db.updateDocuments(chunk))
+            # only now can a new lookup see the dependencies we wrote.
+            self._invalidate_deps(docs)
+            errors = []
+            update_items = []
+            real_ret = []
+            for doc, dattach, dinfo in zip(docs, attachments, results):
+                if 'error' in dinfo:
+                    # presumably an unexpected error :(
+                    errors.append(dinfo)
+                else:
+                    # attachments...
+                    while dattach:
+                        name, info = dattach.popitem()
+                        docid = dinfo['id']
+                        revision = dinfo['rev']
+                        logger.debug('saving attachment %r to doc %r', name, docid)
+                        dinfo = self.db.saveAttachment(self.quote_id(docid),
+                                 self.quote_id(name), info['data'],
+                                 content_type=info['content_type'],
+                                 revision=revision)
+
+                    real_ret.append(dinfo)
+        finally:
+            # A reader may have fetched and cached the old revision while
+            # we were writing - it was fetched after the invalidation above,
+            # so the cache can't tell.  Drop it again now the write is done.
+            self._invalidate_cached(docs)
+            self._release_blobs(blob_ids)
         if errors:
             raise DocumentSaveError(errors)
         return real_ret
 
+    def _invalidate_deps(self, docs):
+        # The items we just wrote may depend on docs we hold results for.
+        index = self.dep_index
+        if index is not None:
+            dep_ids = []
+            for doc in docs:
+                for si in doc.get('rd_schema_items', {}).itervalues():
+                    dep_ids.extend(self.get_doc_id_for_dep(dep)
+                                   for dep in si.get('rd_deps') or ())
+            if dep_ids:
+                index.invalidate(dep_ids)
+
+    def _invalidate_cached(self, docs):
+        # We don't wait for the _changes feed to tell us about our own writes.
+        # Called both before and after writing.
+        cache = self.doc_cache
+        if cache is not None:
+            for doc in docs:
+                cache.invalidate(doc['_id'])
+
+    def _gen_bulk_chunks(self, docs):
+        # Split the docs into chunks for _bulk_docs, so no single request has
+        # more than MAX_BULK_ATTACH_SIZE bytes of inline attachments.  A doc
+        # which exceeds the limit by itself still gets a request of its own.
+        chunk = []
+        chunk_size = 0
+        for doc in docs:
+            size = 0
+            for a in doc.get('_attachments', {}).itervalues():
+                size += len(a.get('data', ''))
+            if chunk and chunk_size + size > self.MAX_BULK_ATTACH_SIZE:
+                yield chunk
+                chunk = []
+                chunk_size = 0
+            chunk.append(doc)
+            chunk_size += size
+        if chunk:
+            yield chunk
+
     # Some functions for working/splitting documents and schemas.
     def _aggregate_doc(self, doc):
         sitems = doc['rd_schema_items']
@@ -330,6 +831,10 @@ class DocumentModel(object):
         for name in doc.get('_attachments', {}):
             if name.startswith(ext_id+'/'):
                 doc['_attachments'][name]['_deleted'] = True
+        blobs = doc.get('rd_blobs', {})
+        for name in blobs.keys():
+            if name.startswith(ext_id+'/'):
+                del blobs[name]
 
         # The item itself may or may not have an '_id' - but if it does it
         # must be the same as the doc itself.
@@ -406,7 +911,14 @@ class DocumentModel(object):
         # and the attachments.
         for attachname, data in (item.get('attachments') or {}).iteritems():
             new_name = ext_id + "/" + attachname
+            if 'remote' in data:
+                doc.setdefault('rd_blobs', {})[new_name] = \
+                                            self._make_remote_blob_ref(data)
+                doc.get('_attachments', {}).pop(new_name, None)
+                continue
             doc.setdefault('_attachments', {})[new_name] = data
+            # any existing reference to a blob is replaced.
+            doc.get('rd_blobs', {}).pop(new_name, None)
         # meta-data stored in the doc itself.
         for mname, opt in (('rd_key', False),
                            ('rd_schema_id', False),
@@ -459,11 +971,13 @@ class DocumentModel(object):
         # map them based on the ID
         doc_map = {}
         orig_doc_map = {}
+        orig_blobs = {} # the blobs referenced before we change anything.
         for did, doc in zip(ids, docs):
             if doc is None:
                 doc = {}
             doc_map[did] = doc
             orig_doc_map[did] = doc.copy()
+            orig_blobs[did] = set(self._get_blob_ids(doc))
             if '_id' in doc:
                 assert doc['_id']==did, doc
             else:
@@ -497,6 +1011,15 @@ class DocumentModel(object):
         # schema items, we may have detected duplicates and removed them...
         if to_up:
             updated_docs = self.update_documents(to_up)
+            # blobs the old items referenced but the new ones don't may now
+            # be unreferenced.
+            old_blobs = set()
+            for doc in to_up:
+                old_blobs.update(orig_blobs[doc['_id']])
+                if '_deleted' not in doc:
+                    old_blobs.difference_update(self._get_blob_ids(doc))
+            if old_blobs:
+                self._delete_unreferenced_blobs(old_blobs)
         else:
             updated_docs = []
         logger.debug("create_schema_items made %r", updated_docs)
@@ -511,6 +1034,110 @@ class DocumentModel(object):
             raise DocumentSaveError(exc_info)
         return updated_docs
 
+    def start_write_buffer(self, max_latency=None, max_batch=None):
+        """Start buffering items passed to queue_schema_items so items from
+        many threads can be written together."""
+        assert self.write_buffer is None, "write buffer already started"
+        self.write_buffer = WriteBehindBuffer(self, max_latency, max_batch)
+        self.write_buffer.start()
+
+    def stop_write_buffer(self):
+        buf = self.write_buffer
+        if buf is not None:
+            self.write_buffer = None
+            buf.stop()
+            logger.debug("write-behind buffer wrote %d items in %d writes",
+                         buf.num_items, buf.num_writes)
+
+    def start_doc_cache(self, schemas=None, max_bytes=None):
+        """Start caching documents opened via open_documents_by_id.  The
+        caller must pass every change to doc_cache.invalidate() while the
+        cache is running.  If schemas is not None, only changes to docs
+        with those schemas will be seen, so only those are cached."""
+        assert self.doc_cache is None, "doc cache already started"
+        self.doc_cache = DocumentCache(max_bytes, schemas)
+
+    def stop_doc_cache(self):
+        cache = self.doc_cache
+        if cache is not None:
+            self.doc_cache = None
+            logger.debug("document cache had %d hits and %d misses",
+                         cache.hits, cache.misses)
+
+    def start_dep_index(self, max_age=None):
+        """Start memoizing the lookups made by get_dependent_sources."""
+        assert self.dep_index is None, "dependency index already started"
+        self.dep_index = DependencyIndex(self, max_age=max_age)
+
+    def stop_dep_index(self):
+        index = self.dep_index
+        if index is not None:
+            self.dep_index = None
+            logger.debug("dependency index had %d hits and %d misses",
+                         index.hits, index.misses)
+
+    def get_dependent_sources(self, doc_ids):
+        """Returns a dict of doc_id -> list of doc IDs, being the 'source' of
+        each schema item which declared it depends on that doc."""
+        index = self.dep_index
+        if index is not None:
+            return index.lookup(doc_ids)
+        return self._open_dependent_sources(doc_ids)
+
+    def _open_dependent_sources(self, doc_ids):
+        # The view is keyed by the [rd_key, schema_id] named in rd_deps, so
+        # decode each ID back into that.
+        result = {}
+        keys = []
+        by_dep = {} # hashable dep -> [doc_id, ...]
+        for doc_id in doc_ids:
+            if doc_id in result:
+                continue
+            result[doc_id] = []
+            try:
+                _, rd_key, schema_id = self.split_doc_id(doc_id)
+            except ValueError:
+                # not a raindrop document - nothing can depend on it.
+                continue
+            key = [rd_key, schema_id]
+            hkey = self.hashable_key(key)
+            if hkey not in by_dep:
+                keys.append(key)
+            by_dep.setdefault(hkey, []).append(doc_id)
+        if keys:
+            rows = self.open_view(viewId='source_by_dep', keys=keys)['rows']
+            for row in rows:
+                for doc_id in by_dep.get(self.hashable_key(row['key']), ()):
+                    result[doc_id].append(row['value'])
+        return result
+
+    def queue_schema_items(self, item_defs):
+        """Like create_schema_items, but the items may not be written until
+        later.  Returns a PendingWrite which must be passed to
+        flush_schema_items to see the outcome.  If the write buffer isn't
+        running the items are written immediately."""
+        assert item_defs, "don't call me when you have no docs!"
+        buf = self.write_buffer
+        if buf is None:
+            pending = PendingWrite(item_defs)
+            _write_pending(self, [pending])
+            return pending
+        return buf.queue_items(item_defs)
+
+    def flush_schema_items(self, pendings):
+        """Ensure the items for all the PendingWrite objects have been
+        written.  Raises a DocumentSaveError holding the errors for all
+        of the documents which couldn't be saved."""
+        buf = self.write_buffer
+        if buf is None:
+            errors = []
+            for pending in pendings:
+                errors.extend(pending.wait())
+        else:
+            errors = buf.flush(pendings)
+        if errors:
+            raise DocumentSaveError(errors)
+
     def open_schemas(self, wanted, **kw):
         dids = []
         for (rd_key, schema_id) in wanted:
@@ -520,12 +1147,14 @@ class DocumentModel(object):
 
     def _prepare_attachments(self, docs):
         # called internally when creating a batch of documents. Returns a list
-        # of attachments which should be saved separately.
+        # of attachments which should be saved separately, and the IDs of the
+        # blobs the docs reference, which the caller must pass to
+        # _release_blobs once the docs are written.
 
-        # The intent is that later we can optimize this - if the attachment
-        # is small, we can keep it in the document base64 encoded and save
-        # a http connection.  For now though we just do all attachments
-        # separately.
+        # Attachments are kept in the document base64 encoded so they are
+        # saved in the same _bulk_docs request (and the same revision) as
+        # the document itself - only documents with huge attachments have
+        # them saved separately.
 
         # attachment processing still need more thought - ultimately we need
         # to be able to 'push' them via a generator or similar to avoid
@@ -533,6 +1162,7 @@ class DocumentModel(object):
         # document knowing if the attachment failed (or vice-versa) given we
         # have no transactional semantics.
         all_attachments = []
+        blobs = {} # blobs which need to exist before the docs are saved.
         for doc in docs:
             assert '_id' in doc, doc
             try:
@@ -546,14 +1176,23 @@ class DocumentModel(object):
                 for name, a in this_attach.items():
                     if a.get('stub'):
                         del this_attach[name]
+                if self.dedupe_attachments:
+                    self._move_attachments_to_blobs(doc, blobs)
 
             if not this_attach:
                 all_attachments.append(None)
             else:
                 total_bytes = 0
                 for a in this_attach.values():
-                    total_bytes += len(a.get('data', []))
-                if total_bytes > self.MAX_INLINE_ATTACH_SIZE:
+                    data = a.get('data', '')
+                    if hasattr(data, 'read'):
+                        # a file-like object to be streamed to the couch -
+                        # never inline these.
+                        total_bytes = None
+                        break
+                    total_bytes += len(data)
+                if total_bytes is None or \
+                   total_bytes > self.MAX_INLINE_ATTACH_SIZE:
                     # nuke non-deleted attachments specified
                     split_attachments = {}
                     for name, a in this_attach.items():
@@ -575,7 +1214,170 @@ class DocumentModel(object):
                             assert '_deleted' in a, a
                     all_attachments.append(None)
         assert len(all_attachments)==len(docs)
-        return all_attachments
+        if blobs:
+            try:
+                self._save_blobs(blobs, hold=True)
+            except:
+                self._release_blobs(blobs)
+                raise
+        return all_attachments, list(blobs)
+
+    def _move_attachments_to_blobs(self, doc, blobs):
+        # Replace the large attachments in the doc with references to blob
+        # docs, noting the blobs in the 'blobs' dict.
+        this_attach = doc['_attachments']
+        for name, a in this_attach.items():
+            data = a.get('data')
+            if '_deleted' in a or not isinstance(data, str) or \
+               len(data) < self.MIN_BLOB_SIZE:
+                continue
+            digest = hashlib.sha1(data).hexdigest()
+            blob_id = self.BLOB_ID_PREFIX + digest
+            blobs[blob_id] = a
+            doc.setdefault('rd_blobs', {})[name] = {
+                'blob_id': blob_id,
+                'content_type': a.get('content_type'),
+                'length': len(data),
+                'digest': 'sha1-' + digest,
+            }
+            del this_attach[name]
+        if not this_attach:
+            del doc['_attachments']
+
+    def _make_remote_blob_ref(self, attach):
+        remote = attach['remote']
+        digest = hashlib.sha1(json.dumps(remote, sort_keys=True)).hexdigest()
+        return {'blob_id': self.REMOTE_BLOB_ID_PREFIX + digest,
+                'content_type': attach.get('content_type'),
+                'length': attach.get('length'),
+                'remote': remote,
+        }
+
+    def ensure_remote_attachment(self, info, accounts=None):
+        """Make sure the blob referenced by a 'remote' attachment exists,
+        fetching the data from the account it came from if necessary.
+
+        info is the reference from 'rd_blobs'.  accounts is the account
+        details from the config file, which is read if not specified.
+        """
+        blob_id = info['blob_id']
+        if blob_id in self._known_blobs:
+            return
+        if self.open_documents_by_id([blob_id], include_docs=False)[0] is not None:
+            self._known_blobs.add(blob_id)
+            return
+        remote = info['remote']
+        if accounts is None:
+            accounts = get_config().accounts
+        for details in accounts.itervalues():
+            if details.get('id') == remote['account']:
+                break
+        else:
+            raise KeyError("no account %r for remote attachment %r" %
+                           (remote['account'], blob_id))
+        from raindrop.proto import protocols, init_protocols
+        if not protocols:
+            init_protocols()
+        account = protocols[details['proto']](self, details)
+        logger.info("fetching remote attachment %r from account %r", blob_id,
+                    remote['account'])
+        data = account.fetch_remote_attachment(remote)
+        self._save_blobs({blob_id: {'content_type': info.get('content_type'),
+                                    'data': data}})
+
+    def _save_blobs(self, blobs, hold=False):
+        # Create the blob docs which don't already exist.  Blob docs are
+        # never updated (their content is their ID) - they are deleted by
+        # _delete_unreferenced_blobs once no document refers to them.  If
+        # 'hold' is set the blobs are about to be referenced by a write, so
+        # are protected from deletion until passed to _release_blobs.
+        self._blob_lock.acquire()
+        try:
+            if hold:
+                for bid in blobs:
+                    self._blobs_in_flight[bid] = \
+                        self._blobs_in_flight.get(bid, 0) + 1
+            wanted = [bid for bid in blobs if bid not in self._known_blobs]
+        finally:
+            self._blob_lock.release()
+        if not wanted:
+            return
+        existing = self.open_documents_by_id(wanted, include_docs=False)
+        to_save = []
+        for bid, doc in zip(wanted, existing):
+            if doc is not None:
+                self._known_blobs.add(bid)
+                continue
+            a = blobs[bid]
+            data = base64.encodestring(a['data']).replace('\n', '')
+            to_save.append({'_id': bid,
+                            'rd_blob': True,
+                            '_attachments': {
+                                self.BLOB_ATTACH_NAME: {
+                                    'content_type': a.get('content_type'),
+                                    'data': data,
+                                },
+                            },
+                            })
+        logger.debug("saving %d new blobs (%d already existed)",
+                     len(to_save), len(wanted)-len(to_save))
+        for chunk in self._gen_bulk_chunks(to_save):
+            results = self.db.updateDocuments(chunk)
+            for doc, dinfo in zip(chunk, results):
+                # a conflict means someone else just saved the same blob.
+                if 'error' in dinfo and dinfo['error'] != 'conflict':
+                    raise DocumentSaveError([dinfo])
+                self._known_blobs.add(doc['_id'])
+
+    def _release_blobs(self, blob_ids):
+        self._blob_lock.acquire()
+        try:
+            for bid in blob_ids:
+                count = self._blobs_in_flight[bid] - 1
+                if count:
+                    self._blobs_in_flight[bid] = count
+                else:
+                    del self._blobs_in_flight[bid]
+        finally:
+            self._blob_lock.release()
+
+    @classmethod
+    def _get_blob_ids(cls, doc):
+        return [info['blob_id'] for info in doc.get('rd_blobs', {}).itervalues()]
+
+    def _delete_unreferenced_blobs(self, blob_ids):
+        # Delete the blob docs which no document refers to any more.  A blob
+        # is shared by every document with the same content, so we must ask
+        # the 'doc_by_blob' view rather than just deleting the ones the
+        # caller's docs used to reference.
+        self._blob_lock.acquire()
+        try:
+            wanted = [bid for bid in blob_ids
+                      if bid not in self._blobs_in_flight]
+            if not wanted:
+                return
+            rows = self.open_view(viewId='doc_by_blob', keys=wanted)['rows']
+            used = set(row['key'] for row in rows)
+            unused = [bid for bid in wanted if bid not in used]
+            if not unused:
+                return
+            to_del = []
+            for row in self.db.listDoc(keys=unused)['rows']:
+                if 'error' in row or row['value'].get('deleted'):
+                    continue
+                to_del.append({'_id': row['id'],
+                               '_rev': row['value']['rev'],
+                               '_deleted': True})
+            self._known_blobs.difference_update(unused)
+            logger.debug("deleting %d unreferenced blobs", len(to_del))
+            if to_del:
+                for dinfo in self.db.updateDocuments(to_del):
+                    # a conflict means someone else just changed it - if it
+                    # is still unreferenced, a later delete will catch it.
+                    if 'error' in dinfo and dinfo['error'] != 'conflict':
+                        raise DocumentSaveError([dinfo])
+        finally:
+            self._blob_lock.release()
 
     @classmethod
     def get_schema_attachment_info(cls, doc, attach_base_name):
@@ -585,7 +1387,9 @@ class DocumentModel(object):
         # so for now just check we don't have multiple, warn and pick one if
         # we do.
         doc_id = doc['_id']
-        infos = doc.get('_attachments', {})
+        infos = doc.get('_attachments', {}).copy()
+        # references to 'blob' docs look like attachments to our callers.
+        infos.update(doc.get('rd_blobs', {}))
         found = None
         for name, info in infos.iteritems():
             # don't expect deleted attachments to come back.
@@ -604,6 +1408,19 @@ class DocumentModel(object):
             raise KeyError(attach_base_name)
         return found, infos[found]
 
+    def open_schema_attachment(self, doc, attach_base_name, **kw):
+        # Open an attachment from a schema document, transparently handling
+        # attachments which live in a blob doc.
+        found, info = self.get_schema_attachment_info(doc, attach_base_name)
+        if 'remote' in info:
+            self.ensure_remote_attachment(info)
+        if 'blob_id' in info:
+            doc_id, name = info['blob_id'], self.BLOB_ATTACH_NAME
+        else:
+            doc_id, name = doc['_id'], found
+        logger.debug("attempting to open attachment %s/%s", doc_id, name)
+        return self.db.openDoc(self.quote_id(doc_id), attachment=name, **kw)
+
     def _update_important_views(self):
         # Something else periodically updates our important views.
         if not self._important_views:
@@ -654,7 +1471,9 @@ _doc_model = None
 def get_doc_model():
     global _doc_model
     if _doc_model is None:
-        _doc_model = DocumentModel(get_db())
+        dbinfo = get_config().couches['local']
+        _doc_model = DocumentModel(get_db(),
+                        dedupe_attachments=dbinfo.get('dedupe-attachments'))
     return _doc_model
 
 def fab_db():
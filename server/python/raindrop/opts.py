@@ -74,6 +74,10 @@ def get_program_options():
                  help="Enable debug mode; breaking on exceptions.")
     yield Option("", "--config", action="store",
                  help="Specify an alternate config file (default: ~./raindrop)")
+    yield Option("", "--profile", action="store",
+                 help="Run a sampling profiler over all threads and write "
+                      "the results to the named file in the 'collapsed "
+                      "stack' format used by flamegraph tools.")
 
 
 def get_request_options():
@@ -120,6 +124,40 @@ def get_request_options():
                 help="Maximum age of an item to fetch.  eg, '30 seconds', "
                      "'2weeks'.")
 
+    yield Option("", "--chunk-size", type="int",
+                help="The number of documents processed at once by "
+                     "operations such as 'unprocess' and 'reprocess'.")
+
+    yield Option("", "--parallel", type="int",
+                help="The number of threads used by operations such as "
+                     "'unprocess' and 'reprocess'.")
+
+    yield Option("", "--write-batch", type="int",
+                help="The number of items the work-queues collect before "
+                     "writing them to the couch in a single request.")
+
+    yield Option("", "--write-latency", type="float",
+                help="The maximum number of seconds items generated by the "
+                     "work-queues wait before being written to the couch.")
+
+    yield Option("", "--stats-file",
+                help="The name of a file the 'process' command writes the "
+                     "performance counters of each extension to, as JSON.")
+
+    yield Option("", "--min-batch-size", type="int",
+                help="The smallest number of changes the work-queues will "
+                     "process in one batch as they tune their batch sizes.")
+
+    yield Option("", "--max-batch-size", type="int",
+                help="The largest number of changes the work-queues will "
+                     "process in one batch as they tune their batch sizes.")
+
+    yield Option("", "--processes", type="int",
+                help="The number of worker processes used to run extensions "
+                     "marked with an 'execution' of 'process'.  By default "
+                     "(or if 0) no processes are started and these "
+                     "extensions run in the work-queues' threads.")
+
     yield NumSecondsOption("", "--repeat-after", type="int",
                 help="Time to wait after completion before repeating the sync")
 
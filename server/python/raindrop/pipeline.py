@@ -24,15 +24,24 @@
 """ This is the raindrop pipeline; it moves messages from their most raw
 form to their most useful form.
 """
+from __future__ import with_statement
+
 import sys
 import time
 import itertools
 import threading
+from multiprocessing.pool import ThreadPool
+try:
+    import resource
+except ImportError: # not on windows...
+    resource = None
 
 from raindrop.model import DocumentSaveError
-from raindrop.changesiter import ChangesIterFactory
+from raindrop.changesiter import SharedChangesReader
 
 import extenv
+import extproc
+import profiler
 
 import logging
 
@@ -52,6 +61,13 @@ class Extension(object):
 
     ALL_CATEGORIES = (SMART, PROVIDER, EXTENDER)
 
+    # How the handler is executed - the default is in the work-queue's
+    # thread, but CPU-bound extensions may ask to be run in a worker process
+    # when raindrop is run with --processes (see extproc.py)
+    THREAD = "thread"
+    PROCESS = "process"
+    ALL_EXECUTIONS = (THREAD, PROCESS)
+
     def __init__(self, id, doc, globs):
         self.id = id
         self.doc = doc
@@ -63,13 +79,21 @@ class Extension(object):
             self.source_schemas = [doc['source_schema']]
         self.confidence = doc.get('confidence')
         self.globs = globs
-        self.running = False # for reentrancy testing...
         # the category - for now we have a default, but later should not!
         self.category = doc.get('category', self.PROVIDER)
         self.uses_dependencies = doc.get('uses_dependencies', False)
+        # How many documents the extension may process at once.  Extensions
+        # which query the couch (and so may need to see what the previous
+        # document wrote) are run one at a time once they do.
+        self.concurrency = doc.get('concurrency', 1)
         if self.category not in self.ALL_CATEGORIES:
             logger.error("extension %r has invalid category %r (must be one of %s)",
                          id, self.category, self.ALL_CATEGORIES)
+        self.execution = doc.get('execution', self.THREAD)
+        if self.execution not in self.ALL_EXECUTIONS:
+            logger.error("extension %r has invalid execution %r (must be one of %s)",
+                         id, self.execution, self.ALL_EXECUTIONS)
+            self.execution = self.THREAD
 
         self.handler = globs.get('handler')
         self.later_handler = globs.get('later_handler')
@@ -82,6 +106,105 @@ class Extension(object):
             # a default filter which checks the schema id is one we want.
             self.filter = lambda src_id, src_rev, schema_id: schema_id in self.source_schemas
 
+def get_thread_cpu_time():
+    """Returns the CPU time used by the current thread in seconds, or None
+    if the platform can't tell us."""
+    # RUSAGE_THREAD is linux only, and the resource module doesn't know
+    # about it before python 3.2.
+    if resource is None or not sys.platform.startswith('linux'):
+        return None
+    usage = resource.getrusage(getattr(resource, 'RUSAGE_THREAD', 1))
+    return usage.ru_utime + usage.ru_stime
+
+
+class ExtensionStats(object):
+    """Performance counters for a single extension.
+
+    The counters are:
+    * seen: documents the extension was offered.
+    * filtered: documents the extension's filter rejected.
+    * up_to_date: documents the extension had already processed.
+    * skipped: documents which changed, were deleted or have no provider.
+    * processed: documents the handler was called for.
+    * items: schema items emitted.
+    * errors: documents the handler failed to process.
+    * open_view, open_schemas, open_attachment: couch calls made by the
+      extension.
+    * attachment_bytes: bytes of attachments the extension read.
+
+    Handler times are kept in histograms with buckets keyed by the upper
+    bound of each bucket in milliseconds, each bucket twice the previous.
+    """
+    COUNTERS = ('seen', 'filtered', 'up_to_date', 'skipped', 'processed',
+                'items', 'errors', 'open_view', 'open_schemas',
+                'open_attachment', 'attachment_bytes')
+    HISTOGRAMS = ('wall_ms', 'cpu_ms')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = dict((name, 0) for name in self.COUNTERS)
+        self.histograms = dict((name, {}) for name in self.HISTOGRAMS)
+
+    def incr(self, name, num=1):
+        with self._lock:
+            self.counters[name] += num
+
+    def note_time(self, name, secs):
+        bucket = 1
+        while bucket < secs * 1000:
+            bucket *= 2
+        # a string so it survives a trip through json.
+        bucket = str(bucket)
+        with self._lock:
+            hist = self.histograms[name]
+            hist[bucket] = hist.get(bucket, 0) + 1
+
+    def merge(self, info):
+        """Add the stats from a dict returned by as_dict"""
+        with self._lock:
+            for name, val in info.get('counters', {}).iteritems():
+                self.counters[name] = self.counters.get(name, 0) + val
+            for name, buckets in info.get('histograms', {}).iteritems():
+                hist = self.histograms.setdefault(name, {})
+                for bucket, num in buckets.iteritems():
+                    hist[bucket] = hist.get(bucket, 0) + num
+
+    def as_dict(self):
+        with self._lock:
+            return {'counters': self.counters.copy(),
+                    'histograms': dict((name, hist.copy()) for name, hist
+                                       in self.histograms.iteritems())}
+
+
+def make_extension(doc):
+    """Compile the code in a rd.ext.workqueue document, returning an
+    Extension object, or None if the extension is broken."""
+    ext_id = doc['rd_key'][1]
+    # some platforms get upset about \r\n, none get upset with \n.
+    src = doc['code'].replace("\r\n", "\n")
+    ct = doc.get('content_type')
+    if ct != "application/x-python":
+        logger.error("Content-type of %r is not supported", ct)
+        return None
+    try:
+        co = compile(src, "<%s>" % ext_id, "exec")
+    except SyntaxError, exc:
+        logger.error("Failed to compile %r: %s", ext_id, exc)
+        return None
+    globs = {}
+    try:
+        exec co in globs
+    except Exception, exc:
+        logger.error("Failed to initialize extension %r: %s", ext_id, exc)
+        return None
+    ext = Extension(ext_id, doc, globs)
+    if ext.handler is None or not callable(ext.handler):
+        logger.error("source-code in extension %r doesn't have a 'handler' function",
+                     ext_id)
+        return None
+    extenv.install_ext_env(ext)
+    return ext
+
 def load_extensions(doc_model):
     extensions = {}
     # now try the DB - load everything with a rd.ext.workqueue schema
@@ -89,44 +212,268 @@ def load_extensions(doc_model):
     ret = doc_model.open_view(key=key, reduce=False, include_docs=True)
     assert ret['rows'], "no extensions!"
     for row in ret['rows']:
-        doc = row['doc']
-        ext_id = doc['rd_key'][1]
-        # some platforms get upset about \r\n, none get upset with \n.
-        src = doc['code'].replace("\r\n", "\n")
-        ct = doc.get('content_type')
-        if ct != "application/x-python":
-            logger.error("Content-type of %r is not supported", ct)
+        ext = make_extension(row['doc'])
+        if ext is None:
             continue
+        assert ext.id not in extensions, ext.id # another with this ID??
+        extensions[ext.id] = ext
+    return extensions
+
+
+def get_extension_graph(exts, emitted_schemas):
+    """Returns a dict keyed by extension ID, with each value being the set of
+    extension IDs 'upstream' of it - ie, those which emit a schema it
+    consumes.
+
+    exts is a sequence of Extension objects, while emitted_schemas is a dict
+    keyed by extension ID with the schemas that extension has been seen to
+    emit.  Extensions which see all schemas (eg, those with a filter function
+    or which use dependencies) have no upstream extensions, and enough edges
+    are dropped to break any cycles, so the graph is always a DAG.
+    """
+    emitters = {}
+    for ext_id, schemas in emitted_schemas.iteritems():
+        for schema_id in schemas:
+            emitters.setdefault(schema_id, set()).add(ext_id)
+    graph = {}
+    for ext in exts:
+        upstream = set()
+        if ext.source_schemas is not None and not ext.uses_dependencies:
+            for schema_id in ext.source_schemas:
+                upstream.update(emitters.get(schema_id, ()))
+        upstream.discard(ext.id)
+        graph[ext.id] = upstream
+
+    def reaches(start, target):
+        seen = set()
+        todo = [start]
+        while todo:
+            this = todo.pop()
+            if this == target:
+                return True
+            if this not in seen:
+                seen.add(this)
+                todo.extend(graph.get(this, ()))
+        return False
+
+    for ext_id, upstream in graph.iteritems():
+        for up_id in list(upstream):
+            if reaches(up_id, ext_id):
+                logger.debug("extensions %r and %r depend on each other",
+                             up_id, ext_id)
+                upstream.discard(up_id)
+    return graph
+
+
+def get_extension_waves(graph):
+    """Given a graph as returned by get_extension_graph, returns a list of
+    sets of extension IDs; the extensions in each set depend only on those
+    in earlier sets.
+    """
+    waves = []
+    todo = set(graph)
+    while todo:
+        wave = set(ext_id for ext_id in todo
+                   if not (graph[ext_id] & todo))
+        assert wave, "extension graph has a cycle"
+        waves.append(wave)
+        todo -= wave
+    return waves
+
+
+def run_parallel(funcs, max_threads):
+    """Call each of the functions using up to max_threads threads, returning
+    a list of their results.  If any fail, the first exception is re-raised
+    once all are done."""
+    funcs = list(funcs)
+    if max_threads <= 1 or len(funcs) <= 1:
+        return [f() for f in funcs]
+    results = [None] * len(funcs)
+    errors = []
+    todo = list(enumerate(funcs))
+    lock = threading.Lock()
+    tag = profiler.get_thread_tag()
+    def worker():
+        # samples from this thread are for whatever our caller is doing.
+        profiler.set_thread_tag(tag)
         try:
-            co = compile(src, "<%s>" % ext_id, "exec")
-        except SyntaxError, exc:
-            logger.error("Failed to compile %r: %s", ext_id, exc)
-            continue
-        globs = {}
+            while True:
+                with lock:
+                    if not todo or errors:
+                        return
+                    i, f = todo.pop(0)
+                try:
+                    results[i] = f()
+                except Exception:
+                    with lock:
+                        errors.append(sys.exc_info())
+        finally:
+            profiler.clear_thread_tag()
+    threads = [threading.Thread(target=worker)
+               for i in range(min(max_threads, len(funcs)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if errors:
+        raise errors[0][0], errors[0][1], errors[0][2]
+    return results
+
+
+class BulkJob(object):
+    """Runs a function over every row of a (potentially huge) view in
+    chunks.  Progress is checkpointed in a 'rd.core.job-state' document
+    after each chunk, so if a job is interrupted, running it again with the
+    same view args resumes where it left off.
+    """
+    SCHEMA_ID = 'rd.core.job-state'
+    PROGRESS_INTERVAL = 30 # seconds between progress messages.
+
+    def __init__(self, doc_model, job_id, view_args, chunk_size,
+                 rows_vanish=False):
+        # rows_vanish means the job removes the rows it processes from the
+        # view (ie, it deletes them.)
+        self.doc_model = doc_model
+        self.job_id = job_id
+        self.view_args = view_args
+        self.chunk_size = chunk_size
+        self.rows_vanish = rows_vanish
+        self.state = None
+
+    def _load_state(self):
+        si = {'rd_key': ['job', self.job_id],
+              'rd_schema_id': self.SCHEMA_ID,
+              'rd_ext_id': 'rd.core',
+              'rd_source': None,
+              'items': {'view_args': self.view_args,
+                        'key': None,
+                        'docid': None,
+                        'num_done': 0,
+                        'finished': False,
+                        },
+             }
+        doc = self.doc_model.open_schemas([(si['rd_key'], self.SCHEMA_ID)])[0]
+        if doc is not None:
+            si['_id'] = doc['_id']
+            si['_rev'] = doc['_rev']
+            if not doc.get('finished') and doc.get('view_args') == self.view_args:
+                for name in ('key', 'docid', 'num_done'):
+                    si['items'][name] = doc.get(name)
+        self.state = si
+
+    def _save_state(self):
+        docs = self.doc_model.create_schema_items([self.state])
+        # nothing is returned if the state is unchanged (eg, a job over an
+        # empty view which already finished) - the _rev is still current.
+        if docs:
+            self.state['_rev'] = docs[0]['rev']
+
+    def _count_rows(self):
+        # the megaview uses a '_count' reduce.
+        args = self.view_args.copy()
+        args.pop('reduce', None)
+        args.pop('include_docs', None)
+        if 'keys' in args:
+            args['group'] = True
         try:
-            exec co in globs
-        except Exception, exc:
-            logger.error("Failed to initialize extension %r: %s", ext_id, exc)
-            continue
-        assert ext_id not in extensions, ext_id # another with this ID??
-        ext = Extension(ext_id, doc, globs)
-        if ext.handler is None or not callable(ext.handler):
-            logger.error("source-code in extension %r doesn't have a 'handler' function",
-                         ext_id)
-            continue
-        extensions[ext_id] = ext
-    return extensions
+            result = self.doc_model.open_view(**args)
+        except self.doc_model.db.Error, exc:
+            logger.info("can't count the rows for job %r: %s", self.job_id, exc)
+            return None
+        return sum(row['value'] for row in result['rows'])
+
+    def _iter_rows(self):
+        items = self.state['items']
+        last_key, last_docid = items['key'], items['docid']
+        args = self.view_args.copy()
+        dm = self.doc_model
+        if last_docid is not None:
+            # resume just after the last row we processed.
+            if 'keys' in args:
+                keys = args.pop('keys')
+                index = keys.index(last_key)
+                range_args = args.copy()
+                range_args['startkey'] = range_args['endkey'] = last_key
+                range_args['startkey_docid'] = last_docid
+                for row in dm.iter_view(**range_args):
+                    if row['key'] != last_key or row['id'] != last_docid:
+                        yield row
+                args['keys'] = keys[index+1:]
+                if not args['keys']:
+                    return
+            else:
+                if 'key' in args:
+                    args['startkey'] = args['endkey'] = args.pop('key')
+                args['startkey'] = last_key
+                args['startkey_docid'] = last_docid
+        for row in dm.iter_view(**args):
+            if row['key'] == last_key and row['id'] == last_docid:
+                continue
+            yield row
+
+    def _gen_chunks(self):
+        chunk = []
+        for row in self._iter_rows():
+            chunk.append(row)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def run(self, chunk_func):
+        """Calls chunk_func with each chunk of rows.  Returns the number of
+        rows processed."""
+        self._load_state()
+        items = self.state['items']
+        total = self._count_rows()
+        if items['num_done']:
+            logger.info("resuming job %r after %d rows", self.job_id,
+                        items['num_done'])
+            if total is not None and not self.rows_vanish:
+                total = max(total - items['num_done'], 0)
+        num = 0
+        start = last_log = time.time()
+        for chunk in self._gen_chunks():
+            chunk_func(chunk)
+            num += len(chunk)
+            items['num_done'] += len(chunk)
+            items['key'] = chunk[-1]['key']
+            items['docid'] = chunk[-1]['id']
+            self._save_state()
+            now = time.time()
+            if now - last_log > self.PROGRESS_INTERVAL:
+                last_log = now
+                rate = num / (now - start)
+                if total:
+                    remaining = max(total - num, 0) / (rate or 1)
+                    logger.info("%s: %d of %d rows (%d%%) - %d rows/sec, "
+                                "about %d:%02d remaining", self.job_id, num,
+                                total, num * 100 / max(total, num), rate,
+                                remaining / 60, remaining % 60)
+                else:
+                    logger.info("%s: %d rows - %d rows/sec", self.job_id,
+                                num, rate)
+        items['finished'] = True
+        self._save_state()
+        logger.info("%s: finished - %d rows in %d seconds", self.job_id,
+                    num, time.time() - start)
+        return num
 
 
 class Pipeline(object):
     """A manager for running items through the pipeline using various
     different strategies.
     """
+    # The number of view rows unprocess/reprocess handle at once.
+    JOB_CHUNK_SIZE = 1000 # pulled from a hat!
     def __init__(self, doc_model, options):
         self.doc_model = doc_model
         self.options = options
         self.runner = None
         self._additional_processors = {}
+        # the queue runners of the current (or last) 'process'.
+        self.queue_runners = None
 
     def initialize(self):
         pass
@@ -183,6 +530,7 @@ class Pipeline(object):
     def start_processing(self, cont_stable_callback):
         assert self.runner is None, "already doing a process"
         pqrs = self.get_queue_runners()
+        self.queue_runners = pqrs
 
         self.runner = StatefulQueueManager(self.doc_model, pqrs,
                                            self.options)
@@ -196,38 +544,76 @@ class Pipeline(object):
         # as it is what is doing the items created by the queue
         return nerr
 
+    def get_stats(self):
+        """Returns the performance counters of each extension for the
+        current (or last) 'process', as a dict keyed by queue ID."""
+        ret = {}
+        for qr in self.queue_runners or []:
+            stats = getattr(qr.processor, 'stats', None)
+            if stats is not None:
+                ret[qr.queue_id] = stats.as_dict()
+        return ret
+
+    def _make_job(self, job_id, view_args, rows_vanish=False):
+        chunk_size = self.options.chunk_size or self.JOB_CHUNK_SIZE
+        return BulkJob(self.doc_model, job_id, view_args, chunk_size,
+                       rows_vanish)
+
+    def _delete_items(self, to_up):
+        # Delete a batch of schema items.  The revs may be stale if an
+        # earlier batch removed another extension's items from the same
+        # doc - so conflicts are retried once with the current revs.
+        dm = self.doc_model
+        try:
+            dm.create_schema_items(to_up)
+        except DocumentSaveError, exc:
+            conflicts = set(info['id'] for info in exc.infos
+                            if info.get('error') == 'conflict')
+            if len(conflicts) != len(exc.infos):
+                raise
+            retry = [si for si in to_up if si['_id'] in conflicts]
+            docs = dm.open_documents_by_id([si['_id'] for si in retry])
+            to_retry = []
+            for si, doc in zip(retry, docs):
+                if doc is not None and \
+                   si['rd_ext_id'] in doc.get('rd_schema_items', {}):
+                    si['_rev'] = doc['_rev']
+                    to_retry.append(si)
+            if to_retry:
+                dm.create_schema_items(to_retry)
+
     def unprocess(self):
         # Just nuke all items that have a 'rd_source' specified...
-        # XXX - should do this in a loop with a limit to avoid chewing
-        # all mem...
+        # This is done as a BulkJob so we never need all the rows in memory
+        # and can resume if interrupted.
         if self.options.exts:
             runners = self.get_queue_runners()
             keys = [['ext_id', r.queue_id] for r in runners]
-            result = self.doc_model.open_view(keys=keys, reduce=False)
-            to_up = [{'_id': row['id'],
-                      '_rev': row['value']['_rev'],
-                      'rd_key': row['value']['rd_key'],
-                      'rd_schema_id': row['value']['rd_schema_id'],
-                      'rd_ext_id': row['key'][-1],
-                      '_deleted': True
-                      } for row in result['rows']]
+            view_args = {'keys': keys, 'reduce': False}
         else:
-            result = self.doc_model.open_view(
-                                # skip NULL rows.
-                                startkey=['source', ""],
-                                endkey=['source', {}],
-                                reduce=False)
-
-            to_up = [{'_id': row['id'],
+            view_args = {# skip NULL rows.
+                         'startkey': ['source', ""],
+                         'endkey': ['source', {}],
+                         'reduce': False}
+        parallel = self.options.parallel or 1
+        def delete_chunk(rows):
+            # All items in the same doc must be deleted by the same thread.
+            batches = [[] for i in range(parallel)]
+            for row in rows:
+                si = {'_id': row['id'],
                       '_rev': row['value']['_rev'],
                       'rd_key': row['value']['rd_key'],
                       'rd_schema_id': row['value']['rd_schema_id'],
                       'rd_ext_id': row['value']['rd_ext_id'],
                       '_deleted': True
-                      } for row in result['rows']]
-        logger.info('deleting %d schemas', len(to_up))
-        if to_up:
-            self.doc_model.create_schema_items(to_up)
+                      }
+                batches[hash(row['id']) % parallel].append(si)
+            run_parallel([lambda b=b: self._delete_items(b)
+                          for b in batches if b], parallel)
+
+        job = self._make_job('unprocess', view_args, rows_vanish=True)
+        num = job.run(delete_chunk)
+        logger.info('deleted %d schemas', num)
 
         # and rebuild our views
         logger.info("rebuilding all views...")
@@ -241,6 +627,19 @@ class Pipeline(object):
         num = sum(results)
         logger.info("reprocess made %d new docs", num)
 
+    def _reprocess_rows(self, runners, rows):
+        # Each runner handles the rows in a different thread - we can't
+        # have a single extension running in more than one.
+        def make_func(runner):
+            def func():
+                items = ((row['id'], row['value']['_rev'], None, None)
+                         for row in rows)
+                return runner.process_queue(items)
+            return func
+        results = run_parallel([make_func(r) for r in runners],
+                               self.options.parallel or 1)
+        return sum(results)
+
     def reprocess(self):
         # We can't just reset all work-queues as there will be a race
         # (ie, one queue will be deleting a doc while it is being
@@ -250,21 +649,21 @@ class Pipeline(object):
         # first wave of extensions to re-run, which will trigger the next
         # etc.
         # However, if extensions are named, only those are reprocessed
-        dm = self.doc_model
-        def gen_em(this_result):
-            to_proc = ((row['id'], row['value']['_rev'])
-                       for row in this_result['rows'])
-            for id, rev in to_proc:
-                yield id, rev, None, None
+        # This is done as a BulkJob so we never need all the rows in memory
+        # and can resume if interrupted.
+        self.options.force = True # evil!
+        def do_job(job_id, view_args):
+            runners = self.get_queue_runners()
+            num_created = [0]
+            def chunk_func(rows):
+                num_created[0] += self._reprocess_rows(runners, rows)
+            self._make_job(job_id, view_args).run(chunk_func)
+            logger.info("reprocess made %d new docs", num_created[0])
 
         if not self.options.exts and not self.options.keys:
-            # fetch all items with a null 'rd_source'
-            result = dm.open_view(
-                            key=['source', None],
-                            reduce=False)
-            logger.info("reprocess found %d source documents",
-                        len(result['rows']))
-            self._reprocess_items(gen_em, result)
+            # process all items with a null 'rd_source'
+            logger.info("reprocessing all source documents")
+            do_job('reprocess', {'key': ['source', None], 'reduce': False})
         else:
             # do each specified extension one at a time to avoid the races
             # if extensions depend on each other...
@@ -279,11 +678,9 @@ class Pipeline(object):
                 else:
                     # all rd_keys...
                     keys=[['schema_id', sch_id] for sch_id in qr.processor.ext.source_schemas]
-                result = dm.open_view(keys=keys,
-                                            reduce=False)
-                logger.info("reprocessing %s - %d docs", qr.queue_id,
-                            len(result['rows']))
-                self._reprocess_items(gen_em, result)
+                logger.info("reprocessing %s", qr.queue_id)
+                do_job('reprocess!' + qr.queue_id,
+                       {'keys': keys, 'reduce': False})
 
 
     def start_retry_errors(self):
@@ -297,18 +694,129 @@ class Pipeline(object):
         # also ran against the source of the error - that can be fixed, but
         # later...
         key = ["schema_id", "rd.core.error"]
-        result = self.doc_model.open_view(key=key, reduce=False,
-                                          include_docs=True)
-        logger.info("found %d error records", len(result['rows']))
         def gen_em():
-            for row in result['rows']:
+            rows = self.doc_model.iter_view(key=key, reduce=False,
+                                            include_docs=True)
+            num = 0
+            for row in rows:
+                num += 1
                 for ext_info in row['doc']['rd_schema_items'].itervalues():
                     src_id, src_rev = ext_info['rd_source']
                     yield src_id, src_rev, None, None
+            logger.info("retried %d error records", num)
 
         self._reprocess_items(gen_em)
 
 
+class BatchController(object):
+    """Tunes the sizes used by a work-queue as it runs.
+
+    The 'batch size' is the number of changes a queue reads per batch - the
+    queue's state is checkpointed between batches, so we aim for batches
+    which take around TARGET_BATCH_TIME seconds of work, however fast or
+    slow the extension and the couch are.  The 'flush size' is the number of
+    items collected before they are handed to the doc model for writing;
+    it shrinks when the items conflict and grows when writing is slow.
+    """
+    INITIAL_BATCH = 2000
+    MIN_BATCH = 50
+    MAX_BATCH = 50000
+    INITIAL_FLUSH = 20
+    MIN_FLUSH = 1
+    MAX_FLUSH = 500 # the write-behind buffer's default batch size.
+    TARGET_BATCH_TIME = 5.0 # pulled from a hat!
+    # conflicts in more than this fraction of items shrinks the flush size.
+    MAX_CONFLICT_RATE = 0.05
+    # writes taking more than this fraction of the work grows it.
+    MAX_WRITE_FRACTION = 0.2
+
+    def __init__(self, min_batch=None, max_batch=None):
+        if min_batch is not None:
+            self.MIN_BATCH = min_batch
+        if max_batch is not None:
+            self.MAX_BATCH = max_batch
+        self.batch_size = self._clamp(self.INITIAL_BATCH, self.MIN_BATCH,
+                                      self.MAX_BATCH)
+        self.flush_size = self.INITIAL_FLUSH
+        # the reason for the last change to the sizes, and whether it has
+        # been reported.
+        self.last_decision = None
+        self.reported = True
+        self._reset()
+
+    def _clamp(self, val, low, high):
+        return max(low, min(high, int(val)))
+
+    def _reset(self):
+        self.num_changes = 0
+        self.num_items = 0
+        self.num_conflicts = 0
+        self.read_time = 0.0
+        self.ext_time = 0.0
+        self.write_time = 0.0
+
+    def note_changes(self, num):
+        self.num_changes += num
+
+    def note_items(self, num):
+        self.num_items += num
+
+    def note_conflicts(self, num):
+        self.num_conflicts += num
+
+    def note_read(self, secs):
+        self.read_time += secs
+
+    def note_ext(self, secs):
+        self.ext_time += secs
+
+    def note_write(self, secs):
+        self.write_time += secs
+
+    def end_batch(self):
+        """Adjust the sizes based on what we were told about the batch."""
+        work = self.read_time + self.ext_time + self.write_time
+        reasons = []
+        # A batch which didn't fill tells us nothing about how big it
+        # could be - we simply ran out of changes.
+        if self.num_changes >= self.batch_size / 2 and work > 0:
+            wanted = self.num_changes * self.TARGET_BATCH_TIME / work
+            # don't over-react to a single odd batch.
+            wanted = min(max(wanted, self.batch_size / 2), self.batch_size * 2)
+            new = self._clamp(wanted, self.MIN_BATCH, self.MAX_BATCH)
+            # ignore small wobbles.
+            if abs(new - self.batch_size) > self.batch_size / 4:
+                reasons.append("batch %d->%d (%.1fs of work for %d changes)" %
+                               (self.batch_size, new, work, self.num_changes))
+                self.batch_size = new
+
+        new = self.flush_size
+        if self.num_items:
+            conflict_rate = float(self.num_conflicts) / self.num_items
+            if conflict_rate > self.MAX_CONFLICT_RATE:
+                new = self._clamp(self.flush_size / 2, self.MIN_FLUSH,
+                                  self.MAX_FLUSH)
+                why = "%d%% of items conflicted" % (conflict_rate * 100)
+            elif work > 0 and \
+                 self.write_time / work > self.MAX_WRITE_FRACTION:
+                new = self._clamp(self.flush_size + self.flush_size / 4 + 1,
+                                  self.MIN_FLUSH, self.MAX_FLUSH)
+                why = "writes took %d%% of the time" % \
+                      (self.write_time * 100 / work)
+        if new != self.flush_size:
+            reasons.append("flush %d->%d (%s)" % (self.flush_size, new, why))
+            self.flush_size = new
+
+        if reasons:
+            self.last_decision = ", ".join(reasons)
+            self.reported = False
+        self._reset()
+
+    def describe(self):
+        return "batch size %d, flush size %d" % (self.batch_size,
+                                                 self.flush_size)
+
+
 # Used by the 'process' operation - runs all of the 'stateful work queues';
 # Each is run continuously and independenly of the others - but once all
 # queues report they are blocked on waiting for new changes at the same
@@ -319,18 +827,32 @@ class QueueState:
     def __init__(self):
         self.schema_item = None
         self.last_saved_seq = 0
+        # the sequence at the end of the last batch we processed.
+        self.done_seq = 0
         self.failure = None
         self.running = False
+        self.controller = None
+        # the extension stats from previous runs.
+        self.saved_stats = {}
 
 
 class StatefulQueueManager(object):
+    STATUS_INTERVAL = 10 # seconds between status messages.
+
     def __init__(self, dm, q_runners, options):
         assert q_runners, "nothing to do?"
         self.doc_model = dm
         self.queues = q_runners
         self.queue_states = None # a list, parallel with self.queues.
         self.options = options
+        self.changes_reader = None
         self.status_msg_last = None
+        # queue_id -> set of queue IDs upstream of it.
+        self.graph = {}
+        # Signalled when a queue blocks waiting for changes or stops, so we
+        # can check if all queues are done.
+        self._wake_cond = threading.Condition()
+        self._woken = False
 
     def _q_status(self):
         current_end = self.doc_model.db.infoDB()['update_seq']
@@ -355,9 +877,29 @@ class StatefulQueueManager(object):
                   (lowest[1], lowest[0], behind)
         if nfailed:
             msg += " - %d queues have failed" % nfailed
+        nskipped = self.changes_reader.num_superseded
+        if nskipped:
+            msg += " - %d superseded changes skipped" % nskipped
+        cache = self.doc_model.doc_cache
+        if cache is not None:
+            lookups = cache.hits + cache.misses
+            msg += " - doc cache hit %d of %d lookups (%d docs, %dKB)" % \
+                   (cache.hits, lookups, len(cache),
+                    cache.num_bytes/1024)
         if self.status_msg_last != msg:
             logger.info(msg)
             self.status_msg_last = msg
+        # and any changes the queues have made to their batch sizes.
+        for qlook, qstate in zip(self.queues, self.queue_states):
+            controller = qstate.controller
+            if not controller.reported:
+                logger.info("queue %r now using %s: %s", qlook.queue_id,
+                            controller.describe(), controller.last_decision)
+                controller.reported = True
+        logger.debug("couch connection pool: %(connections)d connections "
+                     "(%(idle)d idle), %(opened)d opened, %(reused)d reused, "
+                     "%(waited)d waited, %(errored)d errored",
+                     self.doc_model.db.pool.get_stats())
 
     def _load_queue_state(self, qr):
         # first open our 'state' schema
@@ -387,21 +929,41 @@ class StatefulQueueManager(object):
             doc = rows[0]['doc']
             state_info['_id'] = doc['_id']
             state_info['_rev'] = doc['_rev']
-            state_info['items'] = {'seq' : doc.get('seq', 0)}
+            state_info['items'] = {'seq' : doc.get('seq', 0),
+                                   'emitted_schemas': doc.get('emitted_schemas', [])}
         else:
-            state_info['items'] = {'seq': 0}
+            state_info['items'] = {'seq': 0, 'emitted_schemas': []}
         ret = QueueState()
+        ret.controller = BatchController(self.options.min_batch_size,
+                                         self.options.max_batch_size)
         ret.schema_item = state_info
-        ret.last_saved_seq = state_info['items']['seq']
+        if len(rows) and 'doc' in rows[0]:
+            ret.saved_stats = rows[0]['doc'].get('stats', {})
+        ret.last_saved_seq = ret.done_seq = state_info['items']['seq']
+        qr.emitted_schemas.update(state_info['items']['emitted_schemas'])
         return ret
 
-    def _save_queue_state(self, state, current_seq, num_created):
+    def _save_queue_state(self, state, current_seq, num_created,
+                          emitted_schemas=(), stats=None):
         assert current_seq is not None
         si = state.schema_item
         seq = si['items']['seq'] = current_seq
-        # We can chew 1000 'nothing to do' docs quickly next time...
+        if stats is not None:
+            # the stats for all runs, not just this one.
+            all_stats = ExtensionStats()
+            all_stats.merge(state.saved_stats)
+            all_stats.merge(stats.as_dict())
+            si['items']['stats'] = all_stats.as_dict()
+        # remember what the queue emits so we can build the extension graph
+        # before it runs next time.
+        emitted = sorted(emitted_schemas)
+        if emitted != si['items']['emitted_schemas']:
+            si['items']['emitted_schemas'] = emitted
+            num_created = num_created or len(emitted)
+        # We can chew through a batch of 'nothing to do' docs quickly next
+        # time...
         last_saved = state.last_saved_seq
-        if num_created or (seq-last_saved) > 1000:
+        if num_created or (seq-last_saved) > state.controller.batch_size:
             logger.debug("flushing state doc at end of run...")
             docs = self.doc_model.create_schema_items([si])
             assert len(docs)==1, docs # only asked to save 1
@@ -410,30 +972,88 @@ class StatefulQueueManager(object):
         else:
             logger.debug("no need to flush state doc")
 
-    def _run_queue(self, q, qstate, batch_size=2000):
+    def _run_queue(self, q, qstate):
         logger.debug("initializing queue %r at sequence %s", q.queue_id, qstate.feed.current_seq)
         qstate.running = True
         qstate.failure = None
+        controller = qstate.controller
         while qstate.running:
-            batchiter = qstate.feed.make_iter(batch_size)
+            batchiter = qstate.feed.make_iter(controller.batch_size)
             logger.debug("starting batch for queue %r at sequence %s", q.queue_id, qstate.feed.current_seq)
-            num_created = q.process_queue(batchiter)
+            num_created = q.process_queue(batchiter, controller)
             logger.debug("Work queue %r finished batch at sequence %s",
                          q.queue_id, qstate.feed.current_seq)
-            self._save_queue_state(qstate, qstate.feed.current_seq, 0)
+            controller.end_batch()
+            self._save_queue_state(qstate, qstate.feed.current_seq, 0,
+                                   q.emitted_schemas,
+                                   getattr(q.processor, 'stats', None))
+            # Everything this batch created has now been written, so the
+            # queues downstream of us may process up to here.
+            qstate.done_seq = qstate.feed.current_seq
+            self.changes_reader.notify_progress()
+
+    def _get_filter_schemas(self, q):
+        # The schemas a queue needs to see changes for, or None if it needs
+        # to see all changes.
+        ext = q.processor.ext
+        if ext.uses_dependencies:
+            # a change to any schema may be a dependency.
+            return None
+        return getattr(ext, 'source_schemas', None)
+
+    def _update_graph(self):
+        # (re)build the graph of queues from the schemas they consume and
+        # the schemas they have been seen to emit.
+        exts = [q.processor.ext for q in self.queues]
+        emitted = dict((q.queue_id, frozenset(q.emitted_schemas))
+                       for q in self.queues)
+        graph = get_extension_graph(exts, emitted)
+        if graph != self.graph:
+            self.graph = graph
+            for wave in get_extension_waves(graph):
+                logger.debug("extension wave: %s", ", ".join(sorted(wave)))
+            self.changes_reader.notify_progress()
+
+    def _make_limit_func(self, q):
+        # Returns a function giving the highest sequence the queue may read -
+        # a queue doesn't see a change until every queue upstream of it has
+        # processed it, so it doesn't see a document before the upstream
+        # queues have added their schemas to it.
+        qstates = dict((qlook.queue_id, qstate) for qlook, qstate in
+                       zip(self.queues, self.queue_states))
+        def get_limit():
+            seqs = [qstates[up_id].done_seq
+                    for up_id in self.graph.get(q.queue_id, ())
+                    if up_id in qstates and qstates[up_id].failure is None]
+            if not seqs:
+                return None
+            return min(seqs)
+        return get_limit
+
+    def _wake(self):
+        with self._wake_cond:
+            self._woken = True
+            self._wake_cond.notify()
 
     def _worker_thread(self, q, qs):
+        profiler.set_thread_tag('queue:%s' % (q.queue_id,))
         try:
             self._run_queue(q, qs)
         except Exception, exc:
             logger.exception('queue %r failed', q.queue_id)
             qs.failure = exc
+        q.close()
         qs.running = False
+        profiler.clear_thread_tag()
+        # the queues downstream of us can stop waiting for us.
+        self.changes_reader.notify_progress()
+        self._wake()
 
     def _stop_all(self):
         for qs in self.queue_states:
             qs.feed.stop()
             qs.running = False
+        self.changes_reader.stop()
 
     def run(self, stable_callback):
         dm = self.doc_model
@@ -443,12 +1063,35 @@ class StatefulQueueManager(object):
         for q in self.queues:
             qs = self._load_queue_state(q)
             self.queue_states.append(qs)
-            qs.feed = ChangesIterFactory()
-            start_seq = qs.schema_item['items']['seq']
+
+        # All queues share a single _changes connection; it starts at the
+        # most recent queue and any queues behind that catch up separately.
+        # The shared connection only asks for the schemas at least one queue
+        # wants, unless any queue wants everything.
+        start_seqs = [qs.schema_item['items']['seq'] for qs in self.queue_states]
+        all_schemas = set()
+        for q in self.queues:
+            schemas = self._get_filter_schemas(q)
+            if schemas is None:
+                all_schemas = None
+                break
+            all_schemas.update(schemas)
+        if all_schemas is not None:
+            all_schemas = sorted(all_schemas)
+        # Extensions with an 'execution' of 'process' use the extension
+        # process pool if run-raindrop started one.
+        self.changes_reader = SharedChangesReader()
+        self.changes_reader.on_wait = self._wake
+        self.changes_reader.initialize(dm, max(start_seqs), all_schemas)
+        for q, qs, start_seq in zip(self.queues, self.queue_states, start_seqs):
             # There is quite a performance penalty involved in getting the
             # dependencies for extensions which don't need them...
             include_deps = q.processor.ext.uses_dependencies
-            qs.feed.initialize(self.doc_model, start_seq, include_deps=include_deps)
+            qs.feed = self.changes_reader.make_cursor(start_seq,
+                                include_deps=include_deps,
+                                filter_schemas=self._get_filter_schemas(q),
+                                limit_func=self._make_limit_func(q))
+        self._update_graph()
 
         last_status_tick = time.time()
 
@@ -458,8 +1101,20 @@ class StatefulQueueManager(object):
         old_check_interval = sys.getcheckinterval()
         sys.setcheckinterval(5000)
 
+        # All the queues write via a shared buffer so their items can be
+        # combined into larger batches.
+        dm.start_write_buffer(self.options.write_latency,
+                              self.options.write_batch)
+        # The doc model can cache the docs the extensions open, as the
+        # shared reader tells it about any changes to them.
+        dm.start_doc_cache(all_schemas)
+        # and remember which docs depend on the docs the queues see.
+        dm.start_dep_index()
+
         workers = []
         for q, qs in zip(self.queues, self.queue_states):
+            # so we don't think we are done before the thread gets going.
+            qs.running = True
             t = threading.Thread(target=self._worker_thread,
                                  args=(q, qs))
             t.setDaemon(True) # incase one gets truly stuck...
@@ -469,11 +1124,18 @@ class StatefulQueueManager(object):
         finished = False
         try:
             while not finished:
-                # wake up once per second to check status etc.
-                time.sleep(1)
-                if time.time()-10 > last_status_tick:
+                # Sleep until a queue blocks or stops, or it is time to
+                # report our status.
+                timeout = last_status_tick + self.STATUS_INTERVAL - time.time()
+                with self._wake_cond:
+                    if not self._woken and timeout > 0:
+                        self._wake_cond.wait(timeout)
+                    self._woken = False
+                if time.time()-self.STATUS_INTERVAL > last_status_tick:
                     self._q_status()
                     last_status_tick = time.time()
+                # queues may have emitted schemas we didn't know about.
+                self._update_graph()
 
                 # See if each of the changes feeds are blocked at the same
                 # sequence number.
@@ -485,8 +1147,10 @@ class StatefulQueueManager(object):
                         all_seqs.add(qs.feed.current_seq)
                 else:
                     # didn't break, so all are blocked somewhere.  Check all
-                    # at the same point.
-                    all_at_end = len(all_seqs)==1
+                    # at the same point, and that the reader hasn't got
+                    # changes it is yet to hand them.
+                    all_at_end = len(all_seqs)==1 and \
+                        min(all_seqs) >= self.changes_reader.get_last_seq()
                     if all_at_end:
                         end_seq = all_seqs.pop()
                         logger.debug('all queues are paused at seq %s', end_seq)
@@ -502,6 +1166,9 @@ class StatefulQueueManager(object):
                 w.join(10)
                 if w.isAlive():
                     logger.warn("failed to wait for worker thread to complete")
+            dm.stop_write_buffer()
+            dm.stop_doc_cache()
+            dm.stop_dep_index()
             sys.setcheckinterval(old_check_interval)
 
         # update the views now...
@@ -513,14 +1180,133 @@ class ProcessingQueueRunner(object):
     of couch documents and run any of the extension objects which process the
     documents.
     """
+    # How many elements of a batch we look ahead over so the processor can
+    # fetch the documents it needs in bulk.
+    PREFETCH_SIZE = 200 # pulled from a hat!
+
     def __init__(self, doc_model, processor, queue_id):
         self.doc_model = doc_model
         self.processor = processor
         self.queue_id = queue_id
-
-    def process_queue(self, src_gen):
+        # the schemas we have seen the processor emit.
+        self.emitted_schemas = set()
+        # The threads used when the processor allows concurrency, and
+        # whether this run stopped using them as the processor queried the
+        # couch.
+        self._thread_pool = None
+        self._serial = False
+
+    def close(self):
+        if self._thread_pool is not None:
+            self._thread_pool.close()
+            self._thread_pool.join()
+            self._thread_pool = None
+
+    def _gen_prefetch_chunks(self, src_gen):
+        # Reads the src_gen in chunks of PREFETCH_SIZE.  The schema_id of
+        # each element is filled in if the source didn't provide it; elements
+        # which aren't raindrop documents get a schema_id of None.
+        split_doc_id = self.doc_model.split_doc_id
+        chunk = []
+        for src_id, src_rev, schema_id, seq in src_gen:
+            if schema_id is None:
+                try:
+                    _, _, schema_id = split_doc_id(src_id, decode_key=False)
+                except ValueError, why:
+                    logger.log(1, 'skipping document %r: %s', src_id, why)
+            chunk.append((src_id, src_rev, schema_id, seq))
+            if len(chunk) >= self.PREFETCH_SIZE:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def _call_processor(self, src_id, src_rev, schema_id, pf,
+                        before_query=None):
+        # Returns (got, must_save, later_info)
+        kw = {}
+        if pf is not None:
+            kw['prefetched'] = pf
+        if before_query is not None:
+            kw['before_query'] = before_query
+        try:
+            got, must_save = self.processor(src_id, src_rev, schema_id, **kw)
+        except extenv.ProcessLaterException, exc:
+            return None, None, exc
+        return got, must_save, None
+
+    def _gen_results(self, calls):
+        # Call the processor for each (src_id, src_rev, schema_id, prefetched)
+        # in calls, yielding (call, result) in the same order.  If the
+        # processor allows, up to 'concurrency' calls are made at once -
+        # but never for the same document, as a later call must see what an
+        # earlier one wrote.
+        # A call which queries the couch must see what the calls before it
+        # wrote, so before its first query it waits until our caller has
+        # handled (and, as must_save is then set, written) the results of
+        # all of them.  No more calls are made at once for the rest of the
+        # run once one has queried.
+        concurrency = getattr(self.processor, 'concurrency', 1)
+        if concurrency <= 1 or self._serial:
+            for call in calls:
+                yield call, self._call_processor(*call)
+            return
+
+        if self._thread_pool is None:
+            tag = profiler.get_thread_tag()
+            self._thread_pool = ThreadPool(concurrency,
+                                           profiler.set_thread_tag, (tag,))
+        cond = threading.Condition()
+        state = {'handled': 0} # how many calls our caller has handled.
+
+        def call_processor(arg):
+            index, call = arg
+            def before_query():
+                self._serial = True
+                with cond:
+                    while state['handled'] < index:
+                        cond.wait()
+            return self._call_processor(*call, before_query=before_query)
+
+        index = 0
+        try:
+            while calls and not self._serial:
+                seen = set()
+                for i, call in enumerate(calls):
+                    if call[0] in seen:
+                        break
+                    seen.add(call[0])
+                else:
+                    i = len(calls)
+                these, calls = calls[:i], calls[i:]
+                results = self._thread_pool.imap(call_processor,
+                                                 enumerate(these, index))
+                for call, result in itertools.izip(these, results):
+                    yield call, result
+                    with cond:
+                        state['handled'] += 1
+                        cond.notifyAll()
+                index += len(these)
+        finally:
+            # don't leave any calls waiting if our caller gave up on us.
+            with cond:
+                state['handled'] = sys.maxint
+                cond.notifyAll()
+        if calls:
+            logger.info("queue %r queried the couch - processing its "
+                        "documents one at a time", self.queue_id)
+        for call in calls:
+            yield call, self._call_processor(*call)
+
+    def process_queue(self, src_gen, controller=None):
         """processes a number of items in a work-queue.
+
+        If a BatchController is passed, it decides how many items are
+        collected before writing them, and is told how the batch went.
         """
+        if controller is None:
+            controller = BatchController()
+        self._serial = False
         doc_model = self.doc_model
         num_created = 0
         processor = self.processor
@@ -538,50 +1324,88 @@ class ProcessingQueueRunner(object):
         # writing' - but performance really sucks without it...
         conflicts = []
         conflict_sources = {} # key is src_id, value is created doc id.
+        # The items we have handed to the doc model's write-behind buffer
+        # but which may not yet have been written.
+        writes = []
         # process until we run out.
         last_seq = None
-        for src_id, src_rev, schema_id, seq in src_gen:
-            if seq is not None: # 'dependency' rows have no seq...
-                last_seq = seq
-            if schema_id is None:
-                try:
-                    _, _, schema_id = doc_model.split_doc_id(src_id, decode_key=False)
-                except ValueError, why:
-                    logger.log(1, 'skipping document %r: %s', src_id, why)
+        schema_id = None
+        # Not all processors know how to prefetch (eg, the outgoing ones)
+        prefetch = getattr(processor, 'prefetch', None)
+        for chunk in self._gen_prefetch_chunks(src_gen):
+            # Ask the processor to fetch everything it needs for the entire
+            # chunk up-front, rather than 2 requests per source document.
+            controller.note_changes(len(chunk))
+            start = time.time()
+            if prefetch is None:
+                prefetched = {}
+            else:
+                prefetched = prefetch(chunk)
+            now = time.time()
+            controller.note_read(now - start)
+            start = now
+            write_time = 0
+            calls = []
+            for src_id, src_rev, schema_id, seq in chunk:
+                if seq is not None: # 'dependency' rows have no seq...
+                    last_seq = seq
+                if schema_id is None:
+                    # not a raindrop document - but still note its sequence.
+                    continue
+                # The same doc may appear twice in one chunk; only the first
+                # gets the prefetched info - later ones must go back to the
+                # couch so they see what the first one wrote.
+                pf = prefetched.pop(src_id, None)
+                calls.append((src_id, src_rev, schema_id, pf))
+            for call, (got, must_save, later) in self._gen_results(calls):
+                src_id, src_rev, schema_id, _ = call
+                if later is not None:
+                    # This extension has been asked to be called later at the
+                    # end of the batch - presumably to save doing duplicate work.
+                    logger.debug("queue %r asked for document %r/%s to be processed later (state=%r)",
+                                 queue_id, src_id, src_rev, later.value)
+                    pending.append(later.value)
                     continue
 
-            try:
-                got, must_save = processor(src_id, src_rev, schema_id)
-            except extenv.ProcessLaterException, exc:
-                # This extension has been asked to be called later at the
-                # end of the batch - presumably to save doing duplicate work.
-                logger.debug("queue %r asked for document %r/%s to be processed later (state=%r)",
-                             queue_id, src_id, src_rev, exc.value)
-                pending.append(exc.value)
-                continue
-
-            if not got:
-                continue
-            num_created += len(got)
-            # note which src caused an item to be generated, incase we
-            # conflict as we write them (see above - our 'buffering' makes
-            # this necessary...)
-            for si in got:
-                doc_model.check_schema_item(si)
-                did = doc_model.get_doc_id_for_schema_item(si)
-                conflict_sources[did] = (src_id, src_rev)
-            items.extend(got)
-            if must_save or len(items)>20:
-                try:
-                    doc_model.create_schema_items(items)
-                except DocumentSaveError, exc:
-                    conflicts.extend(exc.infos)
-                items = []
+                if not got:
+                    continue
+                num_created += len(got)
+                # note which src caused an item to be generated, incase we
+                # conflict as we write them (see above - our 'buffering' makes
+                # this necessary...)
+                for si in got:
+                    doc_model.check_schema_item(si)
+                    did = doc_model.get_doc_id_for_schema_item(si)
+                    conflict_sources[did] = (src_id, src_rev)
+                    self.emitted_schemas.add(si['rd_schema_id'])
+                items.extend(got)
+                if must_save or len(items) > controller.flush_size:
+                    writes.append(doc_model.queue_schema_items(items))
+                    items = []
+                if must_save:
+                    # The extension queried the couch, so the next document
+                    # must be able to see what this one wrote.
+                    flush_start = time.time()
+                    try:
+                        doc_model.flush_schema_items(writes)
+                    except DocumentSaveError, exc:
+                        conflicts.extend(exc.infos)
+                    writes = []
+                    write_time += time.time() - flush_start
+            controller.note_write(write_time)
+            controller.note_ext(time.time() - start - write_time)
         if items:
-            try:
-                doc_model.create_schema_items(items)
-            except DocumentSaveError, exc:
-                conflicts.extend(exc.infos)
+            writes.append(doc_model.queue_schema_items(items))
+        # Our caller saves the queue state when we return, so everything
+        # we generated must have hit the couch first.
+        flush_start = time.time()
+        try:
+            doc_model.flush_schema_items(writes)
+        except DocumentSaveError, exc:
+            conflicts.extend(exc.infos)
+        controller.note_write(time.time() - flush_start)
+        controller.note_items(num_created)
+        controller.note_conflicts(len(conflicts))
 
         # retry conflicts 3 times (yet another magic number)
         for i in range(3):
@@ -631,27 +1455,36 @@ class ProcessingQueueRunner(object):
 class ExtensionProcessor(object):
     """A class which manages the execution of a single extension over
     documents holding raindrop schemas"""
+    # Attachments on the source doc up to this size are sent to the process
+    # pool along with the doc; bigger ones are fetched by the worker.
+    MAX_SHIPPED_ATTACH_SIZE = 4000000 # pulled from a hat!
+
     def __init__(self, doc_model, ext, options):
         self.doc_model = doc_model
         self.ext = ext
         self.options = options
         self.num_errors = 0
+        self.stats = ExtensionStats()
+        # thread execution only - the process pool has its own concurrency.
+        if ext.execution == ext.PROCESS:
+            self.concurrency = 1
+        else:
+            self.concurrency = ext.concurrency
+        # Set once the extension has queried the couch while running in the
+        # process pool; from then on each document must see what the ones
+        # before it wrote, so none are handed to the pool ahead of time.
+        self.queried = False
 
     def _get_ext_env(self, context, src_doc):
-        # Each ext has a single 'globals' which is updated before it is run;
-        # therefore it is critical we don't accidently run the same extension
-        # more than once concurrently
-        if self.ext.running:
-            raise RuntimeError, "%r is already running" % self.ext.id
-        self.ext.running = True
+        # The extension's globals find the environment for the current
+        # thread, so many threads may run the same extension at once.
         new_globs = extenv.get_ext_env(self.doc_model, context, src_doc,
                                        self.ext)
-        self.ext.globs.update(new_globs)
+        extenv.set_ext_env(self.ext, new_globs)
         return self.ext.handler
 
     def _release_ext_env(self):
-        assert self.ext.running
-        self.ext.running = False
+        extenv.clear_ext_env(self.ext)
 
     def _merge_new_with_previous(self, new_items, docs_previous):
         # check the new items created against the 'source' documents created
@@ -689,12 +1522,96 @@ class ExtensionProcessor(object):
             self._release_ext_env()
         return new_items
 
-    def __call__(self, src_id, src_rev, schema_id):
-        """The "real" entry-point to this processor"""
+    def prefetch(self, elts):
+        """Fetch everything needed to process a number of source documents.
+
+        elts is a sequence of (src_id, src_rev, schema_id, seq) tuples.
+        Returns a dict keyed by src_id, with each value suitable for passing
+        as the 'prefetched' arg when calling this processor.  Only 2 couch
+        requests are made regardless of the number of elements.
+
+        If the extension runs in the process pool (and has never queried the
+        couch), the documents which need processing are handed to the pool
+        now, so they are processed in parallel while our caller works
+        through the chunk.
+        """
         ext = self.ext
-        if not ext.filter(src_id, src_rev, schema_id):
-            return [], False
+        src_ids = []
+        src_revs = {}
+        for src_id, src_rev, schema_id, _ in elts:
+            if schema_id is None or src_id in src_revs or \
+               not ext.filter(src_id, src_rev, schema_id):
+                continue
+            src_revs[src_id] = src_rev
+            src_ids.append(src_id)
+        if not src_ids:
+            return {}
 
+        dm = self.doc_model
+        prev_rows = dict((src_id, []) for src_id in src_ids)
+        if ext.category in [ext.PROVIDER, ext.EXTENDER]:
+            keys = [['ext_id-source', [ext.id, src_id]] for src_id in src_ids]
+            result = dm.open_view(keys=keys, reduce=False)
+            for row in result['rows']:
+                prev_rows[row['key'][1][1]].append(row)
+        src_docs = dm.open_documents_by_id(src_ids)
+        in_process = self._use_process_pool() and not self.queried
+        ret = {}
+        for src_id, src_doc in zip(src_ids, src_docs):
+            rows = prev_rows[src_id]
+            job = None
+            if in_process and \
+               self._get_previous(src_id, src_revs[src_id], rows) is not None and \
+               self._check_src_doc(src_id, src_revs[src_id], src_doc):
+                job = self._start_job(src_doc)
+            ret[src_id] = (rows, src_doc, job)
+        return ret
+
+    def _use_process_pool(self):
+        return self.ext.execution == self.ext.PROCESS and \
+               extproc.get_pool() is not None
+
+    def _start_job(self, src_doc):
+        # Hand a source document to the process pool.
+        dm = self.doc_model
+        attachments = {}
+        infos = src_doc.get('_attachments', {}).copy()
+        infos.update(src_doc.get('rd_blobs', {}))
+        for name, info in infos.iteritems():
+            try:
+                _, aname = name.split("/", 1)
+            except ValueError:
+                continue
+            # leave the really big ones, and those still on a remote server,
+            # for the worker to fetch itself.
+            if 'remote' not in info and \
+               info.get('length', 0) <= self.MAX_SHIPPED_ATTACH_SIZE:
+                attachments[aname] = dm.open_schema_attachment(src_doc, aname)
+        args = (self.ext.doc, src_doc, attachments)
+        return extproc.get_pool().apply_async(extproc.run_handler, args)
+
+    def _run_job(self, job, context):
+        # Wait for a job in the process pool and merge its results into the
+        # context, raising whatever exception the extension raised.
+        status, value, did_query, stats = job.get()
+        self.stats.merge(stats)
+        if did_query:
+            context['did_query'] = True
+            if not self.queried:
+                logger.info("extension %r queried the couch - processing "
+                            "its documents one at a time", self.ext.id)
+                self.queried = True
+        if status == 'later':
+            raise extenv.ProcessLaterException(value)
+        if status == 'error':
+            raise extproc.RemoteExtensionError(value)
+        context['new_items'].extend(value)
+
+    def _get_previous(self, src_id, src_rev, rows):
+        # Returns a dict of the items previously written by this extension for
+        # the source doc, or None if the doc doesn't need to be processed.
+        # If rows is None, the items are looked up.
+        ext = self.ext
         dm = self.doc_model
         ext_id = ext.id
         force = self.options.force
@@ -707,14 +1624,15 @@ class ExtensionProcessor(object):
             # the extension says it can take care of everything related to
             # re-running.  Such extensions are unlikely to be able to be
             # correctly overridden, but that is life.
-            pass
+            return docs_previous
         elif ext.category in [ext.PROVIDER, ext.EXTENDER]:
             is_provider = ext.category!=ext.EXTENDER
             # We need to find *all* items previously written by this extension
             # so we can manage updating/removal of the old items.
-            key = ['ext_id-source', [ext_id, src_id]]
-            result = dm.open_view(key=key, reduce=False)
-            rows = result['rows']
+            if rows is None:
+                key = ['ext_id-source', [ext_id, src_id]]
+                result = dm.open_view(key=key, reduce=False)
+                rows = result['rows']
             if rows:
                 if ext.uses_dependencies:
                     # we can't just check the source doc - assume the worst.
@@ -737,7 +1655,7 @@ class ExtensionProcessor(object):
                             # must be an extender, which is OK (see above)
                             logger.debug("skipping document %r - it depends on itself",
                                          src_id)
-                            return (None, None)
+                            return None
 
                         if prev_src != [src_id, src_rev]:
                             dirty = True
@@ -753,7 +1671,7 @@ class ExtensionProcessor(object):
                 dirty = True
             if not dirty and not force:
                 logger.debug("document %r is up-to-date", src_id)
-                return (None, None)
+                return None
 
             for row in rows:
                 v = row['value']
@@ -764,9 +1682,11 @@ class ExtensionProcessor(object):
         else:
             raise RuntimeError("don't know what to do with category of extension %r: %r" %
                                (ext_id, ext.category))
+        return docs_previous
 
-        # Get the source-doc and process it.
-        src_doc = dm.open_documents_by_id([src_id])[0]
+    def _check_src_doc(self, src_id, src_rev, src_doc):
+        # Returns True if the source doc should be processed.
+        ext = self.ext
         # Although we got this doc id directly from the _all_docs_by_seq view,
         # it is quite possible that the doc was deleted since we read that
         # view.  It could even have been updated - so if its not the exact
@@ -774,11 +1694,11 @@ class ExtensionProcessor(object):
         if src_doc is None:
             logger.debug("skipping document %r - it's been deleted since we read the queue",
                          src_id)
-            return (None, None)
+            return False
         elif src_rev != None and src_doc['_rev'] != src_rev:
             logger.debug("skipping document %(_id)r - it's changed since we read the queue",
                          src_doc)
-            return (None, None)
+            return False
 
         # our caller should have filtered the list to only the schemas
         # our extensions cares about.
@@ -791,20 +1711,73 @@ class ExtensionProcessor(object):
         if not src_doc.get('rd_schema_provider'):
             logger.debug("skipping document %(_id)r - it has yet to see a schema provider",
                          src_doc)
+            return False
+        return True
+
+    def __call__(self, src_id, src_rev, schema_id, prefetched=None,
+                 before_query=None):
+        """The "real" entry-point to this processor.
+
+        If before_query is given, it is called before each query the
+        extension makes of the couch."""
+        ext = self.ext
+        stats = self.stats
+        stats.incr('seen')
+        if not ext.filter(src_id, src_rev, schema_id):
+            stats.incr('filtered')
+            return [], False
+
+        ext_id = ext.id
+        if prefetched is None:
+            rows = src_doc = job = None
+        else:
+            rows, src_doc, job = prefetched
+
+        docs_previous = self._get_previous(src_id, src_rev, rows)
+        if docs_previous is None:
+            stats.incr('up_to_date')
+            return (None, None)
+
+        # Get the source-doc (if we didn't already) and process it.
+        if prefetched is None:
+            src_doc = self.doc_model.open_documents_by_id([src_id])[0]
+        if not self._check_src_doc(src_id, src_rev, src_doc):
+            stats.incr('skipped')
             return (None, None)
 
         # Now process it
         new_items = []
         context = {'new_items': new_items}
+        if before_query is not None:
+            context['before_query'] = before_query
         logger.debug("calling %r with doc %r, rev %s", ext_id,
                      src_doc['_id'], src_doc['_rev'])
 
+        stats.incr('processed')
         try:
-            func = self._get_ext_env(context, src_doc)
-            try:
-                result = func(src_doc)
-            finally:
-                self._release_ext_env()
+            if self._use_process_pool():
+                if job is not None and self.queried:
+                    # It was started before we knew the extension queries,
+                    # so can't have seen what the documents before it
+                    # wrote - leave it be and start again.
+                    job = None
+                if job is None:
+                    job = self._start_job(src_doc)
+                result = self._run_job(job, context)
+            else:
+                # the worker process times the handler itself.
+                context['stats'] = stats
+                start = time.time()
+                start_cpu = get_thread_cpu_time()
+                func = self._get_ext_env(context, src_doc)
+                try:
+                    result = func(src_doc)
+                finally:
+                    self._release_ext_env()
+                    stats.note_time('wall_ms', time.time() - start)
+                    if start_cpu is not None:
+                        stats.note_time('cpu_ms',
+                                        get_thread_cpu_time() - start_cpu)
         except extenv.ProcessLaterException, exc:
             assert not new_items, "extensions can't do now and later!"
             # we still need to delete the older ones created last time.
@@ -830,6 +1803,7 @@ class ExtensionProcessor(object):
         # did, then it will probably query next time, and will probably
         # expect to see what it wrote last time
         must_save = 'did_query' in context
+        stats.incr('items', len(new_items))
         logger.debug("extension %r generated %d new schemas (must_save=%s)",
                      ext_id, len(new_items), must_save)
         if not must_save:
@@ -852,6 +1826,7 @@ class ExtensionProcessor(object):
         logger.warn("Extension %r failed to process document %r",
                     self.ext.id, src_doc['_id'], exc_info=exc_info)
         self.num_errors += 1
+        self.stats.incr('errors')
         if self.options.stop_on_error:
             logger.info("--stop-on-error specified - stopping queue")
             # Throw away any records emitted by *this* failure.
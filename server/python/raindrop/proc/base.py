@@ -169,6 +169,13 @@ class AccountBase(Rat):
     """
     raise NotImplementedError
 
+  def fetch_remote_attachment(self, remote):
+    """Return the data of an attachment which was left on the server when
+    its message was synched.  'remote' is the location the protocol noted
+    in the attachment's placeholder.
+    """
+    raise NotImplementedError
+
   def can_send_from(self, identity):
     """Return True if we can send messages from the specified identity.  Any
     identity may be passed, not just ones returned by get_identities
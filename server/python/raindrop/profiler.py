@@ -0,0 +1,151 @@
+# ***** BEGIN LICENSE BLOCK *****
+# Version: MPL 1.1
+#
+# The contents of this file are subject to the Mozilla Public License Version
+# 1.1 (the "License"); you may not use this file except in compliance with
+# the License. You may obtain a copy of the License at
+# http://www.mozilla.org/MPL/
+#
+# Software distributed under the License is distributed on an "AS IS" basis,
+# WITHOUT WARRANTY OF ANY KIND, either express or implied. See the License
+# for the specific language governing rights and limitations under the
+# License.
+#
+# The Original Code is Raindrop.
+#
+# The Initial Developer of the Original Code is
+# Mozilla Messaging, Inc..
+# Portions created by the Initial Developer are Copyright (C) 2009
+# the Initial Developer. All Rights Reserved.
+#
+# Contributor(s):
+#
+
+# A low-overhead sampling profiler for the whole process.  A background
+# thread periodically grabs the current stack of every other thread, so
+# unlike cProfile it sees all our worker threads and doesn't slow down every
+# function call.  The samples are written in the 'collapsed stack' format
+# used by flamegraph.pl and friends - one line per unique stack, with the
+# frames separated by semi-colons, followed by the number of samples.
+# The first frame of each stack is the 'tag' of the thread - eg, the work
+# queue or account it is working on - so the graph is split up by them.
+import os
+import sys
+import time
+import thread
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# thread ident -> tag.  Maintained even when we aren't profiling, as it is
+# cheap and threads are generally started before the profiler.
+_thread_tags = {}
+
+def set_thread_tag(tag):
+    """Set the tag used for samples taken from the current thread."""
+    _thread_tags[thread.get_ident()] = tag
+
+def get_thread_tag():
+    """Returns the tag of the current thread, or None."""
+    return _thread_tags.get(thread.get_ident())
+
+def clear_thread_tag():
+    _thread_tags.pop(thread.get_ident(), None)
+
+
+class SamplingProfiler(object):
+    INTERVAL = 0.005 # seconds between samples - pulled from a hat!
+    MAX_DEPTH = 100 # frames deeper than this are dropped.
+
+    def __init__(self, interval=None):
+        self.interval = interval or self.INTERVAL
+        # (tag, tuple of code objects) -> number of samples.  The code
+        # objects are only turned into strings when we write the results.
+        self.samples = {}
+        self.num_samples = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        assert self._thread is None, "already started"
+        self._thread = threading.Thread(target=self._sampler_thread)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop_event.set()
+            self._thread.join()
+            self._thread = None
+
+    def _sampler_thread(self):
+        me = thread.get_ident()
+        samples = self.samples
+        while not self._stop_event.isSet():
+            time.sleep(self.interval)
+            for ident, frame in sys._current_frames().iteritems():
+                if ident == me:
+                    continue
+                codes = []
+                while frame is not None and len(codes) < self.MAX_DEPTH:
+                    codes.append(frame.f_code)
+                    frame = frame.f_back
+                codes.reverse()
+                key = _thread_tags.get(ident), tuple(codes)
+                samples[key] = samples.get(key, 0) + 1
+            self.num_samples += 1
+
+    def get_collapsed(self):
+        """Returns a dict of collapsed stack string -> number of samples."""
+        result = {}
+        names = {} # code object -> frame name
+        for (tag, codes), count in self.samples.items():
+            frames = [_escape(tag or 'untagged')]
+            for code in codes:
+                try:
+                    name = names[code]
+                except KeyError:
+                    name = names[code] = _escape("%s (%s:%d)" % (
+                                    code.co_name,
+                                    os.path.basename(code.co_filename),
+                                    code.co_firstlineno))
+                frames.append(name)
+            stack = ";".join(frames)
+            result[stack] = result.get(stack, 0) + count
+        return result
+
+    def write(self, filename):
+        collapsed = self.get_collapsed()
+        f = open(filename, "w")
+        try:
+            for stack in sorted(collapsed):
+                f.write("%s %d\n" % (stack, collapsed[stack]))
+        finally:
+            f.close()
+        logger.info("wrote %d profile samples (%d unique stacks) to %r",
+                    self.num_samples, len(collapsed), filename)
+
+
+def _escape(name):
+    # the format has no quoting, so we just avoid the special chars.
+    return str(name).replace(";", ":").replace("\n", " ")
+
+
+_profiler = None
+
+def start_profiling(interval=None):
+    global _profiler
+    assert _profiler is None, "already profiling"
+    _profiler = SamplingProfiler(interval)
+    _profiler.start()
+    logger.info("started sampling profiler")
+
+def stop_profiling(filename):
+    """Stop the profiler started by start_profiling and write its results."""
+    global _profiler
+    if _profiler is not None:
+        _profiler.stop()
+        _profiler.write(filename)
+        _profiler = None
@@ -29,13 +29,17 @@ import threading
 import socket
 import errno
 import Queue
+import bisect
 
 import sys
+import base64
+import quopri
 import imapclient
 import imaplib
 
 from ..proc import base
 from ..model import DocumentSaveError
+from .. import profiler
 from . import xoauth
 
 brat = base.Rat
@@ -50,8 +54,38 @@ NUM_QUERYERS = 3
 NUM_FETCHERS = 3
 
 # we fetch this many bytes or this many messages, whichever we hit first.
-MAX_BYTES_PER_FETCH = 500000
-MAX_MESSAGES_PER_FETCH = 30
+# These are just where we start - the sizes are tuned so each fetch takes
+# about TARGET_FETCH_TIME (see FetchSizer), but never go beyond the MAX_
+# values, which can be overridden per account.
+BYTES_PER_FETCH = 500000
+MESSAGES_PER_FETCH = 30
+MIN_BYTES_PER_FETCH = 50000
+MAX_BYTES_PER_FETCH = 5000000
+MAX_MESSAGES_PER_FETCH = 250
+TARGET_FETCH_TIME = 2 # seconds - pulled from a hat!
+# The round-trip of a fetch should be no more than this fraction of it.
+MAX_FETCH_LATENCY_RATIO = 0.25
+# How many fetched batches may be waiting to be written before the fetch
+# stalls.
+WRITE_QUEUE_SIZE = 2
+
+# The cache of a folder's messages is split into documents each holding
+# the messages with UIDs in a range this size.
+CACHE_SEGMENT_SIZE = 1000 # pulled from a hat!
+
+# With 'lazy_attachments', non-text parts of at least this size are left on
+# the server until someone asks for them.
+LAZY_ATTACHMENT_SIZE = 100000 # pulled from a hat!
+# The header we add to the parts we left on the server - msg-rfc-to-email
+# turns them into 'remote' attachments.
+REMOTE_PART_HEADER = "X-Raindrop-Remote-Part"
+
+# In 'idle' mode, how often the threads waiting for the server to tell us
+# about changes check if they should stop.
+IDLE_CHECK_INTERVAL = 5
+# RFC2177 says servers may drop a connection idle for 30 minutes, so we
+# restart the IDLE command more often than that.
+IDLE_RENEW_INTERVAL = 60*25
 
 from imapclient.imap_utf7 import encode as encode_imap_utf7
 from imapclient.imap_utf7 import decode as decode_imap_utf7
@@ -60,6 +94,90 @@ def log_exception(msg, *args):
   # this made more sense when things were twisted :)
   logger.exception(msg, *args)
 
+def get_cache_segment(uid):
+  # The number of the folder cache segment which holds a message.
+  return int(uid) // CACHE_SEGMENT_SIZE
+
+def parse_uid_set(uid_set):
+  # Parses an IMAP 'sequence-set' of UIDs, such as '1:3,7', into a list of
+  # (first, last) ranges.
+  ret = []
+  for part in uid_set.strip().split(","):
+    bits = sorted(int(p) for p in part.split(":"))
+    ret.append((bits[0], bits[-1]))
+  return ret
+
+def get_uids_in_ranges(uids, ranges):
+  # Returns the set of uids which fall within any of the (first, last)
+  # ranges.  The ranges are merged so each uid is a single bisect.
+  starts = []
+  ends = []
+  for first, last in sorted(ranges):
+    if ends and first <= ends[-1] + 1:
+      ends[-1] = max(ends[-1], last)
+    else:
+      starts.append(first)
+      ends.append(last)
+  ret = set()
+  for uid in uids:
+    i = bisect.bisect_right(starts, uid) - 1
+    if i >= 0 and uid <= ends[i]:
+      ret.add(uid)
+  return ret
+
+def is_multipart_structure(struct):
+  # a multipart BODYSTRUCTURE starts with the list of its parts.
+  return isinstance(struct[0], (list, tuple))
+
+def get_lazy_parts(struct, min_size, part_id=''):
+  # Given a multipart BODYSTRUCTURE, returns (sections, lazy) - a list of the
+  # sections we fetch to rebuild the message without its non-text parts of
+  # at least min_size, and a dict of those parts' sizes keyed by part ID.
+  sections = []
+  lazy = {}
+  for i, sub in enumerate(struct[0]):
+    sub_id = "%s.%d" % (part_id, i+1) if part_id else str(i+1)
+    sections.append(sub_id + ".MIME")
+    if is_multipart_structure(sub):
+      sub_sections, sub_lazy = get_lazy_parts(sub, min_size, sub_id)
+      sections.extend(sub_sections)
+      lazy.update(sub_lazy)
+    elif sub[0].lower() != 'text' and int(sub[6]) >= min_size:
+      lazy[sub_id] = int(sub[6])
+    else:
+      sections.append(sub_id)
+  return sections, lazy
+
+def get_boundary(struct):
+  # the multipart params are a flat list of names and values.
+  params = struct[2] if len(struct) > 2 else None
+  params = list(params or [])
+  for name, val in zip(params[::2], params[1::2]):
+    if name.lower() == 'boundary':
+      return val
+  return None
+
+def build_partial_message(struct, bodies, lazy, part_id=''):
+  # Reassemble (the body of) a multipart message from the sections we
+  # fetched.  The lazy parts get their MIME headers and our REMOTE_PART_HEADER
+  # but no content.
+  boundary = get_boundary(struct)
+  bits = []
+  for i, sub in enumerate(struct[0]):
+    sub_id = "%s.%d" % (part_id, i+1) if part_id else str(i+1)
+    mime = bodies[sub_id + ".MIME"]
+    if sub_id in lazy:
+      mime = "%s\r\n%s: %s; size=%d\r\n\r\n" % (mime.rstrip("\r\n"),
+                                      REMOTE_PART_HEADER, sub_id, lazy[sub_id])
+      content = ""
+    elif is_multipart_structure(sub):
+      content = build_partial_message(sub, bodies, lazy, sub_id)
+    else:
+      content = bodies[sub_id]
+    bits.append("--%s\r\n%s%s\r\n" % (boundary, mime, content))
+  bits.append("--%s--\r\n" % (boundary,))
+  return "".join(bits)
+
 def get_rdkey_for_email(msg_id):
   # message-ids must be consistent everywhere we use them, and we decree
   # the '<>' is stripped (if for no better reason than the Python email
@@ -96,6 +214,59 @@ def check_envelope_ok(env):
   return True
 
 
+class FetchSizer(object):
+  """Tunes the number of messages and bytes in each body fetch of an
+  account to the throughput and latency we measure from the server.
+
+  We aim for each fetch to take TARGET_FETCH_TIME - or longer if the
+  round-trip of a fetch is slow - so the connection spends its time
+  transferring messages rather than waiting for the next fetch to start,
+  while keeping a failed fetch cheap to retry.
+  """
+  def __init__(self, max_bytes=MAX_BYTES_PER_FETCH,
+               max_messages=MAX_MESSAGES_PER_FETCH):
+    self.max_bytes = max_bytes
+    self.max_messages = max_messages
+    self.num_bytes = min(BYTES_PER_FETCH, max_bytes)
+    self.num_messages = min(MESSAGES_PER_FETCH, max_messages)
+    # the quickest fetch we've seen is our best guess at the round-trip.
+    self.latency = None
+    self.lock = threading.Lock()
+
+  def get_limits(self):
+    """Returns (max_messages, max_bytes) for the next fetch."""
+    return self.num_messages, self.num_bytes
+
+  def fetched(self, num_messages, num_bytes, took):
+    """Note a fetch of the limits we gave took this many seconds."""
+    self.lock.acquire()
+    try:
+      if self.latency is None or took < self.latency:
+        self.latency = took
+      target = max(TARGET_FETCH_TIME, self.latency / MAX_FETCH_LATENCY_RATIO)
+      # don't jump too far on one measurement.
+      scale = min(2.0, max(0.5, target / max(took, 0.001)))
+      if scale > 1:
+        if num_messages < self.num_messages and num_bytes < self.num_bytes:
+          # we ran out of messages before hitting a limit, so this tells us
+          # nothing about bigger fetches.
+          return
+        new_messages = self.num_messages * scale
+        new_bytes = self.num_bytes * scale
+      else:
+        # too slow - base the new limits on what we actually fetched.
+        new_messages = min(num_messages, self.num_messages) * scale
+        new_bytes = min(num_bytes, self.num_bytes) * scale
+      self.num_messages = max(1, min(self.max_messages, int(new_messages)))
+      self.num_bytes = max(MIN_BYTES_PER_FETCH,
+                           min(self.max_bytes, int(new_bytes)))
+      logger.log(1, "fetch of %d messages (%d bytes) took %gs - now "
+                 "fetching %d messages or %d bytes", num_messages, num_bytes,
+                 took, self.num_messages, self.num_bytes)
+    finally:
+      self.lock.release()
+
+
 class IMAP4AuthException(Exception):
   def __init__(self, why, *args):
     self.why = why
@@ -145,6 +316,9 @@ def ssl_imap_readline(self):
       if char in ("\n", ''): return ''.join(line)
 
 imaplib.IMAP4_SSL.readline = ssl_imap_readline
+
+# imaplib doesn't know about ENABLE (RFC 5161), which we need for QRESYNC.
+imaplib.Commands.setdefault('ENABLE', ('AUTH',))
   
 
 class ImapProvider(object):
@@ -162,6 +336,8 @@ class ImapProvider(object):
     self.query_queue = Queue.Queue() # IMAP folder etc query requests 
     self.fetch_queue = Queue.Queue()
     self.updated_folder_infos = None
+    # the (delim, name) of all folders we are synching, once known.
+    self.all_folders = None
 
   def write_items(self, items):
     try:
@@ -279,6 +455,7 @@ class ImapProvider(object):
           todo_top.append(folder_info)
     
     todo = todo_special_folders + todo_top + todo_sub
+    self.all_folders = todo
     try:
       self._updateFolders(conn, todo)
     except:
@@ -307,16 +484,23 @@ class ImapProvider(object):
              if self.shouldFetchMessage(results[seq])]
     self.maybe_queue_fetch_items(folder_path, infos)
 
-  def _updateFolders(self, conn, all_names):
-    # Fetch all state cache docs for all mailboxes in one go.
+  def _openFolderCaches(self, folder_name=None):
+    # Fetch the state cache docs for all mailboxes (or just the one named)
+    # in one go.
     # XXX - need key+schema here, but we don't use multiple yet.
     acct_id = self.account.details.get('id')
-    startkey = ['key', ['imap-mailbox', [acct_id]]]
-    endkey = ['key', ['imap-mailbox', [acct_id, {}]]]
+    if folder_name is None:
+      startkey = ['key', ['imap-mailbox', [acct_id]]]
+      endkey = ['key', ['imap-mailbox', [acct_id, {}]]]
+    else:
+      startkey = ['key', ['imap-mailbox', [acct_id, folder_name]]]
+      endkey = ['key', ['imap-mailbox', [acct_id, folder_name, {}]]]
     results = self.doc_model.open_view(startkey=startkey,
                                        endkey=endkey, reduce=False,
                                        include_docs=True)
-    # build a map of the docs keyed by folder-name.
+    # build a map of the docs keyed by folder-name.  Each folder has a
+    # 'header' doc and a doc for each segment of its messages, keyed by the
+    # segment number.
     caches = {}
     for row in results['rows']:
       doc = row['doc']
@@ -324,10 +508,17 @@ class ImapProvider(object):
       if doc['rd_schema_id'] == 'rd.core.error':
         # ack - failed last time for some reason - skip it.
         continue
-      assert doc['rd_schema_id'] in ['rd.imap.mailbox-cache',
-                                     'rd.core.error'], doc ## fix me above
-      caches[folder_name] = doc
+      cache = caches.setdefault(folder_name, {'header': {}, 'segments': {}})
+      if doc['rd_schema_id'] == 'rd.imap.mailbox-cache':
+        cache['header'] = doc
+      else:
+        assert doc['rd_schema_id'] == 'rd.imap.mailbox-cache-segment', doc
+        cache['segments'][doc['rd_key'][1][2]] = doc
     logger.debug('opened cache documents for %d folders', len(caches))
+    return caches
+
+  def _updateFolders(self, conn, all_names):
+    caches = self._openFolderCaches()
 
     # We used to do a 'quick fetch' when the expectation was that a user
     # would be sitting there waiting for the first sync.  Now that we don't
@@ -348,8 +539,8 @@ class ImapProvider(object):
     seen = set()
     for delim, name in all_names:
       seen.add(name)
-      cache_doc = caches.get(name, {})
-      self.query_queue.put((False, self._updateFolderFromCache, (cache_doc, delim, name)))
+      cache = caches.get(name, {'header': {}, 'segments': {}})
+      self.query_queue.put((False, self._updateFolderFromCache, (cache, delim, name)))
     # Now the folders which we saw once before but can't see now - it must
     # have been deleted, so we remove the location records for those folders.
     missing = set(caches) - seen
@@ -357,31 +548,42 @@ class ImapProvider(object):
       logger.debug('updating folder locations for deleted folder %r', folder_name)
       self.writeLocationInfos(folder_name, None, [], [])
 
-  def _updateFolderFromCache(self, conn, cache_doc, folder_delim, folder_name):
+  def _queueChangedFolders(self, folders):
+    # In 'idle' mode the server told us something changed in these folders,
+    # so we update just them.  The provider lives for the whole idle session,
+    # so each batch of changes starts with no folder infos pending.
+    assert not self.updated_folder_infos
+    self.updated_folder_infos = []
+    try:
+      for delim, name in folders:
+        cache = self._openFolderCaches(name).get(name,
+                                            {'header': {}, 'segments': {}})
+        self.query_queue.put((False, self._updateFolderFromCache,
+                              (cache, delim, name)))
+    except:
+      log_exception("Failed to update changed folders for account %r",
+                    self.account.details.get('id',''))
+    # and tell the query queue everything is done.
+    self.query_queue.put(None)
+
+  def _updateFolderFromCache(self, conn, cache, folder_delim, folder_name):
     # Now queue the updates of the folders
-    acct_id = self.account.details.get('id')
     info = conn.select_folder(folder_name, True)
     logger.debug("info for %r is %r", folder_name, info)
 
+    cache_doc = self._loadFolderCache(cache)
     dirty = self._syncFolderCache(conn, folder_name, info, cache_doc)
-
-    if dirty:
-      logger.debug("need to update folder cache for %r", folder_name)
-      items = {'uidvalidity': cache_doc['uidvalidity'],
-               'infos': cache_doc['infos']
-               }
-      new_item = {'rd_key' : ['imap-mailbox', [acct_id, folder_name]],
-                  'rd_schema_id': 'rd.imap.mailbox-cache',
-                  'rd_ext_id': self.rd_extension_id,
-                  'items': items,
-      }
-      if '_id' in cache_doc:
-        new_item['_id'] = cache_doc['_id']
-        new_item['_rev'] = cache_doc['_rev']
-      self.updated_folder_infos.append(new_item)
-      sync_items = cache_doc['infos']
-    else:
-      sync_items = cache_doc.get('infos')
+    if cache_doc['legacy']:
+      # an old cache with every message in the one doc - rewrite it all.
+      dirty.update(get_cache_segment(i['UID']) for i in cache_doc['infos'])
+
+    new_items = self._makeFolderCacheItems(folder_name, cache, cache_doc,
+                                           dirty)
+    if new_items:
+      logger.debug("need to update %d folder cache docs for %r",
+                   len(new_items), folder_name)
+      self.updated_folder_infos.extend(new_items)
+    sync_items = cache_doc['infos']
 
     todo = sync_items[:]
     queued_keys = []
@@ -399,21 +601,106 @@ class ImapProvider(object):
       self.maybe_queue_fetch_items(folder_name, batch)
     self.writeLocationInfos(folder_name, folder_delim, sync_items, queued_keys)
 
+  def _loadFolderCache(self, cache):
+    # Builds a single 'cache doc' from the header and segments of a folder,
+    # with the infos for all messages in the folder sorted by UID.
+    header = cache['header']
+    cache_doc = {'uidvalidity': header.get('uidvalidity'),
+                 'uidnext': header.get('uidnext'),
+                 'highestmodseq': header.get('highestmodseq'),
+                 'legacy': header.get('infos') is not None,
+                 }
+    if cache_doc['legacy']:
+      cache_doc['infos'] = header['infos']
+    else:
+      infos = cache_doc['infos'] = []
+      segments = cache['segments']
+      for num in sorted(segments):
+        infos.extend(segments[num]['infos'])
+    return cache_doc
+
+  def _makeFolderCacheItems(self, folder_name, cache, cache_doc, dirty):
+    # Returns the schema items for the header and the 'dirty' segments of a
+    # folder's cache.
+    acct_id = self.account.details.get('id')
+    segment_infos = {}
+    # It is fairly common to see multiples with the same message ID in, eg,
+    # a 'drafts' folder.  Extensions only look at one segment at a time, so
+    # each segment notes the UIDs of its messages which have the same ID as
+    # a message with a lower UID in the folder - extensions skip them.
+    first_uids = {} # message ID -> lowest UID
+    segment_dupes = {}
+    for info in cache_doc['infos']:
+      num = get_cache_segment(info['UID'])
+      segment_infos.setdefault(num, []).append(info)
+      msg_id = info['ENVELOPE'][-1]
+      if msg_id is None:
+        continue
+      if msg_id in first_uids:
+        segment_dupes.setdefault(num, []).append(info['UID'])
+      else:
+        first_uids[msg_id] = info['UID']
+    # A segment whose duplicates changed must be rewritten too.
+    dirty = set(dirty)
+    for num, old in cache['segments'].iteritems():
+      if old.get('duplicate_uids', []) != segment_dupes.get(num, []):
+        dirty.add(num)
+    ret = []
+    for num in sorted(dirty):
+      old = cache['segments'].get(num)
+      infos = segment_infos.get(num, [])
+      if old is None and not infos:
+        continue
+      # A segment whose messages have all gone is kept, but empty.
+      items = {'uidvalidity': cache_doc['uidvalidity'],
+               'infos': infos,
+               'duplicate_uids': segment_dupes.get(num, []),
+               }
+      new_item = {'rd_key' : ['imap-mailbox', [acct_id, folder_name, num]],
+                  'rd_schema_id': 'rd.imap.mailbox-cache-segment',
+                  'rd_ext_id': self.rd_extension_id,
+                  'items': items,
+      }
+      if old is not None:
+        new_item['_id'] = old['_id']
+        new_item['_rev'] = old['_rev']
+      ret.append(new_item)
+
+    header = cache['header']
+    if cache_doc['legacy'] or \
+       header.get('uidvalidity') != cache_doc['uidvalidity'] or \
+       header.get('uidnext') != cache_doc['uidnext'] or \
+       header.get('highestmodseq') != cache_doc['highestmodseq']:
+      items = {'uidvalidity': cache_doc['uidvalidity'],
+               'uidnext': cache_doc['uidnext'],
+               'highestmodseq': cache_doc['highestmodseq'],
+               }
+      if cache_doc['legacy']:
+        # fields are merged into the existing doc, so must be nuked.
+        items['infos'] = None
+      new_item = {'rd_key' : ['imap-mailbox', [acct_id, folder_name]],
+                  'rd_schema_id': 'rd.imap.mailbox-cache',
+                  'rd_ext_id': self.rd_extension_id,
+                  'items': items,
+      }
+      if '_id' in header:
+        new_item['_id'] = header['_id']
+        new_item['_rev'] = header['_rev']
+      ret.append(new_item)
+    return ret
+
   def _syncFolderCache(self, conn, folder_path, server_info, cache_doc):
-    # Queries the server for the current state of a folder.  Returns True if
-    # the cache document was updated so needs to be written back to couch.
+    # Queries the server for the current state of a folder.  Returns the
+    # set of cache segments which were updated so need to be written back to
+    # couch.
     suidv = int(server_info['UIDVALIDITY'])
-    dirty = False
+    dirty = set()
+    infos = cache_doc['infos']
     if suidv != cache_doc.get('uidvalidity'):
+      dirty.update(get_cache_segment(i['UID']) for i in infos)
       infos = cache_doc['infos'] = []
       cache_doc['uidvalidity'] = suidv
-      dirty = True
-    else:
-      try:
-        infos = cache_doc['infos']
-      except KeyError:
-        infos = cache_doc['infos'] = []
-        dirty = True
+      cache_doc['highestmodseq'] = None
 
     if infos:
       cached_uid_next = int(infos[-1]['UID']) + 1
@@ -435,47 +722,38 @@ class ImapProvider(object):
     else:
       logger.info('folder %r has no new messages', folder_path)
       new_infos = {}
-    # Get flags for all 'old' messages.
-    if cached_uid_next > 1:
-      updated_flags = conn.fetch("1:%d" % (cached_uid_next-1,), ("FLAGS",))
-    else:
-      updated_flags = {}
+    # Get flags for the 'old' messages - just those which changed if the
+    # server supports CONDSTORE and we know where we were up to.
+    removed, updated_flags = self._fetchOldFlags(conn, folder_path,
+                                                 server_info, cache_doc,
+                                                 cached_uid_next)
     logger.info("folder %r has %d new items, %d flags for old items",
                 folder_path, len(new_infos), len(updated_flags))
 
-    # Turn the dicts back into the sorted-by-UID list it started as, nuking
-    # old messages
-    infos_ndx = 0
-    for this_uid in sorted(int(k) for k in updated_flags):
-      info = updated_flags[this_uid]
-      # remove items which no longer exist.
-      while int(infos[infos_ndx]['UID']) < this_uid:
-        old = infos.pop(infos_ndx)
-        logger.debug('detected a removed imap item %r', old)
-        dirty = True
-      if int(infos[infos_ndx]['UID']) == this_uid:
-        old_flags = infos[infos_ndx].get('FLAGS')
-        new_flags = info["FLAGS"]
-        if old_flags != new_flags:
-          dirty = True
-          infos[infos_ndx]['FLAGS'] = new_flags
-          logger.debug('new flags for UID %r - were %r, now %r',
-                       this_uid, old_flags, new_flags)
-        infos_ndx += 1
-        # we might get more than we asked for - that's OK - we should get
-        # them in 'new_infos' too.
-        if infos_ndx >= len(infos):
-          break
-      else:
-        # We see this happen when we previously rejected an item due to
-        # invalid or missing ENVELOPE etc.
-        logger.debug("message %r never seen before - probably invalid", this_uid)
+    # Update the flags of the items we know about, nuking old messages.  If
+    # we weren't told what was removed, it is everything we didn't get flags
+    # for.
+    keep = []
+    for info in infos:
+      this_uid = int(info['UID'])
+      if (removed is None and this_uid not in updated_flags) or \
+         (removed is not None and this_uid in removed):
+        logger.debug('detected a removed imap item %r', info)
+        dirty.add(get_cache_segment(this_uid))
+        continue
+      keep.append(info)
+      try:
+        new_flags = updated_flags[this_uid]['FLAGS']
+      except KeyError:
         continue
-    # Records we had in the past now have accurate flags; anything in past
-    # our current index must have been deleted.
-    while infos_ndx < len(infos):
-      infos.pop()
-      dirty = True
+      old_flags = info.get('FLAGS')
+      # the cached flags are a list, but we are given a tuple.
+      if list(old_flags or []) != list(new_flags):
+        dirty.add(get_cache_segment(this_uid))
+        info['FLAGS'] = new_flags
+        logger.debug('new flags for UID %r - were %r, now %r',
+                     this_uid, old_flags, new_flags)
+    infos[:] = keep
     # next up is to append new message infos we just received...
     for this_uid in sorted(int(k) for k in new_infos):
       info = new_infos[this_uid]
@@ -501,9 +779,55 @@ class ImapProvider(object):
       # it is good - keep it.
       cached_uid_next = this_uid + 1
       infos.append(info)
-      dirty = True
+      dirty.add(get_cache_segment(this_uid))
+    cache_doc['uidnext'] = cached_uid_next
+    cache_doc['highestmodseq'] = server_info.get('HIGHESTMODSEQ')
     return dirty
 
+  def _fetchOldFlags(self, conn, folder_path, server_info, cache_doc,
+                     cached_uid_next):
+    # Returns (removed, updated_flags) for the messages we have cached.
+    # updated_flags is a dict of the FLAGS of messages keyed by UID.  If
+    # removed is None, updated_flags has every message and anything not in
+    # it was removed; otherwise removed is a set of the removed UIDs and
+    # updated_flags has only the messages whose flags changed.
+    if cached_uid_next <= 1:
+      return None, {}
+    old_uids = "1:%d" % (cached_uid_next-1,)
+    modseq = cache_doc.get('highestmodseq')
+    server_modseq = server_info.get('HIGHESTMODSEQ')
+    if modseq is None or server_modseq is None or \
+       not conn.has_capability('CONDSTORE'):
+      return None, conn.fetch(old_uids, ("FLAGS",))
+
+    qresync = getattr(conn, 'qresync_enabled', False)
+    if qresync and server_modseq == modseq:
+      # removing a message also bumps the modseq, so nothing has changed.
+      logger.debug("folder %r is unchanged since modseq %s", folder_path,
+                   modseq)
+      return set(), {}
+    modifiers = ["CHANGEDSINCE %d" % (modseq,)]
+    if qresync:
+      modifiers.append("VANISHED")
+      conn._imap.untagged_responses.pop('VANISHED', None)
+    updated_flags = conn.fetch(old_uids, ("FLAGS",), modifiers=modifiers)
+    if qresync:
+      # the ranges may be huge and include UIDs we never saw.
+      ranges = []
+      for data in conn._imap.untagged_responses.pop('VANISHED', []):
+        ranges.extend(parse_uid_set(data.replace("(EARLIER)", "")))
+      removed = get_uids_in_ranges((int(i['UID']) for i in cache_doc['infos']),
+                                   ranges)
+    else:
+      # plain CONDSTORE doesn't tell us about removed messages, but the
+      # list of UIDs is still far smaller than the flags of them all.
+      existing = set(conn.search("UID %s" % (old_uids,)))
+      removed = set(int(i['UID']) for i in cache_doc['infos']) - existing
+    logger.debug("folder %r has %d changed and %d removed items since "
+                 "modseq %s", folder_path, len(updated_flags), len(removed),
+                 modseq)
+    return removed, updated_flags
+
   def writeLocationInfos(self, folder_name, folder_delim, sync_items, queued_keys):
     # fetch folder info location info and write it out.  As each rd_key gets
     # one record with all locations, there is the possibility a conflict will
@@ -681,55 +1005,163 @@ class ImapProvider(object):
 
   def _processFolderBatch(self, conn, folder_path, by_uid):
     """Called asynchronously by a queue consumer"""
-    conn.select_folder(folder_path, True) # should check if it already is selected?
-    acct_id = self.account.details.get('id')
+    # should check if it already is selected?
+    folder_info = conn.select_folder(folder_path, True)
+    uidvalidity = folder_info.get('UIDVALIDITY')
+    details = self.account.details
+    acct_id = details.get('id')
+    # In 'lazy' mode the big attachments of big messages are left on the
+    # server - see _fetchPartialMessages.
+    if details.get('lazy_attachments'):
+      lazy_size = details.get('lazy_attachment_size', LAZY_ATTACHMENT_SIZE)
+    else:
+      lazy_size = None
+    sizer = self.account.fetch_sizer
     num = 0
-    # fetch most-recent (highest UID) first...
-    left = sorted(by_uid.keys(), reverse=True)
-    while left:
-      # do as many as we can each time while staying inside our MAX_*
-      # constraints...
-      nbytes = 0
-      this = []
-      while left and len(this) < MAX_MESSAGES_PER_FETCH and nbytes < MAX_BYTES_PER_FETCH:
-        look = left.pop(0)
-        this.append(look)
-        try:
-          this_bytes = int(by_uid[look]['RFC822.SIZE'])
-        except (KeyError, ValueError):
-          logger.info("invalid message size in`%r", by_uid[look])
-          this_bytes = 100000 # whateva...
-        nbytes += this_bytes
-      logger.debug("starting fetch of %d items from %r (%d bytes)",
-                   len(this), folder_path, nbytes)
-      to_fetch = ",".join(str(v) for v in this)
-      results = conn.fetch(to_fetch, ("BODY.PEEK[]",))
-      logger.debug("fetch from %r got %d", folder_path, len(results))
-      #results = conn.fetchMessage(to_fetch, uid=True)
-      # Run over the results stashing in our by_uid dict.
-      infos = []
-      for uid, info in results.iteritems():
-        flags = by_uid[uid]['FLAGS']
-        rdkey = by_uid[uid]['RAINDROP_KEY']
-        content = info['BODY[]']
-        mid = rdkey[-1]
-        # XXX - we need something to make this truly unique.
-        logger.debug("new imap message %r (flags=%s)", mid, flags)
-  
-        # put our schemas together
-        attachments = {'rfc822' : {'content_type': 'message',
-                                   'data': content,
-                                   }
-        }
-        infos.append({'rd_key' : rdkey,
-                      'rd_ext_id': self.rd_extension_id,
-                      'rd_schema_id': 'rd.msg.rfc822',
-                      'items': {},
-                      'attachments': attachments,})
-      num += len(infos)
-      self.write_items(infos)
+    # The results of each fetch are handed to a thread which writes them,
+    # so we can get on with the next fetch while couch is busy.  The queue
+    # is bounded so a slow couch stops us fetching everything into memory.
+    write_queue = Queue.Queue(WRITE_QUEUE_SIZE)
+    write_errors = []
+    tag = profiler.get_thread_tag()
+
+    def write_results():
+      if tag is not None:
+        profiler.set_thread_tag(tag)
+      try:
+        while True:
+          infos = write_queue.get()
+          if infos is None:
+            break
+          if write_errors:
+            continue # just drain the queue so the fetcher doesn't block.
+          try:
+            self.write_items(infos)
+          except Exception:
+            write_errors.append(sys.exc_info())
+      finally:
+        profiler.clear_thread_tag()
+
+    writer = threading.Thread(target=write_results)
+    writer.start()
+    try:
+      # fetch most-recent (highest UID) first...
+      left = sorted(by_uid.keys(), reverse=True)
+      while left and not write_errors:
+        # do as many as we can each time while staying inside our size
+        # constraints...
+        max_messages, max_bytes = sizer.get_limits()
+        nbytes = 0
+        this = []
+        while left and len(this) < max_messages and nbytes < max_bytes:
+          look = left.pop(0)
+          this.append(look)
+          try:
+            this_bytes = int(by_uid[look]['RFC822.SIZE'])
+          except (KeyError, ValueError):
+            logger.info("invalid message size in`%r", by_uid[look])
+            this_bytes = 100000 # whateva...
+          nbytes += this_bytes
+        logger.debug("starting fetch of %d items from %r (%d bytes)",
+                     len(this), folder_path, nbytes)
+        whole = this
+        partial = []
+        if lazy_size is not None:
+          whole = []
+          for uid in this:
+            try:
+              big = int(by_uid[uid]['RFC822.SIZE']) >= lazy_size
+            except (KeyError, ValueError):
+              big = False
+            (partial if big else whole).append(uid)
+        start = time.time()
+        # uid -> (content, is_partial)
+        results = {}
+        if partial:
+          results.update(self._fetchPartialMessages(conn, partial, lazy_size))
+        if whole:
+          to_fetch = ",".join(str(v) for v in whole)
+          for uid, info in conn.fetch(to_fetch, ("BODY.PEEK[]",)).iteritems():
+            results[uid] = info['BODY[]'], False
+        # the sizer wants what we actually fetched, which is less than
+        # RFC822.SIZE for messages whose big attachments were left behind.
+        fetched_bytes = sum(len(content) for content, _ in results.itervalues())
+        sizer.fetched(len(this), fetched_bytes, time.time() - start)
+        logger.debug("fetch from %r got %d", folder_path, len(results))
+        # Run over the results stashing in our by_uid dict.
+        infos = []
+        for uid, (content, is_partial) in results.iteritems():
+          flags = by_uid[uid]['FLAGS']
+          rdkey = by_uid[uid]['RAINDROP_KEY']
+          mid = rdkey[-1]
+          # XXX - we need something to make this truly unique.
+          logger.debug("new imap message %r (flags=%s, partial=%s)", mid,
+                       flags, is_partial)
+
+          # put our schemas together
+          attachments = {'rfc822' : {'content_type': 'message',
+                                     'data': content,
+                                     }
+          }
+          items = {}
+          if is_partial:
+            # Tell the converters where to find the parts we left behind.
+            items['remote'] = {'proto': 'imap',
+                               'account': acct_id,
+                               'folder': folder_path,
+                               'uidvalidity': uidvalidity,
+                               'uid': uid,
+                               'message_id': mid,
+                               }
+          infos.append({'rd_key' : rdkey,
+                        'rd_ext_id': self.rd_extension_id,
+                        'rd_schema_id': 'rd.msg.rfc822',
+                        'items': items,
+                        'attachments': attachments,})
+        num += len(infos)
+        write_queue.put(infos)
+    finally:
+      write_queue.put(None)
+      writer.join()
+    if write_errors:
+      exc_type, exc_value, tb = write_errors[0]
+      raise exc_type, exc_value, tb
     return num
 
+  def _fetchPartialMessages(self, conn, uids, min_size):
+    """Fetch messages while leaving their big attachments on the server.
+
+    Returns a dict of uid -> (content, is_partial).  The BODYSTRUCTURE of
+    each message is fetched first; messages which turn out to have nothing
+    worth leaving behind (eg, a single big text part) are fetched whole.
+    """
+    ret = {}
+    whole = []
+    to_fetch = ",".join(str(v) for v in uids)
+    for uid, info in conn.fetch(to_fetch, ("BODYSTRUCTURE",)).iteritems():
+      struct = info['BODYSTRUCTURE']
+      if not is_multipart_structure(struct) or not get_boundary(struct):
+        whole.append(uid)
+        continue
+      sections, lazy = get_lazy_parts(struct, min_size)
+      if not lazy:
+        whole.append(uid)
+        continue
+      # Each message needs a different set of sections.
+      parts = conn.fetch(str(uid), ["BODY.PEEK[HEADER]"] +
+                                   ["BODY.PEEK[%s]" % s for s in sections])
+      bodies = dict((s, parts[uid]['BODY[%s]' % s]) for s in sections)
+      content = parts[uid]['BODY[HEADER]'] + \
+                build_partial_message(struct, bodies, lazy)
+      logger.debug("left %d parts (%d bytes) of message %d on the server",
+                   len(lazy), sum(lazy.values()), uid)
+      ret[uid] = content, True
+    if whole:
+      to_fetch = ",".join(str(v) for v in whole)
+      for uid, info in conn.fetch(to_fetch, ("BODY.PEEK[]",)).iteritems():
+        ret[uid] = info['BODY[]'], False
+    return ret
+
   def shouldFetchMessage(self, msg_info):
     if "\\deleted" in [f.lower() for f in msg_info['FLAGS']]:
       logger.debug("msg is deleted - skipping: %r", msg_info)
@@ -869,6 +1301,12 @@ def _do_get_connection(account, conductor):
       ret.login(encode_imap_utf7(details['username']), details['password'])
     except ret.Error, exc:
       raise IMAP4AuthException(account.PASSWORD, exc.args[0])
+  # QRESYNC lets us find what was removed from a folder without fetching
+  # every message in it, but must be enabled on each connection.
+  ret.qresync_enabled = False
+  if ret.has_capability('QRESYNC'):
+    typ, data = ret._imap._simple_command('ENABLE', 'QRESYNC')
+    ret.qresync_enabled = typ == 'OK'
   account.reportStatus(brat.EVERYTHING, brat.GOOD)
   return ret
 
@@ -901,8 +1339,68 @@ def drop_connection(conn):
       log_exception('failed to logout from the connection')
 
 
+def quote_imap_string(s):
+  # imapclient doesn't quote search criteria for us.
+  return '"%s"' % s.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def is_connection_closed(conn):
+  # True if the server has closed the connection - ie, the socket reads
+  # zero bytes rather than blocking.  We peek at the raw socket, which
+  # works for SSL connections too.
+  sock = conn._imap.sock
+  timeout = sock.gettimeout()
+  sock.setblocking(0)
+  try:
+    try:
+      return sock.recv(1, socket.MSG_PEEK) == ''
+    except socket.error, exc:
+      if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+        return False
+      raise
+  finally:
+    sock.settimeout(timeout)
+
+
 class IMAPAccount(base.AccountBase):
   rd_outgoing_schemas = ['rd.proto.outgoing.imap-flags']
+  def __init__(self, doc_model, details):
+    base.AccountBase.__init__(self, doc_model, details)
+    # The fetch sizes are tuned as we go and remembered between syncs.
+    self.fetch_sizer = FetchSizer(
+            details.get('max_bytes_per_fetch', MAX_BYTES_PER_FETCH),
+            details.get('max_messages_per_fetch', MAX_MESSAGES_PER_FETCH))
+
+  def fetch_remote_attachment(self, remote):
+    """Fetch a part of a message which _fetchPartialMessages left behind."""
+    conn = _do_get_connection(self, None)
+    try:
+      info = conn.select_folder(remote['folder'], True)
+      uid = remote['uid']
+      if info.get('UIDVALIDITY') != remote['uidvalidity']:
+        # The UIDs have been reset - find the message again.
+        uids = conn.search('HEADER Message-ID %s' %
+                           quote_imap_string('<%s>' % remote['message_id']))
+        if not uids:
+          raise KeyError("message %r is no longer in folder %r" %
+                         (remote['message_id'], remote['folder']))
+        uid = uids[0]
+      key = 'BODY[%s]' % remote['part']
+      results = conn.fetch(str(uid), ["BODY.PEEK[%s]" % remote['part']])
+      try:
+        data = results[uid][key]
+      except KeyError:
+        raise KeyError("message %r has no part %r" %
+                       (remote['message_id'], remote['part']))
+    finally:
+      drop_connection(conn)
+    encoding = remote.get('encoding')
+    if encoding == 'base64':
+      data = base64.decodestring(data)
+    elif encoding == 'quoted-printable':
+      data = quopri.decodestring(data)
+    return data
+
   def startSend(self, conductor, src_doc, dest_doc):
     # caller should check items are ready to send.
     assert src_doc['outgoing_state'] == 'outgoing', src_doc
@@ -927,12 +1425,23 @@ class IMAPAccount(base.AccountBase):
     return updater.handle_outgoing(conductor, src_doc, mine)
 
   def startSync(self, conductor, options):
-    done = threading.Event()
+    prov = self._syncPass(conductor, options)
+    # In 'idle' mode we then hang around waiting for the server to tell us
+    # about changes to the 'hot' folders rather than waiting for the next
+    # full sync.
+    if self.details.get('idle') and not conductor.is_sync_interrupted(self):
+      folders = self._getIdleFolders(prov)
+      if folders:
+        self._syncIdle(conductor, options, folders)
+
+  def _syncPass(self, conductor, options):
+    # Synch all folders.  Returns the ImapProvider which did the work.
     prov = ImapProvider(self, conductor, options)
 
     def consume_connection_queue(q):
       """Processes the query queue."""
       acct_id = self.details['id']
+      profiler.set_thread_tag('account:%s' % (acct_id,))
       qitem = None
       context = {'conn': None}
       try:
@@ -974,6 +1483,7 @@ class IMAPAccount(base.AccountBase):
               q.put(None)
       finally:
         drop_connection(context['conn'])
+        profiler.clear_thread_tag()
 
     def run_queryers(n):
       threads = []
@@ -1052,6 +1562,196 @@ class IMAPAccount(base.AccountBase):
     for t in threads:
       t.join()
     status_thread.join()
+    return prov
+
+  def _getIdleFolders(self, prov):
+    # The (delim, name) of the folders we watch in 'idle' mode.
+    names = self.details.get('idle_folders', 'INBOX')
+    wanted = [n.lower() for n in re.split(", *", names) if n]
+    ret = []
+    for delim, name in prov.all_folders or []:
+      if name.lower() in wanted:
+        ret.append((delim, name))
+    if len(ret) != len(wanted):
+      logger.warning("account %r can't idle on some folders in %r - they "
+                     "don't exist or aren't being synched",
+                     self.details['id'], names)
+    return ret
+
+  def _syncIdle(self, conductor, options, folders):
+    # Each 'hot' folder gets its own connection in IDLE mode.  As the server
+    # tells us about changes, we sync just the folders which changed, and if
+    # --repeat-after was specified we still do a full sync that often.
+    # The changed folders are synched by the one provider over the one
+    # connection for the whole session, rather than logging in again (and
+    # starting a new set of worker threads) for every notification.
+    acct_id = self.details['id']
+    prov = ImapProvider(self, conductor, options)
+    context = {'conn': None, 'used': 0}
+    changed = Queue.Queue()
+    stop = threading.Event()
+    threads = []
+    for delim, name in folders:
+      t = threading.Thread(target=self._watchFolder,
+                           args=(conductor, delim, name, changed, stop))
+      t.start()
+      threads.append(t)
+    if options.repeat_after:
+      next_full = time.time() + options.repeat_after
+    else:
+      next_full = None
+    try:
+      while not conductor.is_sync_interrupted(self):
+        if not [t for t in threads if t.isAlive()]:
+          logger.warning("account %r has no folders left to idle on",
+                         acct_id)
+          break
+        try:
+          todo = [changed.get(timeout=IDLE_CHECK_INTERVAL)]
+        except Queue.Empty:
+          if next_full is not None and time.time() > next_full:
+            self._syncPass(conductor, options)
+            next_full = time.time() + options.repeat_after
+          continue
+        # new mail often touches a few folders at once - sync them together.
+        while True:
+          try:
+            folder_info = changed.get_nowait()
+          except Queue.Empty:
+            break
+          if folder_info not in todo:
+            todo.append(folder_info)
+        logger.info("account %r has changes in folders %s", acct_id,
+                    [name for delim, name in todo])
+        self._syncChangedFolders(conductor, prov, context, todo)
+    finally:
+      stop.set()
+      for t in threads:
+        t.join()
+      drop_connection(context['conn'])
+
+  def _syncChangedFolders(self, conductor, prov, context, folders):
+    # Runs the query and fetch queues of the idle session's provider to
+    # completion on the session's connection.
+    acct_id = self.details['id']
+    if context['conn'] is not None and \
+       time.time() - context['used'] > IDLE_RENEW_INTERVAL:
+      # the server has probably logged it out by now.
+      drop_connection(context['conn'])
+      context['conn'] = None
+
+    def _doit(func, xargs):
+      if context['conn'] is None:
+        context['conn'] = get_connection(self, conductor)
+      func(context['conn'], *xargs)
+      context['used'] = time.time()
+
+    def _on_failure(exc):
+      self.reportStatus(**failure_to_status(exc))
+      if not isinstance(exc, RETRYABLE_EXCEPTIONS):
+        raise
+      logger.warning('Failed to update changed folders for %r (%s) - will '
+                     'retry', acct_id, exc)
+      drop_connection(context['conn'])
+      context['conn'] = None
+
+    prov._queueChangedFolders(folders)
+    try:
+      for q in (prov.query_queue, prov.fetch_queue):
+        while True:
+          qitem = q.get()
+          if qitem is None:
+            break
+          seeder, func, xargs = qitem
+          try:
+            conductor.apply_with_retry(self, _on_failure, _doit, func, xargs)
+          except Exception, exc:
+            # skip this request and continue with the others.
+            drop_connection(context['conn'])
+            context['conn'] = None
+            self.reportStatus(**failure_to_status(exc))
+            log_exception('failed to process an IMAP request for account %r',
+                          acct_id)
+        if q is prov.query_queue:
+          prov.fetch_queue.put(None)
+      # write the cache docs last.
+      if prov.updated_folder_infos:
+        prov.write_items(prov.updated_folder_infos)
+    finally:
+      prov.updated_folder_infos = None
+
+  def _watchFolder(self, conductor, folder_delim, folder_name, changed, stop):
+    # Sits in IDLE on a dedicated connection, putting (delim, name) in the
+    # 'changed' queue each time the server tells us about a change.
+    acct_id = self.details['id']
+    profiler.set_thread_tag('account:%s' % (acct_id,))
+    folder_info = folder_delim, folder_name
+    context = {'conn': None, 'idled': False}
+
+    def _watch():
+      # Returns False if we should give up on this folder.
+      conn = context['conn'] = get_connection(self, conductor)
+      if not conn.has_capability('IDLE'):
+        logger.warning("This IMAP server doesn't support IDLE - can't "
+                       "watch folder %r", folder_name)
+        return False
+      conn.select_folder(folder_name, True)
+      conn.idle()
+      if context['idled']:
+        # we may have missed something while we were re-connecting.
+        changed.put(folder_info)
+      context['idled'] = True
+      logger.debug("idling on folder %r for account %r", folder_name, acct_id)
+      try:
+        renew = time.time() + IDLE_RENEW_INTERVAL
+        while not stop.isSet():
+          responses = conn.idle_check(IDLE_CHECK_INTERVAL)
+          # idle_check swallows the EOF from a closed connection, and also
+          # returns nothing when only part of a line has arrived - so look
+          # for the EOF ourselves.
+          if not responses and is_connection_closed(conn):
+            raise imaplib.IMAP4.abort("connection closed while idle")
+          for resp in responses:
+            if resp[0] == 'VANISHED' or \
+               (len(resp) > 1 and resp[1] in ('EXISTS', 'EXPUNGE', 'FETCH')):
+              logger.debug("folder %r changed: %r", folder_name, resp)
+              changed.put(folder_info)
+              break
+          if time.time() > renew:
+            conn.idle_done()
+            conn.idle()
+            renew = time.time() + IDLE_RENEW_INTERVAL
+        conn.idle_done()
+      except RETRYABLE_EXCEPTIONS, exc:
+        # We were idling happily until now, so this doesn't count against
+        # the retries of apply_with_retry - just wait a little and start
+        # again with a new connection.
+        logger.info("lost idle connection to folder %r for %r (%s)",
+                    folder_name, acct_id, exc)
+        drop_connection(context['conn'])
+        context['conn'] = None
+        stop.wait(self.details.get('retry_backoff', self.def_retry_backoff))
+      return True
+
+    def _on_failure(exc):
+      drop_connection(context['conn'])
+      context['conn'] = None
+      if stop.isSet() or not isinstance(exc, RETRYABLE_EXCEPTIONS):
+        raise
+      logger.warning('Failed to idle on folder %r for %r (%s) - will retry',
+                     folder_name, acct_id, exc)
+
+    try:
+      while not stop.isSet():
+        if not conductor.apply_with_retry(self, _on_failure, _watch):
+          break
+    except Exception:
+      if not stop.isSet():
+        log_exception('giving up idling on folder %r for account %r',
+                      folder_name, acct_id)
+    finally:
+      drop_connection(context['conn'])
+      profiler.clear_thread_tag()
 
   def get_identities(self):
     addresses = self.details.get('addresses')
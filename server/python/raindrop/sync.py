@@ -28,6 +28,7 @@ import sys
 
 from . import proto as proto
 from .config import get_config
+from . import profiler
 
 logger = logging.getLogger(__name__)
 
@@ -49,8 +50,9 @@ def get_conductor(pipeline):
   return conductor
 
 class OutgoingExtension:
-  def __init__(self, id):
+  def __init__(self, id, source_schemas):
     self.id = id
+    self.source_schemas = source_schemas
     self.uses_dependencies = False
 
 class OutgoingProcessor:
@@ -105,7 +107,7 @@ class SyncConductor(object):
     # (or fail) at its own pace.
     for sch_id in self.outgoing_handlers.iterkeys():
       ext_id = "outgoing-" + sch_id
-      ext = OutgoingExtension(ext_id)
+      ext = OutgoingExtension(ext_id, [sch_id])
       proc = OutgoingProcessor(self, ext, sch_id)
       self.pipeline.add_processor(proc)
 
@@ -329,12 +331,26 @@ class SyncConductor(object):
     # wait for existing ones to complete, then return...
     self.stop_sync(False)
 
+  def is_sync_interrupted(self, acct):
+    """Returns True if a sync of the account which is waiting for something
+    to happen (eg, an IMAP account in 'idle' mode) should return - either a
+    stop has been requested or another sync of the account has.
+    """
+    if self.stop_requested:
+      return True
+    try:
+      return self._sync_states[acct.details['id']].control_event.isSet()
+    except KeyError:
+      return True
+
   def _sync_one_loop(self, sync_state, options):
     acct_id = sync_state.acct.details['id']
+    profiler.set_thread_tag('account:%s' % (acct_id,))
     try:
       self._do_sync_one_loop(sync_state, options)
     except:
       logger.exception("sync of account '%s' failed", acct_id)
+    profiler.clear_thread_tag()
     self._sync_states[acct_id].thread = None
 
   def _do_sync_one_loop(self, sync_state, options):
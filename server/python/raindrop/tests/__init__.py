@@ -78,6 +78,14 @@ class FakeOptions:
     folders = []
     max_age = 0
     continuous = False
+    write_batch = None
+    chunk_size = None
+    parallel = None
+    write_latency = None
+    processes = None
+    min_batch_size = None
+    stats_file = None
+    max_batch_size = None
 
 class TestCase(unittest.TestCase):
     def resetRaindrop(self):
@@ -1,8 +1,12 @@
 # The first raindrop unittest!
 
 import re
-from raindrop.tests import TestCaseWithTestDB, FakeOptions
+from raindrop.tests import TestCase, TestCaseWithTestDB, FakeOptions
 from raindrop.model import get_doc_model
+from raindrop.pipeline import get_extension_graph, get_extension_waves
+from raindrop.pipeline import BatchController, BulkJob
+from raindrop.pipeline import make_extension, ExtensionProcessor
+from raindrop.pipeline import ProcessingQueueRunner
 from raindrop.proto import test as test_proto
 
 import logging
@@ -91,6 +95,28 @@ class TestPipeline(TestPipelineBase):
 
         return reprocess(self.test_one_step())
 
+    def test_extension_graph(self):
+        # The queues remember the schemas they emit, so the graph built
+        # next time knows which extensions feed each other.
+        self.process_doc()
+        dm = get_doc_model()
+        exts = self.pipeline.get_extensions()
+        emitted = {}
+        for ext in exts:
+            key = ['key-schema_id', [['ext', ext.id], 'rd.core.workqueue-state']]
+            rows = dm.open_view(key=key, reduce=False, include_docs=True)['rows']
+            if rows:
+                emitted[ext.id] = rows[0]['doc'].get('emitted_schemas', [])
+        self.failUnless('rd.msg.email' in emitted['rd.ext.core.msg-rfc-to-email'])
+        graph = get_extension_graph(exts, emitted)
+        self.failUnlessEqual(graph['rd.ext.core.msg-email-to-body'],
+                             set(['rd.ext.core.msg-rfc-to-email']))
+        waves = get_extension_waves(graph)
+        ids = [ext_id for wave in waves for ext_id in wave]
+        self.failUnless(ids.index('rd.ext.core.msg-rfc-to-email') <
+                        ids.index('rd.ext.core.msg-email-to-body'))
+
+
 class TestErrors(TestPipelineBase):
     extensions = ['rd.test.core.test_converter']
 
@@ -151,3 +177,113 @@ class TestErrors(TestPipelineBase):
         doc = self.process_doc(1)
         seq = self.get_last_by_seq(2)
         return check_last_doc(seq)
+
+
+class TestBulkJob(TestCaseWithTestDB):
+    def test_empty_view_twice(self):
+        view_args = {'key': ['schema_id', 'rd.test.no-such-schema'],
+                     'reduce': False}
+        chunks = []
+        # the state doc doesn't change after the first run.
+        for i in range(3):
+            job = BulkJob(self.doc_model, 'test-empty', view_args, 10)
+            self.failUnlessEqual(job.run(chunks.append), 0)
+        self.failUnlessEqual(chunks, [])
+
+
+class TestConcurrentExtension(TestCaseWithTestDB):
+    # Each document notes how many documents it saw had been processed.
+    querying_code = """
+def handler(doc):
+    result = open_view(key=['schema_id', 'rd.test.seen-count'], reduce=False)
+    emit_schema('rd.test.seen-count', {'count': len(result['rows'])})
+"""
+    other_key_code = """
+def handler(doc):
+    emit_schema('rd.test.other-key', {'field': 'value'},
+                rd_key=['test', doc['rd_key'][1] + '.other'])
+"""
+
+    def run_extension(self, code, num=10):
+        dm = self.doc_model
+        ext = make_extension({'rd_key': ['ext', 'rd.test.concurrent'],
+                              'code': code,
+                              'content_type': 'application/x-python',
+                              'source_schemas': ['rd.test.concurrent-src'],
+                              'concurrency': 4,
+                              })
+        items = [{'rd_key': ['test', 'test.%d' % i],
+                  'rd_schema_id': 'rd.test.concurrent-src',
+                  'rd_ext_id': 'rd.testsuite',
+                  'rd_source': None,
+                  'items': {'field': 'value'},
+                  } for i in range(num)]
+        infos = dm.create_schema_items(items)
+        processor = ExtensionProcessor(dm, ext, self.get_options())
+        runner = ProcessingQueueRunner(dm, processor, 'rd.test.concurrent')
+        try:
+            runner.process_queue((info['id'], info['rev'], None, None)
+                                 for info in infos)
+        finally:
+            runner.close()
+        return processor, runner
+
+    def test_queries_see_earlier_writes(self):
+        processor, runner = self.run_extension(self.querying_code)
+        rows = self.doc_model.open_view(
+                            key=['schema_id', 'rd.test.seen-count'],
+                            reduce=False, include_docs=True)['rows']
+        counts = dict((row['doc']['rd_key'][1], row['doc']['count'])
+                      for row in rows)
+        self.failUnlessEqual(counts,
+                             dict(('test.%d' % i, i) for i in range(10)))
+        # and nothing was processed twice.
+        self.failUnlessEqual(processor.stats.counters['processed'], 10)
+        self.failUnless(runner._serial)
+
+    def test_other_keys_stay_concurrent(self):
+        # writing items for other keys doesn't mean the extension queries.
+        processor, runner = self.run_extension(self.other_key_code)
+        self.failUnlessEqual(processor.stats.counters['processed'], 10)
+        self.failIf(runner._serial)
+
+
+class TestBatchController(TestCase):
+    def test_grows_when_fast(self):
+        c = BatchController()
+        size = c.batch_size
+        c.note_changes(size)
+        c.note_ext(c.TARGET_BATCH_TIME / 10)
+        c.end_batch()
+        self.failUnlessEqual(c.batch_size, size * 2)
+        self.failIf(c.reported)
+
+    def test_shrinks_when_slow(self):
+        c = BatchController(max_batch=1000)
+        self.failUnlessEqual(c.batch_size, 1000)
+        c.note_changes(1000)
+        c.note_ext(c.TARGET_BATCH_TIME * 10)
+        c.end_batch()
+        self.failUnlessEqual(c.batch_size, 500)
+
+    def test_partial_batch_unchanged(self):
+        c = BatchController()
+        size = c.batch_size
+        c.note_changes(10)
+        c.note_ext(c.TARGET_BATCH_TIME * 10)
+        c.end_batch()
+        self.failUnlessEqual(c.batch_size, size)
+
+    def test_flush_size(self):
+        c = BatchController()
+        flush = c.flush_size
+        c.note_items(100)
+        c.note_conflicts(50)
+        c.end_batch()
+        self.failUnless(c.flush_size < flush)
+        flush = c.flush_size
+        c.note_items(100)
+        c.note_ext(1)
+        c.note_write(1)
+        c.end_batch()
+        self.failUnless(c.flush_size > flush)
@@ -1,6 +1,7 @@
 from __future__ import with_statement
 import sys
 import types
+import unittest
 import threading
 import re
 import errno
@@ -8,6 +9,7 @@ import socket
 import SocketServer
 import imaplib
 import email
+import base64
 import rfc822
 import time
 from pprint import pformat
@@ -81,15 +83,48 @@ def collapseNestedLists(items):
             pieces.extend([' ', '(%s)' % (collapseNestedLists(i),)])
     return ''.join(pieces[1:])
 
+def getBodyStructure(msg):
+    if msg.is_multipart():
+        parts = [getBodyStructure(sub) for sub in msg.get_payload()]
+        return parts + [msg.get_content_subtype().upper(),
+                        ['BOUNDARY', msg.get_boundary()]]
+    params = []
+    for name, val in msg.get_params()[1:]:
+        params.extend([name.upper(), val])
+    body = msg.get_payload()
+    encoding = msg.get('content-transfer-encoding', '7bit').upper()
+    ret = [msg.get_content_maintype().upper(), msg.get_content_subtype().upper(),
+           params or None, None, None, encoding, len(body)]
+    if msg.get_content_maintype() == 'text':
+        ret.append(body.count('\n'))
+    return ret
+
 class IMAPMessage:
     def __init__(self, uid, flags, msg_src):
         self.uid = uid
         self.flags = flags
         self.body = msg_src
         self.headers = email.message_from_string(msg_src)
+        # the CONDSTORE 'mod-sequence' of the last change to the message.
+        self.modseq = 1
 
     def get_internal_date(self):
         return self.headers['date']
+
+    def get_section(self, section):
+        # Only the section specifiers raindrop uses are supported.
+        if section == 'HEADER':
+            return self.body[:self.body.index('\n\n') + 2]
+        part_id = section
+        mime = section.endswith('.MIME')
+        if mime:
+            part_id = section[:-len('.MIME')]
+        part = self.headers
+        for num in part_id.split('.'):
+            part = part.get_payload()[int(num) - 1]
+        if mime:
+            return ''.join('%s: %s\r\n' % item for item in part.items()) + '\r\n'
+        return part.get_payload()
         
 class IMAPMailbox:
     def __init__(self, name, delim, flags=None, messages=None):
@@ -97,6 +132,11 @@ class IMAPMailbox:
         self.delim = delim
         self.flags = flags or []
         self.messages = messages or []
+        self.highest_modseq = 1
+        # (uid, modseq) of removed messages, for QRESYNC's VANISHED.
+        self.vanished = []
+        # handlers of connections which are in IDLE on this mailbox.
+        self.idlers = []
 
     def get_message_count(self):
         return len(self.messages)
@@ -107,26 +147,42 @@ class IMAPMailbox:
     def get_uid_validity(self):
         return 1
 
+    def _next_modseq(self):
+        self.highest_modseq += 1
+        return self.highest_modseq
+
     def add_flags(self, msg, flags):
         for flag in flags:
             if flag=='\\Deleted':
-                self.messages.remove(msg)
+                self.expunge(msg)
                 return
             else:
                 if flag not in msg.flags:
                     msg.flags.append(flag)
+                    msg.modseq = self._next_modseq()
+
+    def add_message(self, msg):
+        msg.modseq = self._next_modseq()
+        self.messages.append(msg)
+        for handler in self.idlers:
+            handler.send_untagged_response('%d EXISTS' % len(self.messages))
+
+    def expunge(self, msg):
+        self.messages.remove(msg)
+        self.vanished.append((msg.uid, self._next_modseq()))
 
 class IMAPServer:
     _username = None
     _password = None
-    def __init__(self):
+    def __init__(self, capabilities=()):
         self.mailboxes = []
+        self.capabilities = ['IMAP4rev1'] + list(capabilities)
 
     def get_ident(self):
         return "Test IMAP Server"
 
     def list_capabilities(self):
-        return ['IMAP4rev1']
+        return self.capabilities
 
     def login(self, username, password):
         return username == self._username and password == self._password
@@ -150,6 +206,7 @@ class IMAPSocketServer(SocketServer.ThreadingTCPServer):
 
 class IMAPHandler(SocketServer.StreamRequestHandler):
     current_mbox = None
+    qresync_enabled = False
     def __init__(self, request, client_address, server, imap):
         self.imap = imap
         self._queued_async = []
@@ -236,6 +293,30 @@ class IMAPHandler(SocketServer.StreamRequestHandler):
                 self.send_bad_response(message="Server Failed: %s" % exc)
                 break
 
+    def handle_enable(self, tag, rest, uid):
+        enabled = []
+        for cap in rest.split():
+            if cap == 'QRESYNC' and cap in self.imap.list_capabilities():
+                self.qresync_enabled = True
+                enabled.append(cap)
+        self.send_untagged_response('ENABLED ' + ' '.join(enabled))
+        self.send_positive_response(tag, 'ENABLE completed')
+
+    def handle_idle(self, tag, rest, uid):
+        if 'IDLE' not in self.imap.list_capabilities():
+            self.send_bad_response(tag, 'unknown command IDLE')
+            return
+        mbox = self.current_mbox
+        mbox.idlers.append(self)
+        self.send_line('+ idling')
+        try:
+            line = self.rfile.readline()
+        finally:
+            mbox.idlers.remove(self)
+        if line.strip() != 'DONE':
+            return True # socket closed or confused client.
+        self.send_positive_response(tag, 'IDLE terminated')
+
     def handle_capability(self, tag, rest, uid):
         self.send_untagged_response('CAPABILITY ' + ' '.join(self.imap.list_capabilities()))
         self.send_positive_response(tag, 'CAPABILITY completed')
@@ -312,6 +393,8 @@ class IMAPHandler(SocketServer.StreamRequestHandler):
                 self.send_untagged_response(str(mbox.get_recent_count()) + ' RECENT')
                 self.send_untagged_response('FLAGS (%s)' % ' '.join(mbox.flags))
                 self.send_positive_response(None, '[UIDVALIDITY %d]' % mbox.get_uid_validity())
+                if 'CONDSTORE' in self.imap.list_capabilities():
+                    self.send_positive_response(None, '[HIGHESTMODSEQ %d]' % mbox.highest_modseq)
                 self.send_positive_response(tag, '%s worked' % cmdname)
                 break
         else:
@@ -332,22 +415,38 @@ class IMAPHandler(SocketServer.StreamRequestHandler):
                     first = 1 if first=="*" else int(first)
                     second = 1000000 if second=="*" else int(second)
                 else:
-                    first = second = item
+                    first = second = int(item)
                 check = msg.uid if uid else seq
                 if check >= first and check <= second:
                     # yay - matches.
                     yield seq, msg
 
     def handle_fetch(self, tag, rest, uid):
-        spec, flags = parse_response([rest])
+        self.server.testcase.fetch_requests.append(rest.strip())
+        args = parse_response([rest])
+        spec, flags = args[:2]
+        modifiers = list(args[2]) if len(args) > 2 else []
+        changed_since = None
+        if 'CHANGEDSINCE' in modifiers:
+            changed_since = modifiers[modifiers.index('CHANGEDSINCE') + 1]
+        if 'VANISHED' in modifiers:
+            assert self.qresync_enabled and changed_since is not None
+            uids = [str(vuid) for vuid, modseq in self.current_mbox.vanished
+                    if modseq > changed_since]
+            if uids:
+                self.send_untagged_response('VANISHED (EARLIER) ' + ','.join(uids))
         for seq, msg in self._get_matching_messages(spec, uid):
-            self._spew_message(seq, msg, flags, uid)
+            if changed_since is not None and msg.modseq <= changed_since:
+                continue
+            self._spew_message(seq, msg, flags, uid, changed_since is not None)
         self.send_positive_response(tag, "FETCH worked")
 
-    def _spew_message(self, id, msg, flags, uid):
+    def _spew_message(self, id, msg, flags, uid, modseq=False):
         bits = []
         if uid:
             bits.append('UID %s' % msg.uid)
+        if modseq:
+            bits.append('MODSEQ (%d)' % msg.modseq)
         for flag in flags:
             if flag == 'FLAGS':
                 bits.append('FLAGS (%s)' % ' '.join(msg.flags))
@@ -370,13 +469,26 @@ class IMAPHandler(SocketServer.StreamRequestHandler):
                 bits.append('ENVELOPE ' + collapseNestedLists([getEnvelope(msg.headers)]))
             elif flag == 'BODY.PEEK[]':
                 bits.append('BODY[] ' + _literal(msg.body))
+            elif flag == 'BODYSTRUCTURE':
+                bits.append('BODYSTRUCTURE ' +
+                            collapseNestedLists([getBodyStructure(msg.headers)]))
+            elif flag.startswith('BODY.PEEK[') and flag.endswith(']'):
+                section = flag[len('BODY.PEEK['):-1]
+                bits.append('BODY[%s] %s' % (section,
+                                             _literal(msg.get_section(section))))
             else:
                 raise ValueError("Unsupported flag '%s'" % flag)
         self.send_untagged_response("%d FETCH (%s)" % (id, " ".join(bits)))
 
     def handle_search(self, tag, rest, uid):
-        # todo: return something :)
-        self.send_untagged_response("SEARCH 2")
+        criteria = rest.strip().strip("()").split()
+        if uid and criteria[0] == 'UID':
+            found = [str(msg.uid) for seq, msg in
+                     self._get_matching_messages(criteria[1], uid)]
+            self.send_untagged_response(" ".join(["SEARCH"] + found))
+        else:
+            # todo: return something :)
+            self.send_untagged_response("SEARCH 2")
         self.send_positive_response(tag, "SEARCH completed")
 
     def handle_store(self, tag, rest, uid):
@@ -410,6 +522,7 @@ class IMAP4TestBase(TestCaseWithTestDB):
     num_failed_logins = 0
     num_current_logins = 0
     max_logins = None
+    capabilities = ()
 
     def setUp(self):
         self.old_backoff = raindrop.proto.imap.IMAPAccount.def_retry_backoff
@@ -419,7 +532,8 @@ class IMAP4TestBase(TestCaseWithTestDB):
         self.old_timeout = raindrop.proto.imap.IMAPAccount.def_timeout_response
         raindrop.proto.imap.IMAPAccount.def_timeout_response = 0.25
 
-        self.imap_server = IMAPServer()
+        self.imap_server = IMAPServer(self.capabilities)
+        self.fetch_requests = []
         self.imap_server._username = 'test_raindrop@test.mozillamessaging.com'
         self.imap_server._password = 'topsecret'
 
@@ -694,3 +808,294 @@ class TestSimpleMailboxes(IMAP4TestBase):
         self.failUnlessEqual(len(rows), 1, pformat(rows))
         locations = rows[0]['doc']['locations']
         self.failUnlessEqual(len(locations), 1, pformat(rows[0]['doc']))
+
+
+test_message_src_2 = test_message_src.replace("1234@somewhere", "5678@somewhere")
+
+class MailboxCacheTestBase(IMAP4TestBase):
+    # A folder with messages in 2 cache segments.
+    mailboxes = ["foo"]
+    def setUp(self):
+        IMAP4TestBase.setUp(self)
+        # a second message in a later cache segment.
+        uid = raindrop.proto.imap.CACHE_SEGMENT_SIZE * 2 + 1
+        self.imap_server.mailboxes[0].messages.append(
+                    IMAPMessage(uid, [], test_message_src_2))
+
+    def get_cache_docs(self):
+        key = ["schema_id", "rd.imap.mailbox-cache"]
+        result = self.doc_model.open_view(key=key, reduce=False,
+                                          include_docs=True)
+        headers = [row['doc'] for row in result['rows']]
+        key = ["schema_id", "rd.imap.mailbox-cache-segment"]
+        result = self.doc_model.open_view(key=key, reduce=False,
+                                          include_docs=True)
+        segments = dict((row['doc']['rd_key'][1][2], row['doc'])
+                        for row in result['rows'])
+        return headers, segments
+
+
+class TestMailboxCache(MailboxCacheTestBase):
+    def test_segments(self):
+        cond = self.get_conductor()
+        cond.sync(self.pipeline.options, wait=True)
+        headers, segments = self.get_cache_docs()
+        self.failUnlessEqual(len(headers), 1, pformat(headers))
+        self.failIf('infos' in headers[0], pformat(headers[0]))
+        uid = raindrop.proto.imap.CACHE_SEGMENT_SIZE * 2 + 1
+        self.failUnlessEqual(headers[0]['uidnext'], uid + 1)
+        self.failUnlessEqual(sorted(segments), [0, 2])
+        self.failUnlessEqual([i['UID'] for i in segments[2]['infos']], [uid])
+        # change the flags of the second message - only its segment should
+        # be rewritten.
+        mbox = self.imap_server.mailboxes[0]
+        mbox.add_flags(mbox.messages[1], ['\\Seen'])
+        cond.sync(self.pipeline.options, wait=True)
+        new_headers, new_segments = self.get_cache_docs()
+        self.failUnlessEqual(new_headers[0]['_rev'], headers[0]['_rev'])
+        self.failUnlessEqual(new_segments[0]['_rev'], segments[0]['_rev'])
+        self.failIfEqual(new_segments[2]['_rev'], segments[2]['_rev'])
+        self.failUnlessEqual(new_segments[2]['infos'][0]['FLAGS'], ['\\Seen'])
+
+    def test_duplicates(self):
+        # a message with the same ID as the one in the first segment.
+        uid = raindrop.proto.imap.CACHE_SEGMENT_SIZE * 2 + 2
+        mbox = self.imap_server.mailboxes[0]
+        mbox.messages.append(IMAPMessage(uid, [], test_message_src))
+        cond = self.get_conductor()
+        cond.sync(self.pipeline.options, wait=True)
+        headers, segments = self.get_cache_docs()
+        self.failUnlessEqual(segments[0]['duplicate_uids'], [])
+        self.failUnlessEqual(segments[2]['duplicate_uids'], [uid])
+        # once the original goes, the later one is no longer a duplicate.
+        mbox.expunge(mbox.messages[0])
+        cond.sync(self.pipeline.options, wait=True)
+        headers, segments = self.get_cache_docs()
+        self.failUnlessEqual(segments[2]['duplicate_uids'], [])
+
+
+class TestFetchLimits(MailboxCacheTestBase):
+    def make_config(self):
+        config = MailboxCacheTestBase.make_config(self)
+        config.accounts['test']['max_messages_per_fetch'] = 1
+        return config
+
+    def test_fetch_limits(self):
+        cond = self.get_conductor()
+        cond.sync(self.pipeline.options, wait=True)
+        fetches = [r for r in self.fetch_requests if 'BODY.PEEK[]' in r]
+        self.failUnlessEqual(len(fetches), 2, fetches)
+
+
+test_attachment_data = "".join(chr(i % 256) for i in range(3000))
+
+test_message_src_attach = """\
+From: someone@somewhere
+To: someone@somewhere
+Date: Wed, 6 Jan 2010 19:33:19 -0500
+Message-ID: <1236@somewhere>
+Content-Type: multipart/mixed; boundary="xxxx"
+
+--xxxx
+Content-Type: text/plain
+
+Hello there
+--xxxx
+Content-Type: image/png; name="hello.png"
+Content-Disposition: attachment; filename="hello.png"
+Content-Transfer-Encoding: base64
+
+%s
+--xxxx--
+""" % (base64.encodestring(test_attachment_data).strip(),)
+
+class TestLazyAttachments(IMAP4TestBase):
+    mailboxes = ["foo"]
+    def setUp(self):
+        IMAP4TestBase.setUp(self)
+        self.imap_server.mailboxes[0].messages.append(
+                    IMAPMessage(3, [], test_message_src_attach))
+
+    def make_config(self):
+        config = IMAP4TestBase.make_config(self)
+        config.accounts['test']['lazy_attachments'] = True
+        config.accounts['test']['lazy_attachment_size'] = 1000
+        return config
+
+    def test_lazy(self):
+        cond = self.get_conductor()
+        cond.sync(self.pipeline.options, wait=True)
+        self.ensure_pipeline_complete()
+        # the attachment itself was never fetched.
+        self.failIf([r for r in self.fetch_requests if 'BODY.PEEK[2]' in r],
+                    self.fetch_requests)
+        key = ["key-schema_id", [["email", "1236@somewhere"], "rd.msg.email"]]
+        result = self.doc_model.open_view(key=key, reduce=False,
+                                          include_docs=True)
+        self.failUnlessEqual(len(result['rows']), 1, pformat(result))
+        doc = result['rows'][0]['doc']
+        blobs = doc.get('rd_blobs', {})
+        self.failUnlessEqual(blobs.keys(), ['rd.ext.core.msg-rfc-to-email/hello.png'])
+        ref = blobs.values()[0]
+        self.failUnlessEqual(ref['remote']['part'], '2')
+        # opening it goes back to the server.
+        got = self.doc_model.open_schema_attachment(doc, 'hello.png')
+        self.failUnlessEqual(got, test_attachment_data)
+        self.failUnless([r for r in self.fetch_requests if 'BODY.PEEK[2]' in r],
+                        self.fetch_requests)
+
+
+class TestUIDRanges(unittest.TestCase):
+    def test_in_ranges(self):
+        ranges = raindrop.proto.imap.parse_uid_set("20:30,1:3,5,4,25:40")
+        got = raindrop.proto.imap.get_uids_in_ranges(range(0, 50), ranges)
+        self.failUnlessEqual(sorted(got), range(1, 6) + range(20, 41))
+        self.failUnlessEqual(raindrop.proto.imap.get_uids_in_ranges([1, 2], []),
+                             set())
+
+
+class TestQuoting(unittest.TestCase):
+    def test_quote(self):
+        quote = raindrop.proto.imap.quote_imap_string
+        self.failUnlessEqual(quote('<foo@bar>'), '"<foo@bar>"')
+        self.failUnlessEqual(quote('a"b\\c'), '"a\\"b\\\\c"')
+
+
+class TestFetchSizer(unittest.TestCase):
+    def test_grows(self):
+        sizer = raindrop.proto.imap.FetchSizer()
+        num_messages, num_bytes = sizer.get_limits()
+        # a quick fetch which hit the message limit - it should grow.
+        sizer.fetched(num_messages, 1000, 0.1)
+        self.failUnless(sizer.get_limits()[0] > num_messages)
+        # but never beyond the max.
+        for i in range(20):
+            sizer.fetched(sizer.num_messages, 1000, 0.1)
+        self.failUnlessEqual(sizer.get_limits()[0], sizer.max_messages)
+
+    def test_ran_out(self):
+        sizer = raindrop.proto.imap.FetchSizer()
+        limits = sizer.get_limits()
+        # a quick fetch which hit neither limit tells us nothing.
+        sizer.fetched(1, 1000, 0.01)
+        self.failUnlessEqual(sizer.get_limits(), limits)
+
+    def test_shrinks(self):
+        sizer = raindrop.proto.imap.FetchSizer()
+        sizer.fetched(1, 1000, 0.1) # the round-trip
+        num_messages, num_bytes = sizer.get_limits()
+        sizer.fetched(num_messages, num_bytes, 60)
+        new_messages, new_bytes = sizer.get_limits()
+        self.failUnless(new_messages < num_messages)
+        self.failUnless(new_bytes < num_bytes)
+        # a single huge message still gets fetched.
+        for i in range(20):
+            sizer.fetched(1, 10000000, 60)
+        self.failUnlessEqual(sizer.get_limits(),
+                             (1, raindrop.proto.imap.MIN_BYTES_PER_FETCH))
+
+    def test_slow_server(self):
+        # if the round-trip alone takes longer than our target we should
+        # fetch more at once, not less.
+        sizer = raindrop.proto.imap.FetchSizer()
+        num_messages, num_bytes = sizer.get_limits()
+        sizer.fetched(num_messages, 1000, raindrop.proto.imap.TARGET_FETCH_TIME * 2)
+        self.failUnless(sizer.get_limits()[0] > num_messages)
+
+    def test_account_limits(self):
+        sizer = raindrop.proto.imap.FetchSizer(max_bytes=100000, max_messages=5)
+        self.failUnlessEqual(sizer.get_limits(), (5, 100000))
+
+
+class TestCondstore(MailboxCacheTestBase):
+    capabilities = ['CONDSTORE']
+
+    def get_flag_fetches(self):
+        return [r for r in self.fetch_requests if r.endswith('(FLAGS)') or
+                'CHANGEDSINCE' in r]
+
+    def test_incremental(self):
+        cond = self.get_conductor()
+        cond.sync(self.pipeline.options, wait=True)
+        headers, segments = self.get_cache_docs()
+        mbox = self.imap_server.mailboxes[0]
+        self.failUnlessEqual(headers[0]['highestmodseq'], mbox.highest_modseq)
+        # change the flags of one message and remove the other.
+        mbox.add_flags(mbox.messages[1], ['\\Seen'])
+        mbox.expunge(mbox.messages[0])
+        del self.fetch_requests[:]
+        cond.sync(self.pipeline.options, wait=True)
+        # only the changed flags should have been fetched.
+        fetches = self.get_flag_fetches()
+        self.failUnlessEqual(len(fetches), 1, fetches)
+        self.failUnless('CHANGEDSINCE' in fetches[0], fetches)
+        headers, segments = self.get_cache_docs()
+        self.failUnlessEqual(headers[0]['highestmodseq'], mbox.highest_modseq)
+        self.failUnlessEqual(segments[0]['infos'], [])
+        self.failUnlessEqual(segments[2]['infos'][0]['FLAGS'], ['\\Seen'])
+        # and with nothing changed, nothing is rewritten.
+        cond.sync(self.pipeline.options, wait=True)
+        new_headers, new_segments = self.get_cache_docs()
+        self.failUnlessEqual(new_headers[0]['_rev'], headers[0]['_rev'])
+        self.failUnlessEqual(new_segments[2]['_rev'], segments[2]['_rev'])
+        return fetches
+
+
+class TestQResync(TestCondstore):
+    capabilities = ['CONDSTORE', 'QRESYNC']
+
+    def test_incremental(self):
+        fetches = TestCondstore.test_incremental(self)
+        self.failUnless('VANISHED' in fetches[0], fetches)
+        # the last sync saw an unchanged modseq so didn't fetch flags at all.
+        self.failUnlessEqual(len(self.get_flag_fetches()), 1)
+
+
+class TestIdle(IMAP4TestBase):
+    mailboxes = ["INBOX", "foo"]
+    capabilities = ['IDLE']
+
+    def setUp(self):
+        self.old_idle_interval = raindrop.proto.imap.IDLE_CHECK_INTERVAL
+        raindrop.proto.imap.IDLE_CHECK_INTERVAL = 0.25
+        IMAP4TestBase.setUp(self)
+
+    def tearDown(self):
+        raindrop.proto.imap.IDLE_CHECK_INTERVAL = self.old_idle_interval
+        IMAP4TestBase.tearDown(self)
+
+    def make_config(self):
+        config = IMAP4TestBase.make_config(self)
+        config.accounts['test']['idle'] = True
+        return config
+
+    def wait_for(self, check, what):
+        for i in range(100):
+            result = check()
+            if result:
+                return result
+            time.sleep(0.1)
+        self.fail("timed out waiting for " + what)
+
+    def get_locations(self, msgid):
+        si = self.doc_model.open_schemas([(['email', msgid],
+                                           'rd.msg.imap-locations')])[0]
+        return si and si['locations']
+
+    def test_idle(self):
+        cond = self.get_conductor()
+        cond.sync(self.pipeline.options)
+        try:
+            inbox, foo = self.imap_server.mailboxes
+            # once the first sync is done we idle on just the inbox.
+            self.wait_for(lambda: inbox.idlers, "the inbox to idle")
+            self.failIf(foo.idlers)
+            inbox.add_message(IMAPMessage(3, [], test_message_src_2))
+            # the new message should arrive without another sync.
+            locations = self.wait_for(lambda: self.get_locations("5678@somewhere"),
+                                      "the new message")
+            self.failUnlessEqual([l['folder_name'] for l in locations],
+                                 ["INBOX"], pformat(locations))
+        finally:
+            cond.wait_for_sync()
+        self.failIf(inbox.idlers)
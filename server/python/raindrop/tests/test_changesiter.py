@@ -0,0 +1,37 @@
+from raindrop.tests import TestCaseWithTestDB
+from raindrop.changesiter import ChangesIterFactory
+
+
+class TestSchemaFilter(TestCaseWithTestDB):
+    def _make_item(self, name, schema_id):
+        return {'rd_key' : ['test', name],
+                'rd_schema_id': schema_id,
+                'rd_ext_id' : 'rd.testsuite',
+                'rd_source': None,
+                'items': {'field' : 'value'},
+                }
+
+    def test_filtered_feed(self):
+        dm = self.doc_model
+        wanted = 'rd.test.wanted'
+        info = dm.create_schema_items([self._make_item('deleted', wanted)])[0]
+        start_seq = dm.db.infoDB()['update_seq']
+        doc = dm.open_documents_by_id([info['id']])[0]
+        dm.delete_documents([doc])
+        other = dm.create_schema_items([self._make_item('other',
+                                                        'rd.test.other')])[0]
+        last = dm.create_schema_items([self._make_item('last', wanted)])[0]
+
+        feed = ChangesIterFactory()
+        feed.initialize(dm, start_seq, filter_schemas=[wanted])
+        try:
+            changes = []
+            while not changes or changes[-1]['id'] != last['id']:
+                changes.append(feed._get_next_change(True))
+        finally:
+            feed.connection.close()
+        # deletions have no schema, but the queues must still see them.
+        self.failUnlessEqual([c['id'] for c in changes],
+                             [info['id'], last['id']])
+        self.failUnless(changes[0].get('deleted'))
+        self.failIf(other['id'] in [c['id'] for c in changes])
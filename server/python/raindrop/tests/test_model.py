@@ -1,6 +1,7 @@
 # test of the back-end's document-model.
 from raindrop.tests import TestCaseWithTestDB, FakeOptions
 from raindrop.model import get_doc_model
+from cStringIO import StringIO
 
 class TestSchemas(TestCaseWithTestDB):
     def _make_test_schema_item(self, attach_data="hello\0there"):
@@ -150,6 +151,160 @@ class TestSchemas(TestCaseWithTestDB):
         doc = self.doc_model.open_documents_by_id([info['id']])[0]
         self.failUnlessEqual(doc, None)
 
+    def test_iter_view(self):
+        sis = []
+        for i in range(5):
+            si = self._make_test_schema_item()
+            si['rd_key'] = ['test', 'test.%d' % i]
+            sis.append(si)
+        infos = self.doc_model.create_schema_items(sis)
+        expected = sorted(info['id'] for info in infos)
+        key = ['schema_id', 'rd.test.whateva']
+        rows = self.doc_model.iter_view(key=key, reduce=False, page_size=2)
+        self.failUnlessEqual([row['id'] for row in rows], expected)
+        keys = [key, ['key', ['test', 'test.1']]]
+        rows = self.doc_model.iter_view(keys=keys, reduce=False, page_size=2)
+        self.failUnlessEqual([row['id'] for row in rows],
+                             expected + [self.doc_model.get_doc_id_for_schema_item(sis[1])])
+
+    def test_doc_cache(self):
+        dm = self.doc_model
+        si = self._make_test_schema_item()
+        did = dm.create_schema_items([si])[0]['id']
+        dm.start_doc_cache()
+        try:
+            doc = dm.open_documents_by_id([did])[0]
+            doc['field'] = 'new value'
+            # a cached copy isn't changed by the caller.
+            doc2 = dm.open_documents_by_id([did])[0]
+            self.failUnlessEqual(doc2['field'], 'value')
+            self.failUnlessEqual((dm.doc_cache.hits, dm.doc_cache.misses),
+                                 (1, 1))
+            # writing the doc ourselves must drop it from the cache.
+            dm.update_documents([doc])
+            doc3 = dm.open_documents_by_id([did])[0]
+            self.failUnlessEqual(doc3['field'], 'new value')
+            self.failUnlessEqual(dm.doc_cache.misses, 2)
+        finally:
+            dm.stop_doc_cache()
+
+    def test_doc_cache_read_during_write(self):
+        # A reader which fetches the doc while our write is in flight must
+        # not leave the old revision in the cache.
+        dm = self.doc_model
+        si = self._make_test_schema_item()
+        did = dm.create_schema_items([si])[0]['id']
+        dm.start_doc_cache()
+        real_update = dm.db.updateDocuments
+        seen = []
+        def update_with_read(docs):
+            # the read sees (and caches) the doc as it was.
+            seen.append(dm.open_documents_by_id([did])[0]['field'])
+            return real_update(docs)
+        try:
+            doc = dm.open_documents_by_id([did])[0]
+            doc['field'] = 'new value'
+            dm.db.updateDocuments = update_with_read
+            try:
+                dm.update_documents([doc])
+            finally:
+                dm.db.updateDocuments = real_update
+            doc = dm.open_documents_by_id([did])[0]
+            self.failUnlessEqual(doc['field'], 'new value')
+            # and the same for deletes.
+            dm.db.updateDocuments = update_with_read
+            try:
+                dm.delete_documents([doc])
+            finally:
+                dm.db.updateDocuments = real_update
+            self.failUnlessEqual(dm.open_documents_by_id([did]), [None])
+            self.failUnlessEqual(seen, ['value', 'new value'])
+        finally:
+            dm.stop_doc_cache()
+
+    def test_dep_index(self):
+        dm = self.doc_model
+        src = self._make_test_schema_item()
+        src_info = dm.create_schema_items([src])[0]
+        dep = (['test', 'test.2'], 'rd.test.other')
+        dep_id = dm.get_doc_id_for_dep(dep)
+        def make_dependent(rd_key):
+            return {'rd_key' : rd_key,
+                    'rd_schema_id': 'rd.test.dependent',
+                    'rd_ext_id' : 'rd.testsuite',
+                    'rd_source': [src_info['id'], src_info['rev']],
+                    'items': {'field' : 'value'},
+                    'rd_deps': [dep],
+                    }
+        dm.create_schema_items([make_dependent(['test', 'test.3'])])
+        self.failUnlessEqual(dm.get_dependent_sources([dep_id]),
+                             {dep_id: [src_info['id']]})
+        dm.start_dep_index()
+        try:
+            other_id = dm.get_doc_id_for_dep((['test', 'test.3'], 'rd.test.other'))
+            got = dm.get_dependent_sources([dep_id, other_id])
+            self.failUnlessEqual(got, {dep_id: [src_info['id']], other_id: []})
+            got = dm.get_dependent_sources([dep_id, other_id])
+            self.failUnlessEqual((dm.dep_index.hits, dm.dep_index.misses),
+                                 (2, 2))
+            # writing a new dependency on the doc must drop what we know.
+            dm.create_schema_items([make_dependent(['test', 'test.4'])])
+            got = dm.get_dependent_sources([dep_id])
+            self.failUnlessEqual(got, {dep_id: [src_info['id']] * 2})
+            self.failUnlessEqual(dm.dep_index.misses, 3)
+        finally:
+            dm.stop_dep_index()
+
+    def test_dep_index_existing_items(self):
+        # Items written before the 'source_by_dep' view existed hold only
+        # their rd_deps, and must still be found.
+        dm = self.doc_model
+        src_info = dm.create_schema_items([self._make_test_schema_item()])[0]
+        dep = [['test', 'test.2'], 'rd.test.other']
+        dep_id = dm.get_doc_id_for_dep(dep)
+        rd_key = ['test', 'test.3']
+        doc = {'_id': dm.get_doc_id_for_schema_item(
+                            {'rd_key': rd_key,
+                             'rd_schema_id': 'rd.test.dependent'}),
+               'rd_key': rd_key,
+               'rd_schema_id': 'rd.test.dependent',
+               'rd_schema_items': {
+                    'rd.testsuite': {'rd_source': [src_info['id'],
+                                                   src_info['rev']],
+                                     'rd_deps': [dep]}},
+               'field': 'value',
+               }
+        dm.update_documents([doc])
+        self.failUnlessEqual(dm.get_dependent_sources([dep_id]),
+                             {dep_id: [src_info['id']]})
+
+    def test_buffered_items_same_doc(self):
+        # 2 writers queueing items for the same doc via the write buffer
+        # should end up with a single doc holding both.
+        si = self._make_test_schema_item()
+        si2 = si.copy()
+        si2['rd_ext_id'] = 'rd.testsuite.2'
+        si2['items'] = {'field2': 'value2'}
+        si2['attachments'] = None
+        dm = self.doc_model
+        dm.start_write_buffer(max_latency=60, max_batch=10)
+        try:
+            p1 = dm.queue_schema_items([si])
+            p2 = dm.queue_schema_items([si2])
+            # neither should have been written yet...
+            self.failIf(p1.done.isSet() or p2.done.isSet())
+            dm.flush_schema_items([p1])
+            self.failUnless(p1.done.isSet() and p2.done.isSet())
+            dm.flush_schema_items([p2])
+        finally:
+            dm.stop_write_buffer()
+        did = dm.get_doc_id_for_schema_item(si)
+        doc = dm.open_documents_by_id([did])[0]
+        self.failUnlessEqual(sorted(doc['rd_schema_items'].keys()),
+                             ['rd.testsuite', 'rd.testsuite.2'])
+        # and it was written in 1 hit.
+        self.failUnless(doc['_rev'].startswith('1-'), doc['_rev'])
+
 
 class TestAttachments(TestCaseWithTestDB):
     def _check_rev_last(self, id, rev, attach_data):
@@ -203,3 +358,84 @@ class TestAttachments(TestCaseWithTestDB):
     def test_update_docs_large(self, attach_data='foo\0bar'):
         data = '\0' * (self.doc_model.MAX_INLINE_ATTACH_SIZE+10)
         self.test_update_docs_small(data)
+
+    def test_create_schema_items_streamed(self):
+        # a file-like object as the attachment data is streamed to the couch,
+        # and we can stream it back out again.
+        attach_data = 'foo\0bar' * 10000
+        si = self._make_test_schema_item(StringIO(attach_data))
+        ret = self.doc_model.create_schema_items([si])
+        self._check_rev_last(ret[0]['id'], ret[0]['rev'], attach_data)
+        reader = self.doc_model.db.openDoc(ret[0]['id'], stream=True,
+                                           attachment='rd.testsuite/test')
+        self.failUnlessEqual(reader.length, len(attach_data))
+        self.failUnlessEqual(''.join(reader), attach_data)
+
+    def test_create_schema_items_deduped(self):
+        # 2 docs with the same large attachment share a single blob.
+        dm = self.doc_model
+        dm.dedupe_attachments = True
+        attach_data = 'foo\0bar' * dm.MIN_BLOB_SIZE
+        si1 = self._make_test_schema_item(attach_data)
+        si2 = self._make_test_schema_item(attach_data)
+        si2['rd_key'] = ['test', 'test.2']
+        ret = dm.create_schema_items([si1, si2])
+        docs = dm.open_documents_by_id([r['id'] for r in ret])
+        blob_ids = set()
+        for doc in docs:
+            self.failIf('_attachments' in doc, doc)
+            blob_ids.add(doc['rd_blobs']['rd.testsuite/test']['blob_id'])
+            got = dm.open_schema_attachment(doc, 'test')
+            self.failUnlessEqual(len(got), len(attach_data))
+            self.failUnlessEqual(got, attach_data)
+        self.failUnlessEqual(len(blob_ids), 1)
+
+    def test_unreferenced_blobs_deleted(self):
+        # A blob is deleted once no document refers to it, but not while
+        # another document still shares it.
+        dm = self.doc_model
+        dm.dedupe_attachments = True
+        attach_data = 'foo\0bar' * dm.MIN_BLOB_SIZE
+        si1 = self._make_test_schema_item(attach_data)
+        si2 = self._make_test_schema_item(attach_data)
+        si2['rd_key'] = ['test', 'test.2']
+        dm.create_schema_items([si1, si2])
+        did1 = dm.get_doc_id_for_schema_item(si1)
+        doc = dm.open_documents_by_id([did1])[0]
+        shared_id = doc['rd_blobs']['rd.testsuite/test']['blob_id']
+
+        def blob_exists(blob_id):
+            return dm.open_documents_by_id([blob_id])[0] is not None
+
+        # overwriting one doc's attachment keeps the shared blob.
+        si1['attachments']['test']['data'] = 'x' * dm.MIN_BLOB_SIZE
+        dm.create_schema_items([si1])
+        doc = dm.open_documents_by_id([did1])[0]
+        new_id = doc['rd_blobs']['rd.testsuite/test']['blob_id']
+        self.failIfEqual(new_id, shared_id)
+        self.failUnless(blob_exists(shared_id))
+        # overwriting the other drops the last reference.
+        si2['attachments']['test']['data'] = 'y' * dm.MIN_BLOB_SIZE
+        dm.create_schema_items([si2])
+        self.failIf(blob_exists(shared_id))
+        # and deleting a doc deletes the blob only it referenced.
+        self.failUnless(blob_exists(new_id))
+        dm.delete_documents([doc])
+        self.failIf(blob_exists(new_id))
+
+    def test_create_schema_items_many(self):
+        # Attachments are saved inline, even when the docs need to be split
+        # over multiple _bulk_docs requests.
+        self.doc_model.MAX_BULK_ATTACH_SIZE = 100
+        attach_data = 'x' * 60
+        sis = []
+        for i in range(5):
+            si = self._make_test_schema_item(attach_data)
+            si['rd_key'] = ['test', 'test.%d' % i]
+            sis.append(si)
+        ret = self.doc_model.create_schema_items(sis)
+        self.failUnlessEqual(len(ret), 5)
+        for info in ret:
+            # only 1 revision - the attachment wasn't saved separately.
+            self.failUnless(info['rev'].startswith('1-'), info)
+            self._check_rev_last(info['id'], info['rev'], attach_data)
@@ -0,0 +1,36 @@
+import threading
+
+from raindrop.tests import TestCase
+from raindrop import profiler
+
+
+class TestProfiler(TestCase):
+    def test_tagged_samples(self):
+        started = threading.Event()
+        stop = threading.Event()
+        def busy():
+            profiler.set_thread_tag('queue:test')
+            started.set()
+            while not stop.isSet():
+                sum(range(100))
+            profiler.clear_thread_tag()
+        t = threading.Thread(target=busy)
+        t.start()
+        started.wait()
+        prof = profiler.SamplingProfiler(interval=0.001)
+        prof.start()
+        try:
+            while prof.num_samples < 20:
+                stop.wait(0.01)
+        finally:
+            prof.stop()
+            stop.set()
+            t.join()
+        collapsed = prof.get_collapsed()
+        tagged = [stack for stack in collapsed
+                  if stack.startswith('queue:test;')]
+        self.failUnless(tagged, collapsed)
+        for stack in tagged:
+            self.failUnless('busy (test_profiler.py:' in stack, stack)
+        self.failUnless(sum(collapsed.itervalues()) >= 20)
+        self.failIf(profiler.get_thread_tag())
@@ -27,7 +27,8 @@ import httplib
 import base64
 import socket
 import errno
-from collections import deque
+import select
+import threading
 import time
 
 import logging
@@ -55,17 +56,218 @@ class CouchError(Exception):
 class CouchNotFoundError(CouchError):
     pass
 
+class CouchPoolTimeout(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """A pool of HTTP connections to a couch, shared by all threads.
+
+    No more than MAX_SIZE connections (in use or idle) exist at once -
+    threads wanting a connection when all are in use wait up to
+    CHECKOUT_TIMEOUT seconds for one to be returned.  Idle connections are
+    checked before being reused; those idle for more than MAX_IDLE seconds
+    or which the couch has closed are discarded.
+    Connections owned by a streaming AttachmentReader are detached from the
+    pool until the reader is done, so a thread holding a reader can't
+    starve itself (or others) of connections.
+    """
+    MAX_SIZE = 20 # pulled from a hat!
+    CHECKOUT_TIMEOUT = 120 # seconds
+    MAX_IDLE = 60 # seconds
+
+    def __init__(self, host, port, max_size=None, timeout=None):
+        self.host = host
+        self.port = port
+        if max_size is not None:
+            self.MAX_SIZE = max_size
+        if timeout is not None:
+            self.CHECKOUT_TIMEOUT = timeout
+        self._cond = threading.Condition()
+        self._idle = [] # (time_returned, conn), most recent last.
+        self.num_connections = 0 # total in use or idle.
+        # counters.
+        self.num_opened = 0
+        self.num_reused = 0
+        self.num_waited = 0
+        self.num_errored = 0
+
+    def get_stats(self):
+        return {'connections': self.num_connections,
+                'idle': len(self._idle),
+                'opened': self.num_opened,
+                'reused': self.num_reused,
+                'waited': self.num_waited,
+                'errored': self.num_errored,
+                }
+
+    def _is_healthy(self, conn, returned):
+        if time.time() - returned > self.MAX_IDLE:
+            return False
+        if conn.sock is None:
+            return False
+        # An idle connection should have nothing to read - if it is readable
+        # the couch has closed it (or sent garbage.)
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error):
+            return False
+        return not readable
+
+    def checkout(self, fresh=False):
+        """Returns a (connection, reused) tuple.  If fresh is True, a new
+        connection is always made."""
+        deadline = time.time() + self.CHECKOUT_TIMEOUT
+        waited = False
+        self._cond.acquire()
+        try:
+            while True:
+                while self._idle and not fresh:
+                    returned, conn = self._idle.pop()
+                    if self._is_healthy(conn, returned):
+                        self.num_reused += 1
+                        return conn, True
+                    conn.close()
+                    self.num_connections -= 1
+                if fresh and self._idle and \
+                   self.num_connections >= self.MAX_SIZE:
+                    # make room for a new one by closing the oldest.
+                    _, conn = self._idle.pop(0)
+                    conn.close()
+                    self.num_connections -= 1
+                if self.num_connections < self.MAX_SIZE:
+                    self.num_connections += 1
+                    self.num_opened += 1
+                    return httplib.HTTPConnection(self.host, self.port), False
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise CouchPoolTimeout("no connection became available in %s "
+                                           "seconds" % self.CHECKOUT_TIMEOUT)
+                if not waited:
+                    self.num_waited += 1
+                    waited = True
+                self._cond.wait(remaining)
+        finally:
+            self._cond.release()
+
+    def checkin(self, conn, detached=False):
+        """Return a connection which can be reused.  detached should be
+        True if the connection was detached from the pool."""
+        self._cond.acquire()
+        try:
+            if detached:
+                self.num_connections += 1
+            self._idle.append((time.time(), conn))
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def discard(self, conn, errored=False):
+        """Close a connection which can't be reused"""
+        conn.close()
+        self._cond.acquire()
+        try:
+            self.num_connections -= 1
+            if errored:
+                self.num_errored += 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def detach(self, conn):
+        """Stop counting a checked out connection against MAX_SIZE.  It
+        must later be returned via checkin(conn, detached=True) or simply
+        closed."""
+        self._cond.acquire()
+        try:
+            self.num_connections -= 1
+            self._cond.notify()
+        finally:
+            self._cond.release()
+
+    def close_idle(self):
+        self._cond.acquire()
+        try:
+            while self._idle:
+                _, conn = self._idle.pop()
+                conn.close()
+                self.num_connections -= 1
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+
+class AttachmentReader(object):
+    """A file-like object returned when streaming an attachment from the
+    couch.  The connection is handed back to the couch's pool once the
+    response has been completely read, or closed if the reader is closed
+    early.  Until then the connection is detached from the pool."""
+    def __init__(self, couch, conn, response):
+        self.couch = couch
+        couch.pool.detach(conn)
+        self.conn = conn
+        self.response = response
+        self.content_type = response.getheader('content-type')
+        length = response.getheader('content-length')
+        self.length = length and int(length)
+
+    def read(self, size=-1):
+        if self.response is None:
+            return ''
+        if size is None or size < 0:
+            data = self.response.read()
+        else:
+            data = self.response.read(size)
+        if not data or (size < 0):
+            # all done - the connection can be reused.
+            self.couch._release_connection(self.conn, self.response,
+                                           detached=True)
+            self.conn = self.response = None
+        return data
+
+    def __iter__(self):
+        while True:
+            data = self.read(self.couch.STREAM_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+    def close(self):
+        if self.conn is not None:
+            # we can't reuse a connection with unread data.
+            self.conn.close()
+            self.conn = self.response = None
+
+
+def _gen_body_chunks(body, chunk_size):
+    # A 'streaming' body is either a file-like object or an iterable
+    # yielding strings.
+    if hasattr(body, 'read'):
+        while True:
+            data = body.read(chunk_size)
+            if not data:
+                break
+            yield data
+    else:
+        for data in body:
+            if data:
+                yield data
+
+
 class CouchDB():
     _has_adbs = None # does this couch support the old _all_docs_by_seq api?
     Error = CouchError
     NotFoundError = CouchNotFoundError
-    def __init__(self, host, port=5984, dbName=None, username=None, password=None):
+    STREAM_CHUNK_SIZE = 65536 # pulled from a hat!
+    VIEW_PAGE_SIZE = 1000 # rows fetched per request by iterView.
+    def __init__(self, host, port=5984, dbName=None, username=None, password=None,
+                 pool_size=None, pool_timeout=None):
         self.host = host
         self.port = port
         self.dbName = dbName
         self.username = username
         self.password = password
-        self.connections_available = deque()
+        self.pool = ConnectionPool(host, port, pool_size, pool_timeout)
 
     def _check_error(self, response):
         status = int(response.status)
@@ -81,36 +283,73 @@ class CouchDB():
     def _request(self, method, uri, body = None, headers = None):
         return json.loads(self._rawrequest(method, uri, body, headers))
 
-    def _rawrequest(self, method, uri, body = None, headers = None):
+    def _send_chunked(self, conn, method, uri, body, headers):
+        # Send a request with a body which is sent using the 'chunked'
+        # transfer-encoding, so we never need the entire body in memory.
+        conn.putrequest(method, uri)
+        for name, value in headers.iteritems():
+            conn.putheader(name, value)
+        conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+        for data in _gen_body_chunks(body, self.STREAM_CHUNK_SIZE):
+            conn.send("%x\r\n%s\r\n" % (len(data), data))
+        conn.send("0\r\n\r\n")
+
+    def _release_connection(self, conn, response, detached=False):
+        if response.will_close:
+            # can't reuse this connection.
+            if detached:
+                conn.close()
+            else:
+                self.pool.discard(conn)
+        else:
+            # just incase someone hasn't read it yet.
+            response.read()
+            self.pool.checkin(conn, detached)
+
+    def _rawrequest(self, method, uri, body = None, headers = None,
+                    stream = False):
+        # If 'body' is a file-like object or a generator it is sent using
+        # the chunked transfer-encoding.  If 'stream' is True an
+        # AttachmentReader is returned instead of the response body.
         if headers is None:
             headers = {}
         if 'Accept' not in headers:
             headers['Accept'] = 'application/json'
+        chunked = body is not None and not isinstance(body, basestring)
 
         new_con_retries = 3
         while True: # retry on exceptions using pooled connections
-            try:
-                conn = self.connections_available.popleft()
-                reused = True
-            except IndexError:
-                conn = httplib.HTTPConnection(self.host, self.port)
-                reused = False
+            # A streamed body can't be re-sent, so we don't risk a
+            # pooled connection which the couch may have discarded.
+            conn, reused = self.pool.checkout(fresh=chunked)
             response = None
             try:
                 try:
-                    conn.request(method, uri, body, headers)
+                    if chunked:
+                        self._send_chunked(conn, method, uri, body, headers)
+                    else:
+                        conn.request(method, uri, body, headers)
                     response = conn.getresponse()
                     self._check_error(response)
+                    if stream:
+                        ret = AttachmentReader(self, conn, response)
+                        # the reader now owns the connection.
+                        conn = response = None
+                        return ret
                     return response.read()
                 except (httplib.BadStatusLine, socket.error), exc:
                     # couch may discard old connections resulting in these
                     # exceptions
+                    self.pool.discard(conn, errored=True)
+                    conn = response = None
                     if isinstance(exc, socket.error) and \
                        exc.args[0] not in [errno.ECONNRESET, errno.ECONNABORTED]:
                         logger.warn("non retryable error: %s", exc)
                         raise
-                    conn.close()
-                    conn = response = None
+                    if chunked:
+                        logger.warn("can't retry a streamed request: %s", exc)
+                        raise
                     if not reused:
                         if new_con_retries <= 0:
                             logger.warn("ran out of retries on brand-new connection: %s", exc)
@@ -128,16 +367,9 @@ class CouchDB():
                 if conn is None and response is None:
                     pass
                 elif response is None:
-                    conn.close()
-                elif response.will_close or len(self.connections_available)>10:
-                    # can't/won't reuse this connection.
-                    conn.close()
+                    self.pool.discard(conn, errored=True)
                 else:
-                    # just incase someone hasn't read it yet.
-                    response.read()
-                    self.connections_available.append(conn)
-                    logger.debug("reusing connection - now %d available",
-                                 len(self.connections_available))
+                    self._release_connection(conn, response)
 
     def _getPage(self, uri, **kwargs):
         """
@@ -180,11 +412,65 @@ class CouchDB():
             raise
             return {}
 
+    def iterView(self, docId, viewId, page_size=None, **kwargs):
+        """Like openView, but returns an iterator over the rows which
+        fetches them page_size rows at a time, so the entire result never
+        needs to be in memory.  Can't be used with reduce or skip."""
+        assert 'skip' not in kwargs and 'limit' not in kwargs, kwargs
+        page_size = page_size or self.VIEW_PAGE_SIZE
+        opts = kwargs.copy()
+        keys = opts.pop('keys', None)
+        if keys is None:
+            for row in self._iterViewRange(docId, viewId, page_size, opts):
+                yield row
+            return
+        # A POST of keys can't be paged with startkey - so if a page ends
+        # part way through the rows for a key, we page through the rest of
+        # that key alone then carry on with the keys after it.
+        keys = list(keys)
+        while keys:
+            result = self.openView(docId, viewId, keys=keys, limit=page_size,
+                                   **opts)
+            rows = result['rows']
+            for row in rows:
+                yield row
+            if len(rows) < page_size:
+                break
+            last = rows[-1]
+            index = keys.index(last['key'])
+            range_opts = opts.copy()
+            range_opts['startkey'] = range_opts['endkey'] = last['key']
+            range_opts['startkey_docid'] = last['id']
+            rows = self._iterViewRange(docId, viewId, page_size, range_opts)
+            for row in rows:
+                # the first row(s) may be the ones we have already seen.
+                if row['id'] == last['id'] and row['key'] == last['key']:
+                    continue
+                yield row
+            keys = keys[index+1:]
+
+    def _iterViewRange(self, docId, viewId, page_size, opts):
+        if 'key' in opts:
+            opts['startkey'] = opts['endkey'] = opts.pop('key')
+        while True:
+            # we ask for one more row than we want; it is where the next page
+            # starts.
+            result = self.openView(docId, viewId, limit=page_size+1, **opts)
+            rows = result['rows']
+            for row in rows[:page_size]:
+                yield row
+            if len(rows) <= page_size:
+                break
+            opts['startkey'] = rows[page_size]['key']
+            opts['startkey_docid'] = rows[page_size]['id']
+
     def openDoc(self, docId, revision=None, full=False, attachment="",
-                attachments=False):
+                attachments=False, stream=False):
+        # If 'stream' is True when opening an attachment, a file-like
+        # AttachmentReader is returned rather than a string.
         if attachment:
             uri = "/%s/%s/%s" % (self.dbName, docId, quote(attachment))
-            return self._rawrequest('GET', uri)
+            return self._rawrequest('GET', uri, stream=stream)
 
         uri = "/%s/%s" % (self.dbName, docId)
         try:
@@ -212,8 +498,10 @@ class CouchDB():
         #param name: name of the attachment
         @type name: C{str}
 
-        @param body: content of the attachment.
-        @type body: C{sequence}
+        @param data: content of the attachment - either a string, or a
+                     file-like object or generator which is streamed to the
+                     couch.
+        @type data: C{str}
 
         @param content_type: content type of the attachment
         @type body: C{str}
@@ -264,13 +552,11 @@ class CouchDB():
             # https://issues.apache.org/jira/browse/COUCHDB-326
             # We just need to wait a little and try again...
             # (after closing all outstanding connections...)
-            while self.connections_available:
-                self.connections_available.pop().close()
+            self.pool.close_idle()
             try:
                 self._request('DELETE', uri)
                 # and delete the connection we just made!
-                while self.connections_available:
-                    self.connections_available.pop().close()
+                self.pool.close_idle()
                 break
             except CouchNotFoundError:
                 break
@@ -40,6 +40,8 @@ from raindrop import bootstrap
 from raindrop import pipeline
 from raindrop import opts
 from raindrop import proto
+from raindrop import profiler
+from raindrop import extproc
 from raindrop.sync import get_conductor
 from raindrop.config import get_config, init_config
 
@@ -191,6 +193,13 @@ def process(parser, options):
         return not options.continuous
     result = g_pipeline.start_processing(should_stop)
     print "Message pipeline has finished - created", result, "docs"
+    if options.stats_file:
+        f = open(options.stats_file, "w")
+        try:
+            json.dump(g_pipeline.get_stats(), f, indent=2)
+        finally:
+            f.close()
+        print "Wrote extension stats to", options.stats_file
 
 def process_backlog(parser, options):
     "deprecated - please use 'process'"
@@ -296,22 +305,80 @@ def delete_docs(parser, options):
     # intermediate docs has the same result...
     def _del_docs(to_del):
         docs = []
-        for id, rev in to_del:
-            docs.append({'_id': id, '_rev': rev})
+        for doc in to_del:
+            stub = {'_id': doc['_id'], '_rev': doc['_rev']}
+            # the blobs are needed so unreferenced ones are deleted too.
+            if 'rd_blobs' in doc:
+                stub['rd_blobs'] = doc['rd_blobs']
+            docs.append(stub)
         return model.get_doc_model().delete_documents(docs)
 
-    def _got_docs(result, dt):
-        to_del = [(row['id'], row['value']['_rev']) for row in result['rows']]
-        logger.info("Deleting %d documents of type %r", len(to_del), dt)
-        return to_del
-
     if not options.schemas:
         parser.error("You must specify one or more --schema")
+    dm = model.get_doc_model()
     for st in options.schemas:
         key = ['schema_id', st]
-        result = model.get_doc_model().open_view(key=key, reduce=False)
-        to_del = _got_docs(result, st)
-        _del_docs(to_del)
+        # page through the view, deleting as we go.
+        num = 0
+        to_del = []
+        for row in dm.iter_view(key=key, reduce=False, include_docs=True):
+            to_del.append(row['doc'])
+            if len(to_del) >= 1000:
+                num += len(to_del)
+                _del_docs(to_del)
+                to_del = []
+        if to_del:
+            num += len(to_del)
+            _del_docs(to_del)
+        logger.info("Deleted %d documents of type %r", num, st)
+
+
+def _get_percentile(hist, pct):
+    # hist is a histogram from the extension stats - returns the upper
+    # bound of the bucket holding the given percentile.
+    buckets = sorted((int(b), n) for b, n in hist.iteritems())
+    total = sum(n for b, n in buckets)
+    seen = 0
+    for bucket, n in buckets:
+        seen += n
+        if seen * 100 >= total * pct:
+            return bucket
+    return 0
+
+def show_stats(parser, options):
+    """Show the performance counters for each extension, as saved by the
+       work-queues as they run.  Use --ext to select extensions.
+    """
+    dm = model.get_doc_model()
+    key = ['schema_id', 'rd.core.workqueue-state']
+    result = dm.open_view(key=key, reduce=False, include_docs=True)
+    infos = []
+    for row in result['rows']:
+        doc = row['doc']
+        queue_id = doc['rd_key'][1]
+        if options.exts and queue_id not in options.exts:
+            continue
+        stats = doc.get('stats')
+        if stats:
+            # sort by the (approximate) total time spent in the handler.
+            wall = stats['histograms'].get('wall_ms', {})
+            total = sum(int(b) * n for b, n in wall.iteritems())
+            infos.append((total, queue_id, stats))
+    if not infos:
+        print "No extension stats have been recorded"
+        return
+    fmt = "%-40s %8s %8s %8s %8s %8s %6s %7s %7s %7s %6s %6s %9s"
+    print fmt % ("extension", "seen", "filtered", "current", "skipped",
+                 "done", "errors", "items", "p50ms", "p90ms", "views",
+                 "opens", "att-bytes")
+    for _, queue_id, stats in sorted(infos, reverse=True):
+        c = stats['counters']
+        wall = stats['histograms'].get('wall_ms', {})
+        print fmt % (queue_id, c['seen'], c['filtered'], c['up_to_date'],
+                     c['skipped'], c['processed'], c['errors'], c['items'],
+                     _get_percentile(wall, 50), _get_percentile(wall, 90),
+                     c['open_view'] + c['open_schemas'], c['open_attachment'],
+                     c['attachment_bytes'])
 
 
 def main():
@@ -392,6 +459,13 @@ def main():
             bootstrap.insert_default_docs(options)
             bootstrap.update_apps()
 
+        # The extension process pool is forked from us, so must be started
+        # before any other threads (including the profiler's) exist.
+        if options.processes:
+            extproc.start_pool(model.get_doc_model(), options.processes)
+        if options.profile:
+            profiler.start_profiling()
+
         global g_pipeline, g_conductor
         assert g_pipeline is None and g_conductor is None
         g_pipeline = pipeline.Pipeline(model.get_doc_model(), options)
@@ -420,6 +494,11 @@ def main():
     except:
         print "A command failed - terminating."
         raise   
+    finally:
+        extproc.stop_pool()
+        if options.profile:
+            profiler.stop_profiling(options.profile)
+            print "Wrote profile samples to", options.profile
 
     print "raindrops were falling for", str(datetime.datetime.now()-start)
 